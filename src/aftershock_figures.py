@@ -0,0 +1,519 @@
+"""
+:module: M4.5_Orcas_2025/src/aftershock_figures.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Headless rendering of the aftershock map and magnitude-time figure
+    (see `plot_aftershocks.py`), including batches of snapshot frames (e.g.,
+    hourly figures for the website) rendered across a process pool.
+
+    :class:`~.AftershockFigure` draws the static layers of the figure once
+    (basemap, mainshock beachball, gridlines, axis labels, reference lines,
+    and logo) and :meth:`~.AftershockFigure.draw_events` replaces only the
+    event scatters, stems, and time stamp for each frame. The basemap is the
+    merged tile raster that :meth:`~cartopy.mpl.geoaxes.GeoAxes.add_image`
+    would draw, built once per tile source, extent, and zoom level by
+    :meth:`~.basemap_image` and kept in memory and, optionally, in an `.npz`
+    file shared by all worker processes. Rendering many frames therefore costs
+    little more than rendering one map, plus the time to save each file.
+
+    :class:`~.TileDirectory` reads slippy-map tiles from a local
+    `{root}/{z}/{x}/{y}.png` directory tree, optionally fetching and saving
+    missing tiles from another tile source (e.g., OpenStreetMap), so figures
+    can be rendered offline.
+
+    Figures are created with the Agg canvas directly (no pyplot), so rendering
+    needs no display and is safe in worker processes.
+
+    Event layers are drawn in one of three modes chosen by the number of
+    events in a frame (see :meth:`~.AftershockFigure.render_mode`):
+
+        - 'vector': individual stems and vector scatters, as in the original
+          figure, up to **vector_max** events
+        - 'raster': stems as one :class:`~matplotlib.collections.LineCollection`
+          and scatters, both rasterized, so vector output (PDF/SVG) stays small
+        - 'density': from **density_min** events, hexbin counts on the map and
+          a time-magnitude histogram, with only events above the completeness
+          magnitude drawn individually
+
+    With **stats**, the figure adds a cumulative event count panel below the
+    magnitude-time panel and a log-log aftershock (Omori) rate panel, both
+    computed by binning event times (:meth:`~.cumulative_counts`,
+    :meth:`~.omori_rate`), so their cost does not depend on catalog size.
+"""
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
+from matplotlib.figure import Figure
+from matplotlib.image import imread
+from matplotlib.ticker import EngFormatter
+from matplotlib.offsetbox import AnchoredText
+
+import cartopy.crs as ccrs
+import shapely
+from cartopy.io.img_tiles import GoogleWTS
+from obspy.imaging.beachball import beach
+
+Logger = logging.getLogger(__name__)
+
+WGS84 = ccrs.PlateCarree()
+
+MAIN_COLOR = 'blue'
+AUTO_COLOR = 'goldenrod'
+MANU_COLOR = 'red'
+DETECT_COLOR = 'gray'
+
+PNSN_Green50 = (9/255, 67/255, 9/255, 0.5)
+PNSN_Green75 = (9/255, 67/255, 9/255, 0.75)
+
+# Event layers in drawing order, with their map scatter (and stem) styles.
+# The mainshock is drawn as a beachball on the map, so only as a stem.
+LAYER_STYLES = {
+    'detections': {'color': DETECT_COLOR, 'alpha': 0.5, 'linewidths': 1, 'map': True},
+    'mainshock': {'color': MAIN_COLOR, 'alpha': 1., 'linewidths': 2, 'map': False},
+    'manual': {'color': MANU_COLOR, 'alpha': 0.75, 'linewidths': 2, 'map': True},
+    'auto': {'color': AUTO_COLOR, 'alpha': 0.95, 'linewidths': 2, 'map': True},
+}
+
+RENDER_MODES = ['vector', 'raster', 'density']
+
+# Basemap rasters already built in this process, keyed by tile source, extent, and zoom
+_BASEMAPS = {}
+
+
+class TileDirectory(GoogleWTS):
+    """
+    Slippy-map tiles read from a local `{root}/{z}/{x}/{y}.png` directory tree,
+    the layout used by OpenStreetMap tile servers and tile download tools.
+
+    :param root: tile directory
+    :param source: optional tile source (e.g., :class:`~cartopy.io.img_tiles.OSM`)
+        for tiles missing from **root**, which are saved to **root**.
+        Without a source, missing tiles are blank.
+    :param desired_tile_form: PIL image mode of tiles
+    """
+    def __init__(self, root, source=None, desired_tile_form='RGB'):
+        super().__init__(desired_tile_form=desired_tile_form)
+        self.root = Path(root)
+        self.source = source
+
+    def __repr__(self):
+        return f'TileDirectory(root={self.root}, source={self.source.__class__.__name__})'
+
+    def _image_url(self, tile):
+        x, y, z = tile
+        return (self.root / str(z) / str(x) / f'{y}.png').as_uri()
+
+    def get_image(self, tile):
+        x, y, z = tile
+        path = self.root / str(z) / str(x) / f'{y}.png'
+        if path.exists():
+            img = Image.open(path)
+        elif self.source is not None:
+            img = self.source.get_image(tile)[0]
+            img = img if isinstance(img, Image.Image) else Image.fromarray(np.asarray(img))
+            os.makedirs(str(path.parent), exist_ok=True)
+            img.save(path)
+        else:
+            Logger.warning(f'tile {path} not found, leaving it blank')
+            img = Image.fromarray(np.full((256, 256, 3), 250, dtype=np.uint8))
+        return img.convert(self.desired_tile_form), self.tileextent(tile), 'lower'
+
+
+def projected_extent(imagery, extent):
+    """Project a [lon0, lon1, lat0, lat1] extent into the tile source's CRS"""
+    lon0, lon1, lat0, lat1 = extent
+    x0, y0, x1, y1 = imagery.crs.project_geometry(shapely.box(lon0, lat0, lon1, lat1), WGS84).bounds
+    return [x0, x1, y0, y1]
+
+
+def _basemap_key(imagery, extent, zoom):
+    source = getattr(imagery, 'root', None) or imagery.__class__.__name__
+    return f'{imagery.__class__.__name__}:{source}:{np.round(extent, 1).tolist()}:{zoom}'
+
+
+def basemap_image(imagery, extent, zoom, cache_dir=None):
+    """
+    Get the merged basemap raster for a map extent at a zoom level, as drawn
+    by :meth:`~cartopy.mpl.geoaxes.GeoAxes.add_image`.
+
+    Rasters are built once per process, and with **cache_dir** once per
+    tile source, extent, and zoom level across processes and runs.
+
+    :param imagery: tile source, e.g., :class:`~.TileDirectory`
+    :param extent: [x0, x1, y0, y1] map extent in the tile source's CRS,
+        see :meth:`~.projected_extent`
+    :param zoom: tile zoom level
+    :param cache_dir: optional directory for cached rasters
+
+    :returns: (image, [x0, x1, y0, y1] image extent, origin)
+    """
+    key = _basemap_key(imagery, extent, zoom)
+    if key in _BASEMAPS:
+        return _BASEMAPS[key]
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir) / f'basemap_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npz'
+    if cache_file is not None and cache_file.exists():
+        with np.load(cache_file) as npz:
+            basemap = (npz['img'], npz['extent'].tolist(), str(npz['origin']))
+    else:
+        x0, x1, y0, y1 = extent
+        basemap = imagery.image_for_domain(shapely.box(x0, y0, x1, y1), zoom)
+        if cache_file is not None:
+            os.makedirs(str(cache_file.parent), exist_ok=True)
+            tmp = cache_file.with_suffix('.tmp.npz')
+            np.savez(tmp, img=basemap[0], extent=np.asarray(basemap[1]), origin=basemap[2])
+            os.replace(tmp, cache_file)
+    _BASEMAPS[key] = basemap
+    return basemap
+
+
+def snapshot(layers, time):
+    """Events of each layer with origin times at or before **time**"""
+    time = pd.Timestamp(time)
+    return {_k: _df[_df.DATETIME <= time] for _k, _df in layers.items()}
+
+
+def frame_times(starttime, endtime, step='1h'):
+    """Snapshot times from **starttime** to **endtime** every **step**"""
+    return pd.date_range(pd.Timestamp(starttime), pd.Timestamp(endtime), freq=step)
+
+
+def cumulative_counts(t, edges):
+    """Cumulative number of events before each of **edges** (times **t** in the same units)"""
+    counts = np.histogram(t, bins=np.r_[-np.inf, edges])[0]
+    return np.cumsum(counts)
+
+
+def omori_rate(t, tmin, tmax, nbins=30):
+    """
+    Aftershock rate in logarithmically spaced time bins.
+
+    :param t: event times since the mainshock (e.g., hours), events at or
+        before 0 are ignored
+    :param tmin: start of the first bin (> 0)
+    :param tmax: end of the last bin
+    :param nbins: number of bins
+
+    :returns: (bin centers (geometric mean of edges), rates in events per unit
+        time, event counts) of non-empty bins
+    """
+    edges = np.geomspace(tmin, tmax, nbins + 1)
+    counts = np.histogram(t, bins=edges)[0]
+    rates = counts/np.diff(edges)
+    centers = np.sqrt(edges[:-1]*edges[1:])
+    ok = counts > 0
+    return centers[ok], rates[ok], counts[ok]
+
+
+class AftershockFigure(object):
+    """
+    Aftershock map and magnitude-time figure with static layers drawn once.
+
+    :param imagery: basemap tile source
+    :param extent: [lon0, lon1, lat0, lat1] map extent
+    :param mainshock: :class:`~pandas.Series` with LAT, LON, and DATETIME of the mainshock
+    :param zoom: tile zoom level
+    :param np1: mainshock nodal plane (strike, dip, rake)
+    :param xlim: magnitude-time axis limits in hours since the mainshock
+    :param ylim: magnitude axis limits
+    :param min_mag: completeness magnitude drawn as a reference line
+    :param last_update: optional time of the last manual search, drawn as a reference line
+    :param logo_png: optional logo image file
+    :param figsize: figure size in inches
+    :param fig: optional :class:`~matplotlib.figure.Figure` to draw on, e.g., from
+        :func:`~matplotlib.pyplot.figure` for interactive display. Defaults
+        to a new headless (Agg) figure.
+    :param basemap_cache: optional directory for cached basemap rasters
+    :param stats: add cumulative count and aftershock rate panels
+    :param mode: force a render mode (see :data:`~.RENDER_MODES`), defaults
+        to choosing one by event count
+    :param vector_max: largest number of events drawn as vectors
+    :param density_min: smallest number of events drawn as densities
+    :param gridsize: number of hexagons across the map in 'density' mode
+    :param rate_tmin: start of the first aftershock rate bin in hours
+    """
+    def __init__(self, imagery, extent, mainshock, zoom=11, np1=(15., 55., 90.), xlim=None,
+                 ylim=(-0.3, 5.), min_mag=1.8, last_update=None, logo_png=None,
+                 figsize=None, fig=None, basemap_cache=None, stats=False, mode=None,
+                 vector_max=2000, density_min=50000, gridsize=80, rate_tmin=0.01):
+        if mode is not None and mode not in RENDER_MODES:
+            raise ValueError(f'mode must be None or one of {RENDER_MODES}')
+        if fig is None:
+            fig = Figure(figsize=figsize or ((5.6, 10.5) if stats else (5.6, 7.7)))
+            FigureCanvasAgg(fig)
+        self.fig = fig
+        self.imagery = imagery
+        self.mainshock = mainshock
+        self.mode = mode
+        self.vector_max = vector_max
+        self.density_min = density_min
+        self.gridsize = gridsize
+        self.min_mag = min_mag
+        self._artists = []
+        if stats:
+            outer = fig.add_gridspec(ncols=1, nrows=2, height_ratios=[4, 1.3], hspace=0.3)
+            gs = outer[0].subgridspec(ncols=1, nrows=4, hspace=0)
+        else:
+            gs = fig.add_gridspec(ncols=1, nrows=3, hspace=0)
+        # Map with the cached basemap raster
+        self.axmap = fig.add_subplot(gs[:2], projection=imagery.crs)
+        self.pextent = projected_extent(imagery, extent)
+        self.axmap.set_extent(self.pextent, crs=imagery.crs)
+        img, img_extent, origin = basemap_image(imagery, self.pextent, zoom, cache_dir=basemap_cache)
+        self.axmap.imshow(img, extent=img_extent, origin=origin, transform=imagery.crs)
+        # Add attribution
+        self.axmap.add_artist(AnchoredText('©OpenStreetMap contributors',
+                                           loc=4, prop={'size': 6}, frameon=True))
+        # Mainshock beachball
+        x, y = imagery.crs.transform_point(x=mainshock.LON, y=mainshock.LAT, src_crs=ccrs.Geodetic())
+        self.axmap.add_collection(beach(list(np1), xy=(x, y), width=6000, zorder=1, facecolor=MAIN_COLOR))
+        gl = self.axmap.gridlines(draw_labels=True, zorder=1)
+        gl.bottom_labels = False
+        gl.left_labels = False
+        gl.xlines = False
+        gl.ylines = False
+        self.stamp = self.axmap.text(0.02, 0.98, '', transform=self.axmap.transAxes, ha='left', va='top',
+                                     fontsize=8, bbox={'facecolor': 'white', 'alpha': 0.75, 'linewidth': 0})
+
+        # MAGNITUDE TIME-SERIES
+        self.axts = fig.add_subplot(gs[2])
+        self.axts.grid(linestyle=':')
+        xlabel = f'Hours Since {pd.Timestamp(mainshock.DATETIME).strftime("%Y-%m-%d %H:%M:%S")} (UTC)'
+        self.axts.set_ylabel('Magnitude')
+        xlim = (-1., 48.) if xlim is None else xlim
+        self.axts.set_xlim(xlim)
+        self.axts.set_ylim(ylim)
+        self.xlim, self.ylim = xlim, ylim
+        self.bottom = ylim[0]
+        # Fixed bins so that every frame is binned alike
+        self.time_edges = np.linspace(xlim[0], xlim[1], 401)
+        self.mag_edges = np.arange(ylim[0], ylim[1] + 0.1, 0.1)
+        if stats:
+            self.axts.tick_params(labelbottom=False)
+            # CUMULATIVE COUNT
+            self.axcum = fig.add_subplot(gs[3], sharex=self.axts)
+            self.axcum.grid(linestyle=':')
+            self.axcum.set_ylabel('Event Count')
+            self.axcum.yaxis.set_major_formatter(EngFormatter(sep=''))
+            self.axcum.set_xlabel(xlabel)
+            # AFTERSHOCK RATE
+            self.axrate = fig.add_subplot(outer[1])
+            self.axrate.set_xscale('log')
+            self.axrate.set_yscale('log')
+            self.axrate.grid(linestyle=':', which='both')
+            self.axrate.set_xlim(rate_tmin, xlim[1])
+            self.axrate.set_xlabel('Hours Since Mainshock')
+            self.axrate.set_ylabel('Events / Hour')
+            self.rate_tmin = rate_tmin
+        else:
+            self.axts.set_xlabel(xlabel)
+            self.axcum = self.axrate = None
+        # Add completeness magnitude threshold
+        self.axts.plot(xlim, [min_mag]*2, color=PNSN_Green50)
+        self.axts.text(0.5*sum(xlim), min_mag + 0.1, 'Smallest reliably detected earthquakes',
+                       ha='center', va='bottom', color=PNSN_Green75)
+        # Add last timestamp for manual assessment
+        if last_update is not None:
+            last_dt_hrs = (pd.Timestamp(last_update) - pd.Timestamp(mainshock.DATETIME)).total_seconds()/3600
+            self.axts.plot([last_dt_hrs]*2, ylim, ':', color='firebrick')
+            self.axts.text(last_dt_hrs - 2.5, 3.5, 'Last Manual\nSearch',
+                           color='firebrick', rotation=90, ha='center', va='center')
+        # ADD PNSN LOGO
+        if logo_png is not None:
+            logoax = fig.add_axes([0.01, 0.9, 0.3, 0.3], anchor='SE', zorder=-1)
+            logoax.imshow(imread(str(logo_png)))
+            logoax.axis('off')
+
+    def __repr__(self):
+        return f'AftershockFigure(imagery={self.imagery!r}, artists={len(self._artists)})'
+
+    def clear_events(self):
+        """Remove the event layers of the last frame"""
+        for artist in self._artists:
+            artist.remove()
+        self._artists = []
+
+    def render_mode(self, nevents):
+        """Render mode for a frame with **nevents** events"""
+        if self.mode is not None:
+            return self.mode
+        if nevents <= self.vector_max:
+            return 'vector'
+        if nevents < self.density_min:
+            return 'raster'
+        return 'density'
+
+    def draw_events(self, layers, time=None):
+        """
+        Replace the event layers of the figure.
+
+        :param layers: dict of {layer name: event table} (see :data:`~.LAYER_STYLES`)
+            with LAT, LON, MAG, and 'orig_off_sec' columns
+        :param time: optional time stamp of the frame
+
+        :returns: render mode used
+        """
+        self.clear_events()
+        layers = {_k: _df for _k, _df in layers.items()
+                  if _k in LAYER_STYLES and _df is not None and len(_df) > 0}
+        mode = self.render_mode(sum(len(_df) for _df in layers.values()))
+        if mode == 'density':
+            self._draw_density(layers)
+        else:
+            for name, df in self._ordered(layers):
+                self._draw_layer(df, LAYER_STYLES[name], rasterized=mode == 'raster')
+        if self.axcum is not None:
+            self._draw_stats(layers, time=time)
+        self.stamp.set_text('' if time is None else f'{pd.Timestamp(time).strftime("%Y-%m-%d %H:%M")} UTC')
+        self.stamp.set_visible(time is not None)
+        return mode
+
+    @staticmethod
+    def _ordered(layers):
+        return [(_k, layers[_k]) for _k in LAYER_STYLES if _k in layers]
+
+    def _draw_layer(self, df, style, rasterized=False):
+        t = df.orig_off_sec.values/3600
+        mag = df.MAG.values
+        if style['map']:
+            self._artists.append(
+                self.axmap.scatter(df.LON, df.LAT, s=3**(2 + df.MAG), c='none',
+                                   edgecolors=style['color'], alpha=style['alpha'],
+                                   transform=WGS84, linewidths=style['linewidths'] if not rasterized else 0.5,
+                                   rasterized=rasterized))
+        if not rasterized:
+            ml, sl, bl = self.axts.stem(t, mag, bottom=self.bottom)
+            # Format marker lines
+            ml.set_markerfacecolor('white')
+            ml.set_markeredgecolor(style['color'])
+            ml.set_linewidth(2)
+            sl.set_color(style['color'])
+            sl.set_linewidth(2)
+            bl.set_color('none')
+            self._artists += [ml, sl, bl]
+        else:
+            # One collection of stems and one of heads for all events
+            segments = np.stack([np.c_[t, np.full_like(t, self.bottom)], np.c_[t, mag]], axis=1)
+            self._artists.append(self.axts.add_collection(
+                LineCollection(segments, colors=style['color'], linewidths=0.5, alpha=0.5,
+                               rasterized=True), autolim=False))
+            self._artists.append(self.axts.scatter(t, mag, s=6, c='white', edgecolors=style['color'],
+                                                   linewidths=0.5, rasterized=True, zorder=3))
+
+    def _draw_density(self, layers):
+        df = pd.concat([_df[['MAG', 'orig_off_sec']] for _df in layers.values()])
+        mapped = [_df for _k, _df in layers.items() if LAYER_STYLES[_k]['map']]
+        # Epicenter density on the map, binned in map coordinates over the fixed map extent
+        if len(mapped) > 0:
+            lon = np.concatenate([_df.LON.values for _df in mapped])
+            lat = np.concatenate([_df.LAT.values for _df in mapped])
+            self._artists.append(
+                self.axmap.hexbin(lon, lat, gridsize=self.gridsize,
+                                  extent=self.pextent, bins='log', mincnt=1, cmap='inferno',
+                                  alpha=0.75, linewidths=0, transform=WGS84, rasterized=True, zorder=2))
+            self.axmap.set_extent(self.pextent, crs=self.imagery.crs)
+        # Time-magnitude histogram
+        counts = np.histogram2d(df.orig_off_sec.values/3600, df.MAG.values,
+                                bins=[self.time_edges, self.mag_edges])[0]
+        self._artists.append(
+            self.axts.pcolormesh(self.time_edges, self.mag_edges, np.ma.masked_equal(counts.T, 0),
+                                 norm=LogNorm(vmin=1), cmap='Greys', rasterized=True, zorder=1))
+        # Events above the completeness magnitude stay individual (thin) stems
+        for name, _df in self._ordered(layers):
+            large = _df[_df.MAG >= self.min_mag]
+            if len(large) > 0:
+                self._draw_layer(large, LAYER_STYLES[name], rasterized=name != 'mainshock')
+
+    def _draw_stats(self, layers, time=None):
+        edges = self.time_edges
+        if time is not None:
+            # Counts end at the frame time
+            hours = (pd.Timestamp(time) - pd.Timestamp(self.mainshock.DATETIME)).total_seconds()/3600
+            edges = np.r_[edges[edges < hours], hours]
+        for name, df in self._ordered(layers):
+            if name == 'mainshock':
+                continue
+            style = LAYER_STYLES[name]
+            t = df.orig_off_sec.values/3600
+            line, = self.axcum.plot(edges, cumulative_counts(t, edges), color=style['color'],
+                                    linewidth=1.5, drawstyle='steps-post')
+            self._artists.append(line)
+            centers, rates, _ = omori_rate(t, self.rate_tmin, self.xlim[1])
+            line, = self.axrate.plot(centers, rates, 'o-', color=style['color'], markersize=3,
+                                     markerfacecolor='white', linewidth=1)
+            self._artists.append(line)
+        for ax in (self.axcum, self.axrate):
+            ax.relim()
+            ax.autoscale_view(scalex=False)
+
+    def save(self, path, dpi=250, fmt=None):
+        """Save the current frame"""
+        self.fig.savefig(str(path), format=fmt, dpi=dpi)
+
+
+def _render_chunk(layers, times, paths, figure_kwargs, dpi, fmt):
+    figure = AftershockFigure(**figure_kwargs)
+    for _t, _p in zip(times, paths):
+        figure.draw_events(snapshot(layers, _t), time=_t)
+        figure.save(_p, dpi=dpi, fmt=fmt)
+    return list(paths)
+
+
+def render_frames(layers, times, outdir, figure_kwargs, prefix='aftershocks', dpi=250, fmt='png',
+                  max_workers=None):
+    """
+    Render a snapshot figure of the events before each of **times**.
+
+    Frames are split into one contiguous block per worker process, and each
+    worker draws the static layers of one :class:`~.AftershockFigure` once.
+    The basemap raster is built before workers start, so with a
+    'basemap_cache' in **figure_kwargs** the tiles are read only once.
+
+    :param layers: dict of {layer name: event table}, see :meth:`~.AftershockFigure.draw_events`
+    :param times: snapshot times, e.g., from :meth:`~.frame_times`
+    :param outdir: output directory
+    :param figure_kwargs: keyword arguments of :class:`~.AftershockFigure`
+    :param prefix: file name prefix, followed by the frame time
+    :param dpi: resolution of saved frames
+    :param fmt: file format and extension of saved frames
+    :param max_workers: number of worker processes, defaults to the number of CPUs.
+        With 1, frames are rendered in this process.
+
+    :returns: list of frame file paths
+    """
+    outdir = Path(outdir)
+    os.makedirs(str(outdir), exist_ok=True)
+    times = [pd.Timestamp(_t) for _t in times]
+    paths = [outdir / f'{prefix}_{_t.strftime("%Y%m%dT%H%M%S")}.{fmt}' for _t in times]
+    if len(times) == 0:
+        return []
+    max_workers = min(max_workers or os.cpu_count() or 1, len(times))
+    if max_workers == 1:
+        return _render_chunk(layers, times, paths, figure_kwargs, dpi, fmt)
+    # Build (and cache) the basemap once before workers start
+    imagery = figure_kwargs['imagery']
+    basemap_image(imagery, projected_extent(imagery, figure_kwargs['extent']),
+                  figure_kwargs.get('zoom', 11), cache_dir=figure_kwargs.get('basemap_cache'))
+    blocks = np.array_split(np.arange(len(times)), max_workers)
+    out = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_render_chunk, layers, [times[_i] for _i in _b],
+                                   [paths[_i] for _i in _b], figure_kwargs, dpi, fmt)
+                   for _b in blocks]
+        for future in futures:
+            out += future.result()
+    Logger.info(f'rendered {len(out)} frames to {outdir}')
+    return out
@@ -14,13 +14,18 @@
 from pathlib import Path
 import pandas as pd
 from obspy import UTCDateTime
-from obspy.geodetics import locations2degrees
+
+from event_offsets import get_distances
+from jiggle_io import parse_jiggle_origin_headers, load_event_table
 
 eg_hdr = '61503963 UW 2025-03-03 21:14:40.17   48.6057 -122.8103  17.70  0.92 Ml  eq  L amyw     UW 01  H   2  -  H P5   17.52  0.18'
 
 
 LAT, LON, MZ = 48.611, -122.805, 15.97
 T0 = UTCDateTime('2025-03-03T13:02:37.850')
+# Mainshock reference values in event table form
+MAINSHOCK = pd.Series({'LAT': LAT, 'LON': LON, 'MZ': MZ, 'DATETIME': pd.Timestamp(T0.datetime)})
+
 def parse_jiggle_origin_header(hdr):
     # Split & remove extra whitespace
     parts = hdr.split(' ')
@@ -29,8 +34,8 @@ def parse_jiggle_origin_header(hdr):
     # Parse lines
     evid = parts[0]
     t0 = UTCDateTime(f'{parts[2]}T{parts[3]}')
-    lon = float(parts[4])
-    lat = float(parts[5])
+    lat = float(parts[4])
+    lon = float(parts[5])
     mz = float(parts[6])
     mag = float(parts[7])
     magtype = parts[8]
@@ -40,38 +45,28 @@ def parse_jiggle_origin_header(hdr):
     return output
 
 def get_distances_hdr(hdr):
-    after = parse_jiggle_origin_header(hdr)
-    dist = locations2degrees(LAT,LON, after['lat'], after['lon'])
-    dist_km = 111.2/dist
-    dist_3d_km = (dist_km**2 + (after['mz'] - MZ)**2)**0.5
-    dt = after['t0'] - T0
-    print(f'Epicentral distance: {dist_km: .3f} km')
-    print(f'Hypocentral distance {dist_3d_km:.3f} km')
-    print(f'Origin time {dt/3600:.3f} hrs after mainshock')
-    print(f'Origin time {dt/60:.3f} min after mainshock')
-
-
-def get_distances(df):
-    df = df.sort_values('MAG', ascending=False)
-    ser_main = df.loc[62078906]
-    holder = []
-    for evid, row in df.iterrows():
-        # Get epicentral offsets
-        dh_deg = locations2degrees(ser_main.LAT, ser_main.LON, row.LAT, row.LON)
-        dh_km = 111.2*dh_deg
-        dz_km = row.MZ - ser_main.MZ
-        dx_km = (dz_km**2 + dh_km**2)**0.5
-        dt_sec = (row.DATETIME - ser_main.DATETIME).total_seconds()
-        holder.append([dx_km, dh_km, dt_sec])
-    df_out = pd.DataFrame(data=holder, index=df.index, columns=['hyp_off_km','epi_off_km','orig_off_sec'])
-    return df_out
+    """
+    Get offsets from the mainshock for one or more Jiggle origin headers.
+    **hdr** may be a single header string or anything accepted by
+    :meth:`~jiggle_io.parse_jiggle_origin_headers` (file, multi-line paste, list).
+    Offsets are printed for a single header and returned for all.
+    """
+    df, _ = parse_jiggle_origin_headers(hdr)
+    df = pd.concat([df, get_distances(df, ref=MAINSHOCK)], axis=1, ignore_index=False)
+    if len(df) == 1:
+        after = df.iloc[0]
+        print(f'Epicentral distance: {after.epi_off_km: .3f} km')
+        print(f'Hypocentral distance {after.hyp_off_km:.3f} km')
+        print(f'Origin time {after.orig_off_sec/3600:.3f} hrs after mainshock')
+        print(f'Origin time {after.orig_off_sec/60:.3f} min after mainshock')
+    return df
 
 
 if __name__ == '__main__':
     ROOT = Path(__file__).parent.parent
     EFILE = ROOT / 'data' / 'jiggle' / 'Event_Table_Output_4MAR2025_1900UTC.csv'
     # Load events with datetimes
-    df = pd.read_csv(EFILE, index_col=[0], parse_dates=['DATETIME'])
+    df = load_event_table(EFILE)
     # Sort by descending magnitude
     df = df.sort_values(by='MAG', ascending=False)
     # Calculate time/location differences
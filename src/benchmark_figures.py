@@ -0,0 +1,122 @@
+"""
+:module: M4.5_Orcas_2025/src/benchmark_figures.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Benchmark rendering of the aftershock map and magnitude-time figure
+    (:class:`~aftershock_figures.AftershockFigure`) for synthetic detection
+    catalogs of increasing size. Every catalog size is rendered with the
+    render mode chosen by event count and with vector layers forced (as in
+    the original figure), and the draw time, save time, and file size of each
+    output format are tabulated.
+
+    Basemap tiles are read from the local tile directory only, so the
+    benchmark runs offline (missing tiles are blank).
+"""
+
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from aftershock_figures import AftershockFigure, TileDirectory
+
+sys.path.append(str(Path(__file__).parent / 'template_match'))
+from event_offsets import get_distances
+from synthetic_sequence import MAINSHOCK, synthetic_sequence
+
+Logger = logging.getLogger(__name__)
+
+
+def synthetic_layers(nevents, starttime, duration, seed=0):
+    """
+    Make figure layers for a synthetic sequence of **nevents** detections
+    following an M4.5 mainshock at **starttime** (see
+    :meth:`~synthetic_sequence.synthetic_sequence`).
+
+    :returns: (dict of {layer name: event table}, mainshock :class:`~pandas.Series`)
+    """
+    df, _ = synthetic_sequence(nevents, starttime, duration, mmin=-0.5, mmax=4., seed=seed)
+    main = pd.Series(dict(MAINSHOCK, DATETIME=df.DATETIME.min().floor('s'), MAG=4.5))
+    df = df[['DATETIME', 'LAT', 'LON', 'MZ', 'MAG']].join(get_distances(df, ref=main))
+    mainshock = pd.DataFrame([main], index=pd.Index([0], name='ID'))
+    mainshock = mainshock.join(get_distances(mainshock, ref=main))
+    return {'detections': df, 'mainshock': mainshock}, main
+
+
+def benchmark_rendering(sizes, figure_kwargs, outdir, duration=7*86400., modes=(None, 'vector'),
+                        formats=('png', 'pdf'), dpi=150, vector_max_events=None, seed=0):
+    """
+    Time drawing and saving a figure for catalogs of each of **sizes** events.
+
+    :param sizes: numbers of events
+    :param figure_kwargs: keyword arguments of :class:`~aftershock_figures.AftershockFigure`
+        other than 'mainshock', 'xlim', and 'mode'
+    :param outdir: directory for rendered files
+    :param duration: sequence length in seconds
+    :param modes: render modes to compare, None chooses by event count
+    :param formats: output formats
+    :param dpi: output resolution
+    :param vector_max_events: optional largest catalog rendered in forced 'vector' mode
+    :param seed: random seed
+
+    :returns: :class:`~pandas.DataFrame` with one row per size, mode, and
+        format with 'draw_s', 'save_s', 'total_s', and 'size_mb' columns
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    hours = duration/3600
+    rows = []
+    for nevents in sizes:
+        layers, main = synthetic_layers(nevents, '2025-03-03T13:02:37', duration, seed=seed)
+        for mode in modes:
+            if mode == 'vector' and vector_max_events is not None and nevents > vector_max_events:
+                continue
+            tic = time.perf_counter()
+            figure = AftershockFigure(mainshock=main, xlim=(-0.05*hours, 1.05*hours), mode=mode,
+                                      **figure_kwargs)
+            used = figure.draw_events(layers)
+            draw_s = time.perf_counter() - tic
+            for fmt in formats:
+                path = outdir / f'figure_{nevents}_{mode or "auto"}.{fmt}'
+                tic = time.perf_counter()
+                figure.save(path, dpi=dpi, fmt=fmt)
+                save_s = time.perf_counter() - tic
+                rows.append({'nevents': nevents, 'mode': mode or 'auto', 'used': used, 'format': fmt,
+                             'draw_s': draw_s, 'save_s': save_s, 'total_s': draw_s + save_s,
+                             'size_mb': path.stat().st_size/2**20})
+                Logger.info(f'{nevents} events, {used}, {fmt}: {draw_s + save_s:.2f} s, '
+                            f'{rows[-1]["size_mb"]:.2f} MB')
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    ROOT = Path(__file__).parent.parent
+    # Local OSM tile directory (see plot_aftershocks.py), read offline
+    TILES = ROOT / 'data' / 'tiles' / 'osm'
+    BASEMAPS = ROOT / 'processed_data' / 'basemaps'
+    REPORT = ROOT / 'processed_data' / 'benchmarks' / 'figure_rendering.csv'
+    # Rendered figures are kept here (deleted after the run if None)
+    OUTDIR = None
+    SIZES = [50, 1000, 10000, 100000]
+    # Largest catalog also rendered with forced vector layers
+    VECTOR_MAX_EVENTS = 100000
+    FORMATS = ['png', 'pdf']
+    DPI = 150
+    # Map extent around the mainshock [lon0, lon1, lat0, lat1]
+    EXTENT = [-122.97, -122.64, 48.50, 48.72]
+
+    figure_kwargs = {'imagery': TileDirectory(TILES), 'extent': EXTENT, 'zoom': 11, 'stats': True,
+                     'ylim': (-0.6, 5.), 'basemap_cache': BASEMAPS}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        results = benchmark_rendering(SIZES, figure_kwargs, OUTDIR or tmpdir, formats=FORMATS, dpi=DPI,
+                                      vector_max_events=VECTOR_MAX_EVENTS)
+    REPORT.parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(REPORT, index=False)
+    print(results.pivot_table(index=['nevents', 'mode', 'used'], columns='format',
+                              values=['total_s', 'size_mb']).round(2).to_string())
@@ -0,0 +1,191 @@
+"""
+:module: M4.5_Orcas_2025/src/catalog_store.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: An incremental, on-disk catalog store for successive Jiggle event table
+    exports. Events are keyed on event ID (ID) and version (VER). Loading a new
+    export only applies the inserted, updated (VER changed) and deleted events,
+    and registered derived tables (e.g., offsets from the mainshock or modeled
+    picks) are only recomputed for the events that changed.
+
+    Store layout::
+
+        {root}/events.parquet           -- current event table
+        {root}/derived/{name}.parquet   -- derived tables indexed by event ID
+"""
+
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from jiggle_io import load_event_table, match_event_table_dtypes
+
+Logger = logging.getLogger(__name__)
+
+
+class CatalogDelta(object):
+    """
+    Event IDs inserted, updated, and deleted by a catalog update.
+    """
+    def __init__(self, inserted, updated, deleted):
+        self.inserted = pd.Index(inserted, name='ID')
+        self.updated = pd.Index(updated, name='ID')
+        self.deleted = pd.Index(deleted, name='ID')
+
+    @property
+    def changed(self):
+        """IDs of events whose derived values need to be (re)computed"""
+        return self.inserted.union(self.updated)
+
+    @property
+    def removed(self):
+        """IDs of events whose existing derived values are stale"""
+        return self.updated.union(self.deleted)
+
+    def __len__(self):
+        return len(self.inserted) + len(self.updated) + len(self.deleted)
+
+    def __repr__(self):
+        return (f'CatalogDelta(inserted={len(self.inserted)}, updated={len(self.updated)}, '
+                f'deleted={len(self.deleted)})')
+
+
+def _restore_categories(df, like):
+    """Re-apply categorical dtypes that are lost when concatenating tables"""
+    for col in like.columns:
+        if col in df.columns and isinstance(like[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+class CatalogStore(object):
+    """
+    Incrementally updated event table with derived tables.
+
+    :param root: directory to host the store
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.events_file = self.root / 'events.parquet'
+        self.derived_dir = self.root / 'derived'
+        os.makedirs(str(self.derived_dir), exist_ok=True)
+        if self.events_file.exists():
+            self.events = match_event_table_dtypes(pd.read_parquet(self.events_file))
+        else:
+            self.events = None
+        self.derived = {}
+        self._derivations = {}
+
+    def __repr__(self):
+        nev = 0 if self.events is None else len(self.events)
+        return f'CatalogStore(root={self.root}, events={nev}, derived={list(self._derivations.keys())})'
+
+    def _derived_file(self, name):
+        return self.derived_dir / f'{name}.parquet'
+
+    def register(self, name, func, refresh_on=None):
+        """
+        Register a derived table.
+
+        :param name: name of the derived table
+        :param func: callable with signature func(df_changed, df_all) that returns a
+            :class:`~pandas.DataFrame` indexed by event ID (repeated IDs are allowed,
+            e.g., one row per modeled pick) for the events in **df_changed**
+        :param refresh_on: optional list of event IDs that all rows depend on (e.g., a
+            reference event). If any of these change, the whole table is recomputed.
+        """
+        self._derivations[name] = (func, refresh_on)
+        path = self._derived_file(name)
+        if path.exists():
+            self.derived[name] = pd.read_parquet(path)
+        elif self.events is not None and len(self.events) > 0:
+            self._recompute(name, self.events.index)
+            self._save(name)
+
+    def _recompute(self, name, evids):
+        """Recompute derived table **name** for events **evids**"""
+        func, _ = self._derivations[name]
+        if len(evids) == 0:
+            return
+        old = self.derived.get(name)
+        if old is not None:
+            old = old[~old.index.isin(evids)]
+        new = func(self.events.loc[self.events.index.intersection(evids)], self.events)
+        if old is None or len(old) == 0:
+            self.derived[name] = new
+        else:
+            self.derived[name] = _restore_categories(pd.concat([old, new]), new)
+
+    def _save(self, name=None):
+        if name is None:
+            self.events.to_parquet(self.events_file)
+        else:
+            self.derived[name].to_parquet(self._derived_file(name))
+
+    def diff(self, df, deletions=True):
+        """
+        Compare an event table export to the store's contents.
+
+        :param df: event table indexed by event ID with a VER column
+        :param deletions: if True, events missing from **df** are deleted. Set to
+            False when **df** only covers part of the catalog.
+        """
+        if self.events is None:
+            return CatalogDelta(df.index, [], [])
+        old, new = self.events.index, df.index
+        common = old.intersection(new)
+        isupdated = self.events.loc[common, 'VER'].values != df.loc[common, 'VER'].values
+        deleted = old.difference(new) if deletions else []
+        return CatalogDelta(new.difference(old), common[isupdated], deleted)
+
+    def update(self, df, deletions=True):
+        """
+        Apply the changes in an event table export and update derived tables for
+        the changed events only. Returns the :class:`~.CatalogDelta`.
+        """
+        delta = self.diff(df, deletions=deletions)
+        Logger.info(f'{delta}')
+        if len(delta) == 0 and self.events is not None:
+            return delta
+        if self.events is None:
+            self.events = df.copy()
+        else:
+            keep = self.events[~self.events.index.isin(delta.removed)]
+            self.events = _restore_categories(pd.concat([keep, df.loc[delta.changed]]), df)
+        self.events = self.events.sort_values('DATETIME')
+        self._save()
+        for name, (func, refresh_on) in self._derivations.items():
+            if refresh_on is not None and delta.removed.union(delta.changed).isin(refresh_on).any():
+                evids = self.events.index
+            else:
+                evids = delta.changed
+            # Drop values for deleted events
+            if name in self.derived:
+                self.derived[name] = self.derived[name][~self.derived[name].index.isin(delta.deleted)]
+            self._recompute(name, evids)
+            self._save(name)
+        return delta
+
+    def load_csv(self, csv_file, deletions=True, **kwargs):
+        """Load a Jiggle event table export and apply it with :meth:`~.CatalogStore.update`"""
+        return self.update(load_event_table(csv_file, **kwargs), deletions=deletions)
+
+    def invalidate(self, name):
+        """Recompute derived table **name** for all events"""
+        self.derived.pop(name, None)
+        self._recompute(name, self.events.index)
+        self._save(name)
+
+    def get(self, *names):
+        """
+        Get the event table with (one-row-per-event) derived tables **names**
+        joined as additional columns.
+        """
+        df = self.events.copy()
+        for name in names:
+            df = df.join(self.derived[name], how='left')
+        return df
@@ -0,0 +1,115 @@
+"""
+:module: M4.5_Orcas_2025/src/event_offsets.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Vectorized epicentral, hypocentral, and origin time offsets between
+    events in an AQMS event table (as exported from Jiggle) and a reference
+    event, plus event-to-event (pairwise) offsets.
+
+    Event tables are :class:`~pandas.DataFrame` objects indexed by event ID with
+    (at least) LAT, LON, MZ, and DATETIME columns. Epicentral distances use
+    :meth:`~obspy.geodetics.locations2degrees` on whole arrays and the same
+    111.2 km/degree conversion as the original per-row calculations.
+"""
+
+import numpy as np
+import pandas as pd
+from obspy.geodetics import locations2degrees
+
+# Event ID of the M4.5 Orcas Island mainshock
+MAINSHOCK_EVID = 62078906
+# Kilometers per degree of arc
+DEG2KM = 111.2
+OFFSET_COLUMNS = ['hyp_off_km', 'epi_off_km', 'orig_off_sec']
+
+
+def get_distances(df, ref_evid=MAINSHOCK_EVID, ref=None):
+    """
+    Get hypocentral and epicentral offsets (km) and origin time offsets (sec)
+    of every event in **df** relative to a reference event.
+
+    :param df: event table indexed by event ID
+    :param ref_evid: event ID of the reference event in **df**
+    :param ref: optional :class:`~pandas.Series` with LAT, LON, MZ, and DATETIME
+        values for a reference event that is not in **df**. Supersedes **ref_evid**.
+
+    :returns: :class:`~pandas.DataFrame` with **df**'s index and
+        'hyp_off_km', 'epi_off_km', and 'orig_off_sec' columns
+    """
+    if ref is None:
+        ref = df.loc[ref_evid]
+    dh_km = DEG2KM*locations2degrees(ref.LAT, ref.LON, df.LAT.values, df.LON.values)
+    dz_km = df.MZ.values - ref.MZ
+    dx_km = (dz_km**2 + dh_km**2)**0.5
+    dt_sec = (df.DATETIME - pd.Timestamp(ref.DATETIME)).dt.total_seconds().values
+    return pd.DataFrame(data={'hyp_off_km': dx_km, 'epi_off_km': dh_km, 'orig_off_sec': dt_sec},
+                        index=df.index, columns=OFFSET_COLUMNS)
+
+
+def _epoch_seconds(times):
+    """Convert a datetime-like Series to float seconds since 1970-01-01"""
+    return (pd.to_datetime(times) - pd.Timestamp('1970-01-01')).dt.total_seconds().values
+
+
+def pairwise_distances(df):
+    """
+    Get dense event-to-event offset matrices for the events in **df**.
+    Element [i, j] is the offset of event j relative to event i.
+
+    Memory scales as N**2, so use :meth:`~.neighbor_pairs` for large catalogs.
+
+    :returns: tuple of (N, N) :class:`~numpy.ndarray` objects with hypocentral
+        offsets (km), epicentral offsets (km), and origin time offsets (sec)
+    """
+    lat = df.LAT.values
+    lon = df.LON.values
+    mz = df.MZ.values
+    t = _epoch_seconds(df.DATETIME)
+    dh_km = DEG2KM*locations2degrees(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+    dz_km = mz[None, :] - mz[:, None]
+    dx_km = (dz_km**2 + dh_km**2)**0.5
+    dt_sec = t[None, :] - t[:, None]
+    return dx_km, dh_km, dt_sec
+
+
+def neighbor_pairs(df, max_km, block_size=2048):
+    """
+    Get all event pairs with hypocentral offsets of **max_km** or less, computed
+    in blocks of **block_size** rows so that memory use stays bounded for large
+    catalogs (e.g., matched-filter detections).
+
+    :returns: :class:`~pandas.DataFrame` with one row per pair (i < j) and
+        'evid_i', 'evid_j', 'hyp_off_km', 'epi_off_km', and 'orig_off_sec' columns
+    """
+    lat = df.LAT.values
+    lon = df.LON.values
+    mz = df.MZ.values
+    t = _epoch_seconds(df.DATETIME)
+    evids = df.index.values
+    nev = len(df)
+    holder = []
+    for i0 in range(0, nev, block_size):
+        i1 = min(i0 + block_size, nev)
+        # Only blocks on or above the diagonal (j >= i) are needed
+        for j0 in range(i0, nev, block_size):
+            j1 = min(j0 + block_size, nev)
+            dh_km = DEG2KM*locations2degrees(lat[i0:i1, None], lon[i0:i1, None],
+                                              lat[None, j0:j1], lon[None, j0:j1])
+            dz_km = mz[None, j0:j1] - mz[i0:i1, None]
+            dx_km = (dz_km**2 + dh_km**2)**0.5
+            ii, jj = np.nonzero(dx_km <= max_km)
+            keep = j0 + jj > i0 + ii
+            ii, jj = ii[keep], jj[keep]
+            if len(ii) == 0:
+                continue
+            holder.append(pd.DataFrame({
+                'evid_i': evids[i0 + ii],
+                'evid_j': evids[j0 + jj],
+                'hyp_off_km': dx_km[ii, jj],
+                'epi_off_km': dh_km[ii, jj],
+                'orig_off_sec': t[j0 + jj] - t[i0 + ii]}))
+    if len(holder) == 0:
+        return pd.DataFrame(columns=['evid_i', 'evid_j'] + OFFSET_COLUMNS)
+    return pd.concat(holder, ignore_index=True)
@@ -0,0 +1,154 @@
+"""
+:module: M4.5_Orcas_2025/src/fake_clients.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Local stand-ins for an FDSN waveform client that serve data from
+    memory, with injectable latency and failures, for exercising the waveform
+    archive and fetch engine without network access, and a replay client that
+    serves archived data as if it were arriving in real time.
+"""
+
+import random
+import threading
+import time
+import zlib
+
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime, read
+
+
+class FakeClientError(Exception):
+    """Injected failure raised by :class:`~.FakeClient`"""
+    pass
+
+
+class FakeClient(object):
+    """
+    Serve waveforms from an in-memory :class:`~obspy.core.stream.Stream`.
+
+    :param stream: data to serve. If `None`, gaussian noise is generated for
+        each NSLC code in **nslc** at **sampling_rate**.
+    :param nslc: list of 'NET.STA.LOC.CHA' codes to synthesize when
+        **stream** is `None`
+    :param sampling_rate: sampling rate of synthesized data
+    :param latency: seconds to wait before answering each request
+    :param jitter: maximum additional random latency in seconds
+    :param failure_rate: probability in [0, 1] that a request raises a
+        :class:`~.FakeClientError`
+    :param seed: seed for the random number generator used for failures
+        and synthesized data
+
+    Every request is appended to **self.requests** as a
+    (network, station, location, channel, starttime, endtime) tuple.
+    """
+    def __init__(self, stream=None, nslc=None, sampling_rate=100., latency=0.,
+                 jitter=0., failure_rate=0., seed=None):
+        self.stream = stream
+        self.nslc = list(nslc) if nslc is not None else []
+        self.sampling_rate = float(sampling_rate)
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.failure_rate = float(failure_rate)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = []
+
+    def __repr__(self):
+        return (f'FakeClient(latency={self.latency}, failure_rate={self.failure_rate}, '
+                f'requests={len(self.requests)})')
+
+    def _synthesize(self, network, station, location, channel, starttime, endtime):
+        st = Stream()
+        template = Stream([Trace(header={'network': _n, 'station': _s, 'location': _l, 'channel': _c})
+                           for _n, _s, _l, _c in [_e.split('.') for _e in self.nslc]])
+        for tr in template.select(network=network, station=station, location=location, channel=channel):
+            npts = int((endtime - starttime)*self.sampling_rate) + 1
+            # Seed on the request so that repeated requests return identical data
+            seed = zlib.crc32(f'{tr.id}.{float(starttime):.2f}'.encode())
+            tr.data = np.random.default_rng(seed).normal(0, 100, npts).astype(np.int32)
+            tr.stats.sampling_rate = self.sampling_rate
+            tr.stats.starttime = starttime
+            st += tr
+        return st
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime, **kwargs):
+        starttime = UTCDateTime(starttime)
+        endtime = UTCDateTime(endtime)
+        with self._lock:
+            self.requests.append((network, station, location, channel, starttime, endtime))
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            fail = self._rng.random() < self.failure_rate
+        time.sleep(delay)
+        if fail:
+            raise FakeClientError(f'injected failure: {network}.{station}.{location}.{channel} {starttime} - {endtime}')
+        if location == '--':
+            location = ''
+        if self.stream is None:
+            return self._synthesize(network, station, location, channel, starttime, endtime)
+        st = self.stream.select(network=network, station=station, location=location, channel=channel)
+        return st.slice(starttime=starttime, endtime=endtime).copy()
+
+    def get_waveforms_bulk(self, bulk, **kwargs):
+        st = Stream()
+        for _b in bulk:
+            st += self.get_waveforms(*_b)
+        return st
+
+
+class ReplayClient(object):
+    """
+    Replay archived waveforms as if they were arriving in real time, at
+    **speed** times real time. Requests only return data up to the replay
+    clock's current time, :meth:`~.ReplayClient.now`.
+
+    :param source: object with a `get_waveforms` method (e.g., a read-only
+        :class:`~waveform_archive.WaveformArchive`), a :class:`~obspy.core.stream.Stream`,
+        or a miniSEED file path, glob, or list of paths to read into memory
+    :param starttime: replay time at which the replay clock starts
+    :param speed: replay clock seconds per wall clock second
+    :param latency: seconds the newest available data lag the replay clock
+    """
+    def __init__(self, source, starttime, speed=1., latency=0.):
+        if isinstance(source, (str, list)):
+            paths = [source] if isinstance(source, str) else source
+            st = Stream()
+            for path in paths:
+                st += read(str(path))
+            source = st
+        if isinstance(source, Stream):
+            source = FakeClient(stream=source.merge(method=-1))
+        self.source = source
+        self.starttime = UTCDateTime(starttime)
+        self.speed = float(speed)
+        self.latency = float(latency)
+        self._wall0 = time.monotonic()
+        self.requests = []
+
+    def __repr__(self):
+        return f'ReplayClient(now={self.now()}, speed={self.speed}, requests={len(self.requests)})'
+
+    def now(self):
+        """Current time of the replay clock"""
+        return self.starttime + self.speed*(time.monotonic() - self._wall0)
+
+    def sleep(self, seconds):
+        """Sleep for **seconds** of replay time"""
+        time.sleep(seconds/self.speed)
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime, **kwargs):
+        horizon = self.now() - self.latency
+        starttime = UTCDateTime(starttime)
+        endtime = min(UTCDateTime(endtime), horizon)
+        self.requests.append((network, station, location, channel, starttime, endtime))
+        if endtime <= starttime:
+            return Stream()
+        st = self.source.get_waveforms(network, station, location, channel, starttime, endtime)
+        return st.slice(starttime=starttime, endtime=endtime)
+
+    def get_waveforms_bulk(self, bulk, **kwargs):
+        st = Stream()
+        for _b in bulk:
+            st += self.get_waveforms(*_b)
+        return st
@@ -0,0 +1,218 @@
+"""
+:module: M4.5_Orcas_2025/src/jiggle_io.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Readers for event metadata exported from AQMS's Jiggle GUI.
+
+    :meth:`~.load_event_table` loads a Jiggle event table export (e.g.,
+    `Event_Table_Output_6MAR2025_1800UTC.csv`) with explicit dtypes, unquoted
+    string fields, boolean fixed-flag columns (TF, HF, ZF), categorical code
+    columns, and a schema check. The parsed table is cached in a Parquet
+    sidecar file that is reused until the CSV contents change.
+
+    :meth:`~.parse_jiggle_origin_headers` parses pasted Jiggle origin/magnitude
+    solution strings (one per line) in bulk into a typed event table with the
+    same column names as Jiggle's event table exports, e.g.::
+
+        61503963 UW 2025-03-03 21:14:40.17   48.6057 -122.8103  17.70  0.92 Ml  eq  L amyw ...
+        [ID]  [AUTH] [DATE]     [TIME]       [LAT]    [LON]     [MZ]   [MAG][MTYP][ETYPE]
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+Logger = logging.getLogger(__name__)
+
+# Increment when parsing changes so stale sidecar files are not reused
+SCHEMA_VERSION = 1
+
+# Column dtypes of Jiggle event table exports (ID is the index)
+EVENT_TABLE_SCHEMA = {
+    'VER': 'int64', 'OWHO': 'category', 'ST': 'category', 'DATETIME': 'datetime64[ns]',
+    'TF': 'bool', 'MAG': 'float64', 'MTYP': 'category', 'MOBS': 'Int64',
+    'MERR': 'float64', 'MWHO': 'category', 'HF': 'bool', 'LAT': 'float64',
+    'LON': 'float64', 'Z': 'float64', 'MZ': 'float64', 'GZ': 'float64', 'ZF': 'bool',
+    'ERR_H': 'float64', 'ERR_Z': 'float64', 'ETYPE': 'category', 'GT': 'category',
+    'SRC': 'category', 'GAP': 'float64', 'DIST': 'float64', 'RMS': 'float64',
+    'OBS': 'Int64', 'USED': 'Int64', 'S': 'Int64', 'FM': 'Int64', 'WRECS': 'Int64',
+    'Q': 'float64', 'V': 'Int64', 'B': 'Int64', 'COMMENT': 'string'}
+# Columns holding '0'/'1' flags
+FLAG_COLUMNS = ['TF', 'HF', 'ZF']
+
+# Leading fields of a Jiggle origin header line
+HEADER_REGEX = (
+    r'^\s*(?P<ID>\d+)\s+(?P<AUTH>\S+)\s+'
+    r'(?P<DATE>\d{4}-\d{2}-\d{2})\s+(?P<TIME>\d{1,2}:\d{2}:\d{2}(?:\.\d*)?)\s+'
+    r'(?P<LAT>[-+]?\d+(?:\.\d*)?)\s+(?P<LON>[-+]?\d+(?:\.\d*)?)\s+'
+    r'(?P<MZ>[-+]?\d+(?:\.\d*)?)\s+(?P<MAG>[-+]?\d+(?:\.\d*)?)\s+'
+    r'(?P<MTYP>\S+)\s+(?P<ETYPE>\S+)')
+
+
+def _read_lines(source):
+    """Get a list of lines from a path, file-like object, string, or iterable of strings"""
+    if isinstance(source, (str, os.PathLike)) and '\n' not in str(source) and os.path.isfile(source):
+        with open(source, 'r') as _f:
+            return _f.read().splitlines()
+    elif isinstance(source, str):
+        return source.splitlines()
+    elif isinstance(source, io.IOBase):
+        return source.read().splitlines()
+    else:
+        return [_l.rstrip('\n') for _l in source]
+
+
+def parse_jiggle_origin_headers(source, errors='warn'):
+    """
+    Parse many Jiggle origin header lines at once.
+
+    :param source: file path, open file, multi-line string, or iterable of
+        header strings. Blank lines are skipped.
+    :param errors: how to handle malformed lines: 'warn' logs each malformed
+        line with its line number, 'raise' raises a :class:`ValueError` listing
+        them, and 'ignore' skips them silently.
+
+    :returns:
+        - **df** (*pandas.DataFrame*) -- event table indexed by event ID (ID)
+          with DATETIME (datetime64), LAT, LON, MZ, MAG (float), AUTH, MTYP,
+          and ETYPE (categorical) columns
+        - **bad** (*pandas.DataFrame*) -- malformed lines with their 1-indexed
+          line numbers ('lineno') and text ('line')
+    """
+    if errors not in ['warn', 'raise', 'ignore']:
+        raise ValueError(f'errors "{errors}" not supported')
+    lines = pd.Series(_read_lines(source), dtype=object)
+    lines.index = pd.RangeIndex(1, len(lines) + 1, name='lineno')
+    lines = lines[lines.str.strip() != '']
+    parts = lines.str.extract(HEADER_REGEX)
+    # Flag unparsable lines
+    isbad = parts.ID.isna()
+    datetimes = pd.to_datetime(parts.DATE + 'T' + parts.TIME, errors='coerce', format='ISO8601')
+    isbad |= datetimes.isna()
+    bad = pd.DataFrame({'lineno': lines.index[isbad], 'line': lines[isbad].values})
+    if len(bad) > 0:
+        msg = '\n'.join(f'line {_r.lineno}: {_r.line}' for _r in bad.itertuples())
+        if errors == 'raise':
+            raise ValueError(f'{len(bad)} malformed Jiggle header lines:\n{msg}')
+        elif errors == 'warn':
+            Logger.warning(f'skipping {len(bad)} malformed Jiggle header lines:\n{msg}')
+    parts = parts[~isbad]
+    df = pd.DataFrame({
+        'DATETIME': datetimes[~isbad],
+        'LAT': parts.LAT.astype(float),
+        'LON': parts.LON.astype(float),
+        'MZ': parts.MZ.astype(float),
+        'MAG': parts.MAG.astype(float),
+        'AUTH': parts.AUTH.astype('category'),
+        'MTYP': parts.MTYP.astype('category'),
+        'ETYPE': parts.ETYPE.astype('category')})
+    df.index = pd.Index(parts.ID.astype('int64').values, name='ID')
+    return df, bad
+
+
+def _read_event_table_csv(csv_file):
+    """Parse a Jiggle event table CSV into a typed DataFrame"""
+    # Read flags and categories as strings, then convert
+    dtype = {}
+    for _k, _v in EVENT_TABLE_SCHEMA.items():
+        if _k == 'DATETIME':
+            continue
+        elif _k in FLAG_COLUMNS or _v in ['category', 'string']:
+            dtype[_k] = 'string'
+        else:
+            dtype[_k] = _v
+    # Jiggle single-quotes string fields
+    df = pd.read_csv(csv_file, index_col=[0], quotechar="'", dtype=dtype,
+                     skipinitialspace=True)
+    # Check columns against the schema
+    missing = set(EVENT_TABLE_SCHEMA.keys()).difference(df.columns)
+    if df.index.name != 'ID' or len(missing) > 0:
+        raise ValueError(f'{csv_file} does not match the event table schema. '
+                         f'Index: {df.index.name}, missing columns: {sorted(missing)}')
+    extra = set(df.columns).difference(EVENT_TABLE_SCHEMA.keys())
+    if len(extra) > 0:
+        Logger.warning(f'{csv_file} has unexpected columns: {sorted(extra)}')
+    df.index = df.index.astype('int64')
+    df['DATETIME'] = pd.to_datetime(df.DATETIME, format='ISO8601').astype('datetime64[ns]')
+    for _k in FLAG_COLUMNS:
+        bad = ~df[_k].isin(['0', '1'])
+        if bad.any():
+            raise ValueError(f'{csv_file} has non-0/1 {_k} values for events {df.index[bad].tolist()}')
+        df[_k] = (df[_k] == '1').astype(bool)
+    for _k, _v in EVENT_TABLE_SCHEMA.items():
+        if _v == 'category':
+            df[_k] = df[_k].astype('category')
+    return df
+
+
+def match_event_table_dtypes(df):
+    """
+    Give an event table read from Parquet (e.g., a sidecar file) the string
+    and categorical dtypes of a freshly parsed CSV. Parquet round-trips string columns with a
+    different NA value, and categories as the default string dtype ('str' in
+    pandas 3) rather than the 'string' dtype categories are parsed with.
+    """
+    for _k, _v in EVENT_TABLE_SCHEMA.items():
+        if _v == 'string':
+            df[_k] = df[_k].astype('string')
+        elif _v == 'category':
+            categories = df[_k].cat.categories.astype('string')
+            df[_k] = df[_k].astype(pd.CategoricalDtype(categories, ordered=df[_k].cat.ordered))
+    return df
+
+
+def _file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as _f:
+        for block in iter(lambda: _f.read(2**20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_event_table(csv_file, cache=True, cache_dir=None):
+    """
+    Load a Jiggle event table export as a typed :class:`~pandas.DataFrame`
+    indexed by event ID.
+
+    String fields are unquoted, TF/HF/ZF become booleans, code columns (ST,
+    MTYP, ETYPE, ...) become categoricals, and count columns use nullable
+    integers. A :class:`ValueError` is raised if columns are missing.
+
+    :param csv_file: path to the event table CSV
+    :param cache: if True, read from / write to a Parquet sidecar file that
+        is reused while the CSV's contents (SHA-1) are unchanged
+    :param cache_dir: directory for sidecar files, defaults to the CSV's directory
+    """
+    csv_file = Path(csv_file)
+    cache_dir = csv_file.parent if cache_dir is None else Path(cache_dir)
+    sidecar = cache_dir / f'{csv_file.stem}.parquet'
+    meta_file = cache_dir / f'{csv_file.stem}.parquet.json'
+    sha1 = _file_sha1(csv_file) if cache else None
+    if cache and sidecar.exists() and meta_file.exists():
+        with open(meta_file, 'r') as _f:
+            meta = json.load(_f)
+        if meta.get('sha1') == sha1 and meta.get('schema_version') == SCHEMA_VERSION:
+            try:
+                return match_event_table_dtypes(pd.read_parquet(sidecar))
+            except ImportError:
+                cache = False
+            except Exception as e:
+                Logger.warning(f'could not read {sidecar}, re-parsing CSV: {e}')
+    df = _read_event_table_csv(csv_file)
+    if cache:
+        try:
+            os.makedirs(str(cache_dir), exist_ok=True)
+            df.to_parquet(sidecar)
+            with open(meta_file, 'w') as _f:
+                json.dump({'source': csv_file.name, 'sha1': sha1,
+                           'schema_version': SCHEMA_VERSION}, _f)
+        except ImportError:
+            Logger.debug('no parquet engine available, event table not cached')
+    return df
@@ -0,0 +1,317 @@
+"""
+:module: M4.5_Orcas_2025/src/marker_store.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Append-only, time-indexed store of Snuffler markers.
+
+    :class:`~.MarkerStore` keeps markers as lines of Snuffler's marker file
+    format (see :meth:`pyrocko.gui.snuffler.marker.save_markers`). Each
+    session records only what changed, as 'add', 'edit', and 'delete'
+    operations appended to a JSON-lines journal. Once the journal holds
+    **compact_every** operations, it is folded into a state table sorted by
+    marker start time, and the folded operations are moved to the history.
+    Loading a review window reads only the state table rows in that window,
+    plus the short journal. Any earlier state is rebuilt on demand by
+    replaying the history (:meth:`~.MarkerStore.snapshot`).
+
+    Markers get a stable ID when first added. An edit that only changes a
+    marker's kind (its grade) keeps the marker's ID. Other changes to a
+    marker are recorded as a delete and an add.
+
+    Layout::
+
+        {root}/state.json                       -- journal sequence number of the state table
+        {root}/state.parquet                    -- live markers at that sequence number
+        {root}/journal.jsonl                    -- operations since the state table
+        {root}/history/{seq0}-{seq1}.jsonl      -- compacted operations
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from obspy import UTCDateTime
+
+Logger = logging.getLogger(__name__)
+
+MARKER_HEADER = '# Snuffler Markers File Version 0.2'
+_TIME = r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(?:\.\d*)?'
+MARKER_REGEX = re.compile(rf'^(?:(?P<type>event|phase):\s+)?(?P<tmin>{_TIME})(?:\s+(?P<tmax>{_TIME})\s+\S+)?\s+(?P<kind>\d+)\b')
+STATE_COLUMNS = ['id', 'tmin', 'tmax', 'line']
+
+
+def parse_marker_line(line):
+    """
+    Get the start and end times (POSIX seconds) and the identity of a
+    Snuffler marker line. The identity is the line without its kind, so
+    re-graded markers keep their identity.
+
+    :returns: (tmin, tmax, identity), or `None` for comments and blank lines
+    """
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+        return None
+    match = MARKER_REGEX.match(line)
+    if match is None:
+        raise ValueError(f'not a Snuffler marker: {line}')
+    tmin = UTCDateTime(match['tmin']).timestamp
+    tmax = tmin if match['tmax'] is None else UTCDateTime(match['tmax']).timestamp
+    identity = line[:match.start('kind')] + line[match.end('kind'):]
+    return tmin, tmax, ' '.join(identity.split())
+
+
+def read_marker_lines(path):
+    """Read the marker lines of a Snuffler marker file"""
+    with open(path, 'r') as _f:
+        return [_l.rstrip('\n') for _l in _f if parse_marker_line(_l) is not None]
+
+
+def write_marker_lines(path, lines):
+    """Write marker lines as a Snuffler marker file"""
+    tmp = str(path) + '.tmp'
+    with open(tmp, 'w') as _f:
+        _f.write(MARKER_HEADER + '\n')
+        for line in lines:
+            _f.write(line + '\n')
+    os.replace(tmp, str(path))
+    return path
+
+
+def _new_id(line, seq):
+    return hashlib.sha1(f'{seq}|{line}'.encode()).hexdigest()[:16]
+
+
+class MarkerStore(object):
+    """
+    Journaled, time-indexed store of Snuffler markers.
+
+    :param root: store directory
+    :param compact_every: journal length (operations) that triggers compaction
+    :param row_group_size: rows per Parquet row group of the state table.
+        Window reads skip row groups outside the window.
+    """
+    def __init__(self, root, compact_every=1000, row_group_size=10000):
+        self.root = Path(root)
+        self.compact_every = int(compact_every)
+        self.row_group_size = int(row_group_size)
+        self.state_file = self.root / 'state.parquet'
+        self.state_meta = self.root / 'state.json'
+        self.journal_file = self.root / 'journal.jsonl'
+        self.history_dir = self.root / 'history'
+        os.makedirs(str(self.history_dir), exist_ok=True)
+        if self.state_meta.exists():
+            with open(self.state_meta, 'r') as _f:
+                self.meta = json.load(_f)
+        else:
+            self.meta = {'seq': 0, 'max_duration': 0.}
+        self.journal = self._read_ops(self.journal_file)
+        self.seq = self.journal[-1]['seq'] if len(self.journal) > 0 else self.meta['seq']
+
+    def __repr__(self):
+        return f'MarkerStore(root={self.root}, seq={self.seq}, journal={len(self.journal)})'
+
+    @staticmethod
+    def _read_ops(path):
+        if not Path(path).exists():
+            return []
+        ops = []
+        with open(path, 'r') as _f:
+            for _l in _f:
+                try:
+                    ops.append(json.loads(_l))
+                except json.JSONDecodeError:
+                    # A torn last line from an interrupted write
+                    Logger.warning(f'skipping unreadable journal line in {path}: {_l!r}')
+        return ops
+
+    def _read_state(self, starttime=None, endtime=None):
+        """Rows of the state table overlapping [starttime, endtime]"""
+        if not self.state_file.exists():
+            return pd.DataFrame(columns=STATE_COLUMNS)
+        filters = []
+        if starttime is not None:
+            # Markers start at most max_duration before they end
+            filters.append(('tmin', '>=', UTCDateTime(starttime).timestamp - self.meta['max_duration']))
+        if endtime is not None:
+            filters.append(('tmin', '<=', UTCDateTime(endtime).timestamp))
+        df = pd.read_parquet(self.state_file, filters=filters or None)
+        if starttime is not None:
+            df = df[df.tmax >= UTCDateTime(starttime).timestamp]
+        return df
+
+    @staticmethod
+    def _apply(markers, ops, in_window):
+        """Apply operations to a dict of {id: (tmin, tmax, line)}"""
+        for op in ops:
+            if op['op'] == 'delete' or not in_window(op['tmin'], op['tmax']):
+                markers.pop(op['id'], None)
+            else:
+                markers[op['id']] = (op['tmin'], op['tmax'], op['line'])
+        return markers
+
+    @staticmethod
+    def _window(starttime, endtime):
+        t0 = -np.inf if starttime is None else UTCDateTime(starttime).timestamp
+        t1 = np.inf if endtime is None else UTCDateTime(endtime).timestamp
+        return lambda tmin, tmax: tmin <= t1 and tmax >= t0
+
+    def load(self, starttime=None, endtime=None):
+        """
+        Get the live markers overlapping a review window.
+
+        :returns: dict of {marker ID: marker line}, sorted by start time
+        """
+        in_window = self._window(starttime, endtime)
+        df = self._read_state(starttime, endtime)
+        markers = {_id: (_t0, _t1, _l) for _id, _t0, _t1, _l
+                   in zip(df.id.values, df.tmin.values, df.tmax.values, df.line.values)}
+        markers = self._apply(markers, self.journal, in_window)
+        return {_id: _v[2] for _id, _v in sorted(markers.items(), key=lambda _i: _i[1][0])}
+
+    def diff(self, before, after):
+        """
+        Operations that turn the markers **before** (dict of {ID: line}, as
+        returned by :meth:`~.MarkerStore.load`) into the marker lines **after**.
+        """
+        after = [_l.strip() for _l in after if parse_marker_line(_l) is not None]
+        remaining = {}
+        for _id, _l in before.items():
+            remaining.setdefault(_l.strip(), []).append(_id)
+        added = []
+        for line in after:
+            if len(remaining.get(line, [])) > 0:
+                remaining[line].pop()
+            else:
+                added.append(line)
+        removed = {_id: _l for _l, _ids in remaining.items() for _id in _ids}
+        # Re-graded markers are edits of the same marker
+        by_identity = {}
+        for _id, _l in removed.items():
+            by_identity.setdefault(parse_marker_line(_l)[2], []).append(_id)
+        ops = []
+        for line in added:
+            tmin, tmax, identity = parse_marker_line(line)
+            ids = by_identity.get(identity, [])
+            if len(ids) > 0:
+                _id = ids.pop()
+                removed.pop(_id)
+                ops.append({'op': 'edit', 'id': _id, 'tmin': tmin, 'tmax': tmax, 'line': line})
+            else:
+                ops.append({'op': 'add', 'id': None, 'tmin': tmin, 'tmax': tmax, 'line': line})
+        for _id, line in removed.items():
+            tmin, tmax, _ = parse_marker_line(line)
+            ops.append({'op': 'delete', 'id': _id, 'tmin': tmin, 'tmax': tmax, 'line': line})
+        return ops
+
+    def commit(self, before, after, session=None, time=None):
+        """
+        Append the changes between a session's loaded and final markers to the
+        journal, compacting it if it is long enough.
+
+        :param before: markers loaded for the session, see :meth:`~.MarkerStore.load`
+        :param after: marker lines at the end of the session
+        :param session: optional session label stored with each operation
+        :param time: time stored with each operation, defaults to now
+        :returns: list of appended operations
+        """
+        ops = self.diff(before, after)
+        if len(ops) == 0:
+            return ops
+        now = str(UTCDateTime() if time is None else UTCDateTime(time))
+        with open(self.journal_file, 'a') as _f:
+            for op in ops:
+                self.seq += 1
+                op.update({'seq': self.seq, 'time': now, 'session': session})
+                if op['id'] is None:
+                    op['id'] = _new_id(op['line'], self.seq)
+                _f.write(json.dumps(op) + '\n')
+            _f.flush()
+            os.fsync(_f.fileno())
+        self.journal += ops
+        counts = pd.Series([_o['op'] for _o in ops]).value_counts().to_dict()
+        Logger.info(f'recorded {counts} marker operations')
+        if len(self.journal) >= self.compact_every:
+            self.compact()
+        return ops
+
+    def replace(self, lines, session=None, time=None):
+        """
+        Make the store's live markers equal to **lines** (e.g., a whole marker
+        file), recording the differences as operations.
+        """
+        return self.commit(self.load(), lines, session=session, time=time)
+
+    def import_files(self, paths, session='import'):
+        """
+        Replay whole marker files (e.g., successive `markers_{time}.dat`
+        saves) into the store in the given order, each as one
+        :meth:`~.MarkerStore.replace`. Operations are timed by the time in
+        the file name, or else the file's modification time.
+        """
+        for path in paths:
+            try:
+                time = UTCDateTime(Path(path).stem.split('_')[-1])
+            except Exception:
+                time = UTCDateTime(os.path.getmtime(path))
+            ops = self.replace(read_marker_lines(path), session=session, time=time)
+            Logger.info(f'imported {path}: {len(ops)} operations')
+
+    def compact(self):
+        """Fold the journal into the state table and move it to the history"""
+        if len(self.journal) == 0:
+            return
+        df = self._read_state()
+        markers = {_id: (_t0, _t1, _l) for _id, _t0, _t1, _l
+                   in zip(df.id.values, df.tmin.values, df.tmax.values, df.line.values)}
+        markers = self._apply(markers, self.journal, lambda tmin, tmax: True)
+        df = pd.DataFrame([(_id,) + _v for _id, _v in markers.items()], columns=STATE_COLUMNS)
+        df = df.sort_values('tmin', kind='stable', ignore_index=True)
+        tmp = self.state_file.with_suffix('.tmp')
+        df.to_parquet(tmp, index=False, row_group_size=self.row_group_size)
+        seq0, seq1 = self.journal[0]['seq'], self.journal[-1]['seq']
+        # Replaying the journal onto the new state is harmless, so an
+        # interrupted compaction leaves a consistent store
+        os.replace(str(tmp), str(self.state_file))
+        self.meta = {'seq': seq1, 'max_duration': float((df.tmax - df.tmin).max()) if len(df) > 0 else 0.}
+        with open(str(self.state_meta) + '.tmp', 'w') as _f:
+            json.dump(self.meta, _f)
+        os.replace(str(self.state_meta) + '.tmp', str(self.state_meta))
+        os.replace(str(self.journal_file), str(self.history_dir / f'{seq0:010d}-{seq1:010d}.jsonl'))
+        self.journal = []
+        Logger.info(f'compacted operations {seq0}-{seq1}: {len(df)} live markers')
+
+    def operations(self):
+        """All recorded operations, oldest first"""
+        ops = []
+        for path in sorted(glob.glob(str(self.history_dir / '*.jsonl'))):
+            ops += self._read_ops(path)
+        return ops + self.journal
+
+    def snapshot(self, at=None, starttime=None, endtime=None):
+        """
+        Rebuild the live markers as they were after operation sequence number
+        **at** (int) or at time **at** (UTCDateTime). `None` is the current state.
+
+        :returns: dict of {marker ID: marker line}, sorted by start time
+        """
+        if at is None:
+            return self.load(starttime, endtime)
+        if isinstance(at, (int, np.integer)):
+            ops = [_o for _o in self.operations() if _o['seq'] <= at]
+        else:
+            ops = [_o for _o in self.operations() if UTCDateTime(_o['time']) <= UTCDateTime(at)]
+        markers = self._apply({}, ops, self._window(starttime, endtime))
+        return {_id: _v[2] for _id, _v in sorted(markers.items(), key=lambda _i: _i[1][0])}
+
+    def write_snapshot(self, path, at=None, starttime=None, endtime=None):
+        """Write :meth:`~.MarkerStore.snapshot` as a Snuffler marker file"""
+        return write_marker_lines(path, self.snapshot(at, starttime, endtime).values())
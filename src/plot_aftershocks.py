@@ -10,26 +10,35 @@
     The nodal plane orientation for the M4.5 earthquake was manually entered.
 
     The map uses OpenStreetMap imagery for its basemap, which requires the
-    included attribution to meet their terms of use. 
+    included attribution to meet their terms of use. Tiles are kept in a
+    local tile directory (see :class:`~aftershock_figures.TileDirectory`),
+    so the figure can be re-rendered offline once tiles have been fetched.
+
+    With `isframes`, hourly snapshot figures of the sequence are also
+    rendered headlessly across a process pool (see
+    :meth:`~aftershock_figures.render_frames`). Large matched-filter detection
+    catalogs (`isdetections`) are drawn as rasterized collections or
+    densities above VECTOR_MAX and DENSITY_MIN events, and `isstats` adds
+    cumulative count and aftershock rate panels.
 
 """
 
 import os
+import sys
 from pathlib import Path
 
 import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-from matplotlib.offsetbox import AnchoredText
-
-# from obspy.clients.fdsn import Client
-from obspy.geodetics import locations2degrees
-from obspy.imaging.beachball import beach
 import pandas as pd
 
-
 import cartopy.crs as ccrs
 from cartopy.io.img_tiles import OSM
-import cartopy.feature as cfeature
+
+from aftershock_figures import AftershockFigure, TileDirectory, frame_times, render_frames
+from event_offsets import get_distances, MAINSHOCK_EVID
+from catalog_store import CatalogStore
+
+sys.path.append(str(Path(__file__).parent / 'template_match'))
+from detection_catalog import read_detection_catalog
 
 # Define absolute path to repository root
 ROOT = Path(__file__).parent.parent
@@ -39,6 +48,15 @@ FIGPATH = ROOT / 'figures'
 LOGO_PNG = ROOT / 'data' / 'resources' / 'PNSN_Small_RGB.png'
 # Path to AQMS Event Table CSV output from Jiggle
 AQMS_CSV = ROOT / 'data' / 'jiggle' / 'Event_Table_Output_6MAR2025_1800UTC.csv'
+# Incremental catalog store updated from successive Jiggle exports
+CATALOG = ROOT / 'processed_data' / 'catalog'
+# Matched-filter detection catalog (see template_match/detection_catalog.py)
+DETECTIONS = ROOT / 'processed_data' / 'detection_catalog'
+# Local OSM tile directory ({z}/{x}/{y}.png) and cached basemap rasters
+TILES = ROOT / 'data' / 'tiles' / 'osm'
+BASEMAPS = ROOT / 'processed_data' / 'basemaps'
+# Only use tiles already in TILES (no downloads)
+OFFLINE = False
 
 # Set figure saving/resolution controls
 issave = False
@@ -48,6 +66,18 @@ FMT = 'png'
 
 # Set if figure should be plt.show()'d
 isshow = True
+# Set if matched-filter detections with magnitudes should be plotted
+isdetections = False
+# Set if cumulative count and aftershock rate panels should be added
+isstats = False
+# Event counts above which events are drawn as rasterized collections, then as densities
+VECTOR_MAX = 2000
+DENSITY_MIN = 50000
+# Set if snapshot frames should be rendered, every FRAME_STEP, with FRAME_WORKERS processes
+isframes = False
+FRAME_STEP = '1h'
+FRAME_WORKERS = None
+FRAME_PATH = FIGPATH / 'frames'
 
 UTM10N = ccrs.UTM(zone=10, southern_hemisphere=False)
 WGS84 = ccrs.PlateCarree()
@@ -55,28 +85,6 @@ ZOOM = 11
 RAD_KM = 12.5
 MIN_MAG = 1.8
 
-MAIN_COLOR = 'blue'
-AUTO_COLOR = 'goldenrod'
-MANU_COLOR = 'red'
-
-PNSN_Green100 = (9/255,67/255,9/255)
-PNSN_Green50 = (9/255,67/255,9/255, 0.5)
-PNSN_Green25 = (9/255,67/255,9/255, 0.25)
-
-def get_distances(df):
-    df = df.sort_values('MAG', ascending=False)
-    ser_main = df.loc[62078906]
-    holder = []
-    for evid, row in df.iterrows():
-        # Get epicentral offsets
-        dh_deg = locations2degrees(ser_main.LAT, ser_main.LON, row.LAT, row.LON)
-        dh_km = 111.2*dh_deg
-        dz_km = row.MZ - ser_main.MZ
-        dx_km = (dz_km**2 + dh_km**2)**0.5
-        dt_sec = (row.DATETIME - ser_main.DATETIME).total_seconds()
-        holder.append([dx_km, dh_km, dt_sec])
-    df_out = pd.DataFrame(data=holder, index=df.index, columns=['hyp_off_km','epi_off_km','orig_off_sec'])
-    return df_out
 
 def rad2llur(rlat, rlon, rad_m=50000.):
     
@@ -92,136 +100,63 @@ def rad2llur(rlat, rlon, rad_m=50000.):
     return [lowerleft[0], upperright[0], lowerleft[1], upperright[1]]
 
 
-# Load event data
-df = pd.read_csv(AQMS_CSV, index_col=[0], parse_dates=['DATETIME'])
-# Add distances
-df = pd.concat([df, get_distances(df)], axis=1, ignore_index=False)
-# Get series of mainshock statistics
-
-# Set last manual detection update time
-last_update = pd.Timestamp('2025-03-04T17:00:00')
-
-ser_main = df.loc[62078906]
-df_after = df[df.index.values != 62078906]
-df_manual = df_after[df_after.DATETIME <= last_update]
-df_auto = df_after[df_after.DATETIME >= last_update]
-
-
-# Create connection to OSM tiles
-imagery = OSM(cache=True)
-
-# Specify moment tensor for beachball
-np1 = [15., 55., 90.]
-# xy = UTM10N.transform_point(x=ser_main.LON, y=ser_main.LAT, src_crs=WGS84)
-x, y = imagery.crs.transform_point(x=ser_main.LON, y=ser_main.LAT, src_crs=ccrs.Geodetic())
-bb_main = beach(np1, xy=(x,y), width=6000, zorder=1, facecolor=MAIN_COLOR)
-
-# Initialize Figure
-fig = plt.figure(figsize=(5.6,7.7))
-gs = fig.add_gridspec(ncols=1, nrows=3, hspace=0)
-# Create axis for map
-axmap = fig.add_subplot(gs[:2], projection=imagery.crs)
-axmap.set_extent(rad2llur(df.LAT.median(), df.LON.median(), rad_m=RAD_KM*1e3), ccrs.PlateCarree())
-# Add basemap imagery
-axmap.add_image(imagery, ZOOM)
-text = AnchoredText('©OpenStreetMap contributors',
-                    loc=4, prop={'size': 6}, frameon=True)
-# Add attribution
-axmap.add_artist(text)
-
-# Plotmainshock Beachball
-axmap.add_collection(bb_main)
-
-# Plot Manually Detected events
-axmap.scatter(df_manual.LON, df_manual.LAT, s=3**(2 + df_manual.MAG),
-              c='none', edgecolors=MANU_COLOR,
-              alpha=0.75, transform=ccrs.PlateCarree(),
-              linewidths=2)
-
-# Plot Automatically detected events
-axmap.scatter(df_auto.LON, df_auto.LAT, s=3**(2 + df_auto.MAG),
-              c='none', edgecolors=AUTO_COLOR,
-              alpha=0.95, transform=ccrs.PlateCarree(),
-              linewidths=2)
-
-# Add legend
-# x, y = imagery.crs.transform_point(x=48.67, y=-122.75, src_crs=ccrs.Geodetic())
-# axmap.add_patch(mpatches.Rectangle(xy=[x,y], width=0.1, height=0.03,transform=ccrs.PlateCarree()))
-
-# Plot Stations
-# axmap.plot(df_inv.lon, df_inv.lat, )
-
-# Add coordinates
-gl = axmap.gridlines(draw_labels=True, zorder=1)
-gl.bottom_labels=False
-gl.left_labels=False
-gl.xlines=False
-gl.ylines=False
-
-
-# MAGNITUDE TIME-SERIES
-axts = fig.add_subplot(gs[-1])
-# Do Mainshock stem
-for _d, _c in [(ser_main, MAIN_COLOR), (df_manual, MANU_COLOR), (df_auto, AUTO_COLOR)]:
-    ml, sl, bl = axts.stem(_d.orig_off_sec/3600, _d.MAG, bottom=df.MAG.min() - 0.1)
-    
-    # Format marker lines
-    ml.set_markerfacecolor('white')
-    ml.set_markeredgecolor(_c)
-    ml.set_linewidth(2)
-    sl.set_color(_c)
-    sl.set_linewidth(2)
-    bl.set_color('none')
-
-# # Make stem for mainshock
-
-
-# ml, sl, bl = axts.stem(df_manual.orig_off_sec/3600, df_manual.MAG, bottom = df_manual.MAG.min() - 0.1)
-# # Format marker lines
-# ml.set_markerfacecolor('white')
-# ml.set_markeredgecolor('red')
-# ml.set_linewidth(2)
-# sl.set_color('red')
-# sl.set_linewidth(2)
-# bl.set_color('none')
-# Add gridlines
-axts.grid(linestyle=':')
-# Scale Figure
-axts.set_ylim([df_manual.MAG.min() - 0.1, 5])
-# Label axes
-axts.set_xlabel(f'Hours Since {df.DATETIME.min().strftime("%Y-%m-%d %H:%M:%S")} (UTC)')
-axts.set_ylabel('Magnitude')
-
-# Add completeness magnitude threshold
-xlims = axts.get_xlim()
-axts.plot(xlims, [MIN_MAG]*2, color=PNSN_Green50)
-midpoint_dt_hrs = 0.5*sum(xlims)
-axts.text(midpoint_dt_hrs, MIN_MAG + 0.1, 'Smallest reliably detected earthquakes', ha='center', va='bottom',
-          color=(9/255, 67/255, 9/255, 0.75))
-axts.set_xlim(xlims)
-
-# Add last timestamp for manual assessment
-last_dt_hrs = (last_update - ser_main.DATETIME).total_seconds()/3600
-ylims = axts.get_ylim()
-axts.plot([last_dt_hrs]*2, ylims, ':', color='firebrick')
-axts.set_ylim(ylims)
-axts.text(last_dt_hrs - 2.5, 3.5,'Last Manual\nSearch', color='firebrick',
-          rotation=90, ha='center',va='center')
-
-# ADD PNSN LOGO
-logoax = fig.add_axes([0.01, 0.9, 0.3, 0.3], anchor='SE', zorder=-1)
-im = plt.imread(str(LOGO_PNG))
-logoax.imshow(im)
-logoax.axis('off')
-
-# SAVE FIGURE (IF SWITCH IS TURNED ON)
-if issave:
-    try:
-        os.makedirs(str(FIGPATH), exist_ok=False)
-    except:
-        pass
-    plt.savefig(str(FIGPATH/f'Aftershock_Timeseries_6MAR2025_{DPI}dpi.{FMT}'), format=FMT, dpi=DPI)
-
-# DISPLAY FIGURE (IF SWITCH IS TURNED ON)
-if isshow:
-    plt.show()
\ No newline at end of file
+if __name__ == '__main__':
+    # Load event data, only re-calculating distances for new/updated events
+    store = CatalogStore(CATALOG)
+    store.register('offsets', lambda _df, _full: get_distances(_df, ref=_full.loc[MAINSHOCK_EVID]),
+                   refresh_on=[MAINSHOCK_EVID])
+    store.load_csv(AQMS_CSV)
+    # Get events with distances
+    df = store.get('offsets')
+
+    # Set last manual detection update time
+    last_update = pd.Timestamp('2025-03-04T17:00:00')
+
+    ser_main = df.loc[MAINSHOCK_EVID]
+    df_after = df[df.index.values != MAINSHOCK_EVID]
+    # Load matched-filter detections with relative magnitudes, if any
+    if isdetections and DETECTIONS.exists():
+        df_det = read_detection_catalog(DETECTIONS, columns=['LAT', 'LON', 'MZ', 'MAG'])
+        df_det = df_det[df_det.MAG.notna()]
+        df_det = df_det.join(get_distances(df_det, ref=ser_main))
+    else:
+        df_det = df.iloc[:0]
+    layers = {'detections': df_det,
+              'mainshock': df.loc[[MAINSHOCK_EVID]],
+              'manual': df_after[df_after.DATETIME <= last_update],
+              'auto': df_after[df_after.DATETIME >= last_update]}
+
+    # Local tile directory, filled from OSM (with attribution) as needed
+    imagery = TileDirectory(TILES, source=None if OFFLINE else OSM(cache=True))
+
+    # Time axis spans the whole sequence so that all frames share axes
+    hours = df.orig_off_sec.max()/3600
+    figure_kwargs = {'imagery': imagery, 'zoom': ZOOM, 'mainshock': ser_main,
+                     'extent': rad2llur(df.LAT.median(), df.LON.median(), rad_m=RAD_KM*1e3),
+                     'np1': (15., 55., 90.), 'xlim': (-0.05*hours, 1.05*hours),
+                     'ylim': (layers['manual'].MAG.min() - 0.1, 5), 'min_mag': MIN_MAG,
+                     'last_update': last_update, 'logo_png': LOGO_PNG, 'basemap_cache': BASEMAPS,
+                     'stats': isstats, 'vector_max': VECTOR_MAX, 'density_min': DENSITY_MIN}
+
+    # Initialize Figure
+    fig = plt.figure(figsize=(5.6,10.5) if isstats else (5.6,7.7))
+    figure = AftershockFigure(fig=fig, **figure_kwargs)
+    figure.draw_events(layers)
+
+    # SAVE FIGURE (IF SWITCH IS TURNED ON)
+    if issave:
+        try:
+            os.makedirs(str(FIGPATH), exist_ok=False)
+        except:
+            pass
+        figure.save(FIGPATH/f'Aftershock_Timeseries_6MAR2025_{DPI}dpi.{FMT}', fmt=FMT, dpi=DPI)
+
+    # RENDER HOURLY SNAPSHOTS (IF SWITCH IS TURNED ON)
+    if isframes:
+        times = frame_times(ser_main.DATETIME.ceil(FRAME_STEP), df.DATETIME.max().ceil(FRAME_STEP), FRAME_STEP)
+        render_frames(layers, times, FRAME_PATH, figure_kwargs, prefix='Aftershock_Timeseries',
+                      dpi=DPI, fmt=FMT, max_workers=FRAME_WORKERS)
+
+    # DISPLAY FIGURE (IF SWITCH IS TURNED ON)
+    if isshow:
+        plt.show()
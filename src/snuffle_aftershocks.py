@@ -4,60 +4,69 @@
 :email: ntsteven@uw.edu
 :org: Pacific Northwest Seismic Network
 :license: GNU GPLv3
-:purpose: This script queries a specified period of waveform data from
-    stations near the M4.5 earthquake at Orcas Island on March 3rd 2025
-    and launches a Pyrocko Snuffler instance to display those waveforms
-    for analyst picking. Picks are automatically saved to the `data/snuffler`
-    directory and in subsequent sessions called by this script, the
-    `data/snuffler/_markers_working.dat` file is re-loaded into snuffler
-    to load prior picking progress.
-"""
+:purpose: This script launches Pyrocko Snuffler sessions on the aftershock
+    sequences defined in `snuffle_sequences.json` (stations, channels, review
+    window, and marker store of each sequence, see
+    :meth:`~snuffler_session.load_sequences`) for analyst picking.
+
+    Waveform data for every sequence are fetched into the local archive in
+    background threads as soon as the script starts, so switching to another
+    sequence after closing a session starts from a warm archive. Picks are
+    saved to each sequence's marker store (see :class:`~marker_store.MarkerStore`):
+    each session loads the markers in its review window and records only the
+    markers it added, edited, or deleted.
 
+    Usage: python snuffle_aftershocks.py [sequence name] [config file]
+"""
 
+import logging
 import os
+import sys
 from pathlib import Path
-from obspy import *
 from obspy.clients.fdsn import Client
 
-from obsplus import WaveBank
+from waveform_archive import WaveformArchive
+from snuffler_session import load_sequences, Prefetcher, run_sequence
 
 from pyrocko import obspy_compat
-from pyrocko.gui.snuffler.marker import save_markers, load_markers
 
 obspy_compat.plant()
 
 ROOT = Path(__file__).parent.parent
 SAVEPATH = ROOT/'data'/'snuffler'
-ALL_MARKERS = ROOT/'data'/'snuffler'/'_markers_working.dat'
+WAVEPATH = ROOT/'data'/'waveforms'
+# Sequence definitions
+CONFIG = Path(sys.argv[2]) if len(sys.argv) > 2 else Path(__file__).parent/'snuffle_sequences.json'
+# Also write each session's markers to a timestamped marker file
+SNAPSHOT = False
+# Number of sequences prefetched at once (None prefetches all at once)
+PREFETCH_WORKERS = None
 try:
     os.makedirs(str(SAVEPATH), exist_ok=False)
 except:
     pass
 
-IRIS = Client('IRIS')
-
-# t0 = UTCDateTime('2025-03-03T13:02:37') + 3600*5.5
-t0 = UTCDateTime('2025-03-04T15:00:00')
-tnow = UTCDateTime()
-STAS = 'OLGA,MCW,ORCA,GUEM,LUMI,TURTL,LOPEZ,OAKH,SAXON,DONK'
-CHAS='HH?,BH?,EH?,HN?'
-NETS = 'UW'
-inv = IRIS.get_stations(network=NETS, station=STAS)
-# cat = IRIS.get_events(starttime = t0 - 10, endtime=t0 + 10, latitude=48.607, longitude=-122.804, maxradius=0.1/111.2)
-st = IRIS.get_waveforms(network=NETS, station=STAS, location='*', channel=CHAS, starttime=t0, endtime=tnow)
+logging.basicConfig(level=logging.INFO)
 
-# TODO - Load running marker file
-tmp_mrkr = load_markers(str(ALL_MARKERS))
-return_tag, markers = st.snuffle(ntracks=len(st), markers=tmp_mrkr)
-
-
-# breakpoint()
-# Only save new incremental file if there are new markers
-if len(markers) > 0:
-    savename = SAVEPATH/f'markers_{tnow}.dat'
-    save_markers(markers, str(savename))
-
-# Always save running marker file
-save_markers(markers, str(ALL_MARKERS))
+IRIS = Client('IRIS')
+# Local miniSEED archive in front of IRIS, so only missing data are downloaded
+ARCHIVE = WaveformArchive(WAVEPATH, client=IRIS, chunk_length=3600., max_workers=4)
 
+SEQUENCES = load_sequences(CONFIG)
+PREFETCH = Prefetcher(ARCHIVE, SEQUENCES, max_workers=PREFETCH_WORKERS).start()
 
+name = sys.argv[1] if len(sys.argv) > 1 else None
+try:
+    while True:
+        if name is None:
+            name = input(f'Sequence to review {list(SEQUENCES)} (blank to quit): ').strip()
+            if name == '':
+                break
+        if name not in SEQUENCES:
+            print(f'Unknown sequence "{name}"')
+        else:
+            run_sequence(ARCHIVE, SEQUENCES[name], prefetcher=PREFETCH,
+                         snapshot_dir=SAVEPATH if SNAPSHOT else None)
+        name = None
+finally:
+    PREFETCH.shutdown(wait=False)
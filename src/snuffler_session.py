@@ -0,0 +1,321 @@
+"""
+:module: M4.5_Orcas_2025/src/snuffler_session.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Launches Snuffler on a lazily loaded, file-backed pyrocko pile over the
+    miniSEED files of a :class:`~waveform_archive.WaveformArchive` rather than on
+    an in-memory ObsPy Stream. Only file metadata are scanned at startup, and
+    waveforms are decoded as they come into the visible time window.
+
+    In "follow" mode, a background thread keeps the archive filled up to the
+    present and a Qt timer in the Snuffler window loads new or modified archive
+    files into the running session's pile, so new data appear without
+    restarting the session.
+
+    :meth:`~.markers_from_lines` and :meth:`~.markers_to_lines` convert
+    between pyrocko markers and the marker lines kept by a
+    :class:`~marker_store.MarkerStore`.
+
+    Review sequences (stations, channels, review window, and marker store) are
+    defined in a JSON config file read by :meth:`~.load_sequences`.
+    :class:`~.Prefetcher` fills the archive for every sequence concurrently in
+    the background, and :meth:`~.run_sequence` runs one picking session on a
+    sequence, waiting only for that sequence's prefetch.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from obspy import UTCDateTime
+
+from pyrocko import pile as pile_mod
+from pyrocko.gui.snuffler.snuffler import snuffle
+from pyrocko.gui.snuffler.marker import load_markers, save_markers
+from pyrocko.obspy_compat import to_pyrocko_stations
+
+from marker_store import MarkerStore, read_marker_lines, write_marker_lines
+
+Logger = logging.getLogger(__name__)
+
+# Values used for keys missing from a sequence definition
+SEQUENCE_DEFAULTS = {
+    'network': 'UW',
+    'station': None,
+    'location': '*',
+    'channel': 'HH?,BH?,EH?,HN?',
+    'starttime': None,
+    'endtime': None,
+    'marker_store': None,
+    'legacy_markers': [],
+    'follow': None,
+}
+
+
+def archive_pile(archive, network, station, location, channel,
+                 starttime=None, endtime=None, cachedirname=None):
+    """
+    Create a :class:`~pyrocko.pile.Pile` over archive files matching a request.
+    Trace data are not loaded until they are requested by the viewer.
+    """
+    paths = archive.get_paths(network, station, location, channel, starttime, endtime)
+    return pile_mod.make_pile([str(_p) for _p in paths], fileformat='mseed',
+                              cachedirname=cachedirname, show_progress=False)
+
+
+class ArchiveFollower(threading.Thread):
+    """
+    Background thread that periodically fills **archive** from **starttime**
+    up to the present for a (network, station, location, channel) **query**.
+    """
+    def __init__(self, archive, query, starttime, interval=60.):
+        super().__init__(daemon=True)
+        self.archive = archive
+        self.query = query
+        self.starttime = UTCDateTime(starttime)
+        self.interval = float(interval)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.archive.update(*self.query, self.starttime, UTCDateTime())
+            except Exception as e:
+                Logger.warning(f'archive update failed: {e}')
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def _refresh_pile(pile, archive, query, starttime):
+    """Load new archive files into **pile** and reload files that were appended to"""
+    paths = archive.get_paths(*query, starttime, UTCDateTime())
+    new = [str(_p) for _p in paths if os.path.abspath(str(_p)) not in pile.abspaths]
+    if len(new) > 0:
+        Logger.info(f'adding {len(new)} new files to session')
+        pile.load_files(new, fileformat='mseed', show_progress=False)
+    pile.reload_modified()
+
+
+def _make_follow_hook(pile, archive, query, starttime, interval):
+    """Create a Snuffler launch hook that periodically refreshes **pile**"""
+    from pyrocko.gui.qt_compat import qc
+
+    def hook(win):
+        timer = qc.QTimer(win)
+        timer.timeout.connect(lambda: _refresh_pile(pile, archive, query, starttime))
+        timer.start(int(interval*1000))
+        # Keep a reference to the timer for the lifetime of the window
+        win._archive_timer = timer
+    return hook
+
+
+def markers_from_lines(lines):
+    """Parse Snuffler marker lines into pyrocko markers"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'markers.dat')
+        write_marker_lines(path, lines)
+        return load_markers(path)
+
+
+def markers_to_lines(markers):
+    """Format pyrocko markers as Snuffler marker lines, exactly as saved to file"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'markers.dat')
+        save_markers(markers, path)
+        return read_marker_lines(path)
+
+
+def snuffle_archive(archive, network, station, location, channel, starttime,
+                     endtime=None, markers=None, inventory=None, follow=None,
+                     poll_interval=60., ntracks=None, **kwargs):
+    """
+    Launch Snuffler on archived data for a request, fetching any gaps first.
+
+    :param archive: :class:`~waveform_archive.WaveformArchive` to read from
+    :param network: network code(s), comma delimited
+    :param station: station code(s), comma delimited
+    :param location: location code(s), comma delimited
+    :param channel: channel code(s), comma delimited
+    :param starttime: start of the review window
+    :param endtime: end of the review window, defaults to now
+    :param markers: list of pyrocko markers to pre-load
+    :param inventory: optional :class:`~obspy.core.inventory.Inventory` with
+        station metadata to pass to Snuffler
+    :param follow: if not `None`, run Snuffler in real-time follow mode showing
+        the last **follow** seconds, and keep appending new data to the session
+    :param poll_interval: seconds between archive updates in follow mode
+    :param ntracks: number of tracks to show, defaults to the number of channels
+    :param kwargs: additional key-word arguments passed to
+        :meth:`~pyrocko.gui.snuffler.snuffler.snuffle`
+
+    :returns: (return_tag, markers) as returned by
+        :meth:`~pyrocko.obspy_compat.base.snuffle`
+    """
+    query = (network, station, location, channel)
+    if endtime is None:
+        endtime = UTCDateTime()
+    # Fill the archive for the review window
+    archive.update(*query, starttime, endtime)
+    pile = archive_pile(archive, *query, starttime=starttime,
+                        endtime=endtime if follow is None else None)
+    if ntracks is None:
+        ntracks = max(len(pile.nslc_ids), 1)
+    if inventory is not None:
+        kwargs.update({'stations': to_pyrocko_stations(inventory)})
+
+    follower = None
+    if follow is not None:
+        follower = ArchiveFollower(archive, query, endtime, interval=poll_interval)
+        follower.start()
+        kwargs.update({'follow': follow,
+                       'launch_hook': _make_follow_hook(pile, archive, query, starttime, poll_interval)})
+    try:
+        return_tag, markers = snuffle(pile, ntracks=ntracks, markers=markers,
+                                      want_markers=True, **kwargs)
+    finally:
+        if follower is not None:
+            follower.stop()
+    return return_tag, markers
+
+
+def load_sequences(path):
+    """
+    Read review sequence definitions from a JSON config file of the form::
+
+        {"defaults": {"network": "UW", "channel": "HH?,EH?", ...},
+         "sequences": {"orcas": {"station": "OLGA,TURTL", "starttime": "2025-03-04T15:00:00",
+                                 "marker_store": "../data/snuffler/marker_store"}, ...}}
+
+    Keys are those of :data:`~.SEQUENCE_DEFAULTS`. 'starttime' is required,
+    'endtime' defaults to the time of the session, and relative paths
+    ('marker_store', 'legacy_markers') are relative to the config file.
+    'legacy_markers' entries may be glob patterns, expanded in sorted order.
+
+    :returns: dict of {name: sequence definition}, in file order
+    """
+    path = Path(path)
+    with open(path, 'r') as _f:
+        config = json.load(_f)
+    defaults = dict(SEQUENCE_DEFAULTS, **config.get('defaults', {}))
+    sequences = {}
+    for name, entry in config['sequences'].items():
+        seq = dict(defaults, **entry)
+        if seq['station'] is None or seq['starttime'] is None:
+            raise ValueError(f'sequence "{name}" in {path} needs a station and a starttime')
+        seq['name'] = name
+        seq['starttime'] = UTCDateTime(seq['starttime'])
+        seq['endtime'] = None if seq['endtime'] is None else UTCDateTime(seq['endtime'])
+        if seq['marker_store'] is None:
+            raise ValueError(f'sequence "{name}" in {path} needs a marker_store')
+        seq['marker_store'] = (path.parent / seq['marker_store']).resolve()
+        legacy = []
+        for _p in seq['legacy_markers']:
+            if any(_c in _p for _c in '*?['):
+                legacy += sorted(_f.resolve() for _f in path.parent.glob(_p))
+            else:
+                legacy.append((path.parent / _p).resolve())
+        seq['legacy_markers'] = legacy
+        sequences[name] = seq
+    return sequences
+
+
+def _query(seq):
+    return (seq['network'], seq['station'], seq['location'], seq['channel'])
+
+
+class Prefetcher(object):
+    """
+    Fill **archive** for several review sequences concurrently in background
+    threads.
+
+    :param archive: :class:`~waveform_archive.WaveformArchive` with a client
+    :param sequences: dict of sequence definitions, see :meth:`~.load_sequences`
+    :param max_workers: number of sequences fetched at once, defaults to all
+    """
+    def __init__(self, archive, sequences, max_workers=None):
+        self.archive = archive
+        self.sequences = sequences
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or max(len(sequences), 1),
+                                           thread_name_prefix='prefetch')
+        self.futures = {}
+
+    def __repr__(self):
+        ndone = sum(_f.done() for _f in self.futures.values())
+        return f'Prefetcher(sequences={len(self.sequences)}, done={ndone})'
+
+    def _fetch(self, name):
+        seq = self.sequences[name]
+        endtime = UTCDateTime() if seq['endtime'] is None else seq['endtime']
+        gaps = self.archive.update(*_query(seq), seq['starttime'], endtime)
+        Logger.info(f'prefetched {name}: {len(gaps)} gaps filled')
+        return gaps
+
+    def start(self):
+        """Start fetching every sequence"""
+        for name in self.sequences:
+            if name not in self.futures:
+                self.futures[name] = self.executor.submit(self._fetch, name)
+        return self
+
+    def wait(self, name):
+        """Wait for sequence **name** to be fetched. Fetch errors are logged, not raised."""
+        future = self.futures.get(name)
+        if future is None:
+            return
+        if not future.done():
+            Logger.info(f'waiting for {name} data')
+        try:
+            future.result()
+        except Exception as e:
+            Logger.warning(f'prefetching {name} failed, fetching at launch: {e}')
+
+    def shutdown(self, wait=False):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def run_sequence(archive, seq, prefetcher=None, snapshot_dir=None, **kwargs):
+    """
+    Run one picking session on a review sequence.
+
+    Markers in the review window are loaded from the sequence's
+    :class:`~marker_store.MarkerStore` (importing its legacy marker files
+    into a new store first), and the session's marker changes are committed
+    to it afterwards.
+
+    :param archive: :class:`~waveform_archive.WaveformArchive` to read from
+    :param seq: sequence definition, see :meth:`~.load_sequences`
+    :param prefetcher: optional :class:`~.Prefetcher` to wait for
+    :param snapshot_dir: if given, also write the session's markers to
+        `{snapshot_dir}/{sequence name}/markers_{time}.dat`
+    :param kwargs: passed to :meth:`~.snuffle_archive`
+
+    :returns: (return_tag, markers) of the session
+    """
+    tnow = UTCDateTime()
+    endtime = tnow if seq['endtime'] is None else seq['endtime']
+    store = MarkerStore(seq['marker_store'])
+    if store.seq == 0:
+        store.import_files([_p for _p in seq['legacy_markers'] if _p.exists()])
+    loaded = store.load(seq['starttime'], endtime)
+    if prefetcher is not None:
+        prefetcher.wait(seq['name'])
+    Logger.info(f'starting {seq["name"]} session with {len(loaded)} markers')
+    return_tag, markers = snuffle_archive(archive, *_query(seq), seq['starttime'], endtime,
+                                          markers=markers_from_lines(loaded.values()),
+                                          follow=seq['follow'], **kwargs)
+    store.commit(loaded, markers_to_lines(markers), session=f'{seq["name"]} {tnow}')
+    if snapshot_dir is not None and len(markers) > 0:
+        # One folder per sequence, so no sequence's legacy_markers glob matches another's
+        snapshot_dir = Path(snapshot_dir) / seq['name']
+        os.makedirs(str(snapshot_dir), exist_ok=True)
+        store.write_snapshot(snapshot_dir / f'markers_{tnow}.dat',
+                             starttime=seq['starttime'], endtime=endtime)
+    return return_tag, markers
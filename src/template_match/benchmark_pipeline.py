@@ -0,0 +1,439 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/benchmark_pipeline.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Benchmark the template matching workflow on synthetic aftershock
+    sequences at several scales and write reports that can be compared
+    across commits.
+
+    For each scale (number of events x sequence length), a synthetic sequence
+    (see :mod:`~synthetic_sequence`) is generated at the Jiggle aftershock
+    station set and written as a Jiggle event table. The workflow then runs
+    against a :class:`~synthetic_sequence.SyntheticClient` stage by stage, as
+    in create_templates.py and run_match_filter.py:
+
+        load_event_table -> aqms2cat -> construct -> cluster -> select -> detect
+
+    Each stage's wall time and the process's peak memory are recorded, and
+    with **PROFILE** each stage is run under :mod:`cProfile`, saving its
+    profile and top functions. Template clustering is scored against the
+    synthetic source patches (purity) and detections against the synthetic
+    origin times (recall, precision, and recall by magnitude).
+
+    Reports are written as JSON files named by time and git commit to
+    **REPORT_DIR**, and :meth:`~.compare_reports` tabulates two of them.
+"""
+
+import cProfile
+import json
+import logging
+import platform
+import pstats
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from obspy import UTCDateTime, read_inventory
+from obspy.clients.fdsn import Client
+
+from eqcorrscan import Tribe
+
+from eqcutil import ClusteringTribe
+
+sys.path.append(str(Path(__file__).parent.parent))
+from jiggle_io import load_event_table
+from waveform_archive import WaveformArchive
+from pick_modeling import TravelTimeTable
+from create_templates import aqms2cat
+from template_builder import construct_from_archive
+from xcc_clustering import XCCMatrix
+from template_selection import cluster_table, select_best
+from match_filter_runner import MatchFilterRunner, merge_chunk_parties
+from detection_catalog import SweepDeclusterer, party_to_frame
+from synthetic_sequence import SyntheticClient, synthetic_sequence, write_event_table
+
+Logger = logging.getLogger(__name__)
+
+REPORT_VERSION = 1
+
+
+def read_station_list(path, channels=None):
+    """
+    Read a Jiggle station list (NET.STA.CHA.LOC lines, '--' for an empty
+    location code) as 'NET.STA.LOC.CHA' codes, keeping only channel codes in
+    **channels** if given.
+    """
+    codes = []
+    with open(path, 'r') as _f:
+        for line in _f:
+            parts = line.strip().split('.')
+            if len(parts) != 4:
+                continue
+            net, sta, cha, loc = parts
+            if channels is None or cha in channels:
+                codes.append(f'{net}.{sta}.{"" if loc == "--" else loc}.{cha}')
+    return codes
+
+
+def station_inventory(nslc, path, client=None, time=UTCDateTime('2025-03-03')):
+    """
+    Read a channel-level StationXML file for **nslc** codes, first fetching it
+    from **client** and saving it to **path** if it does not exist.
+    """
+    path = Path(path)
+    if path.exists():
+        return read_inventory(str(path))
+    bulk = []
+    for code in nslc:
+        net, sta, loc, cha = code.split('.')
+        bulk.append((net, sta, loc or '--', cha, time, time + 86400.))
+    inv = client.get_stations_bulk(bulk, level='channel')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    inv.write(str(path), format='STATIONXML')
+    return inv
+
+
+def git_commit(path):
+    """Short hash of the checked-out commit, with '-dirty' if tracked files changed"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=path,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def _max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 2**20 if sys.platform == 'darwin' else 2**10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/scale
+
+
+class StageTimer(object):
+    """
+    Run and time workflow stages, optionally under :mod:`cProfile`.
+
+    :param profile_dir: directory for `{prefix}{stage}.prof` profiles. If
+        `None`, stages are not profiled.
+    :param prefix: profile file name prefix, e.g., the scale name
+    :param nfunctions: number of top functions (by internal time) to report
+    """
+    def __init__(self, profile_dir=None, prefix='', nfunctions=10):
+        self.profile_dir = None if profile_dir is None else Path(profile_dir)
+        self.prefix = prefix
+        self.nfunctions = nfunctions
+        self.results = {}
+
+    def run(self, stage, func, *args, **kwargs):
+        profiler = None if self.profile_dir is None else cProfile.Profile()
+        tic = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+        entry = {'elapsed': time.perf_counter() - tic, 'max_rss_mb': _max_rss_mb()}
+        if profiler is not None:
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+            prof_file = self.profile_dir / f'{self.prefix}{stage}.prof'
+            profiler.dump_stats(str(prof_file))
+            entry['profile'] = prof_file.name
+            entry['hotspots'] = self._hotspots(profiler)
+        self.results[stage] = entry
+        Logger.info(f'{self.prefix}{stage}: {entry["elapsed"]:.2f} s, peak RSS {entry["max_rss_mb"]:.0f} MB')
+        return result
+
+    def _hotspots(self, profiler):
+        stats = pstats.Stats(profiler).stats
+        rows = sorted(stats.items(), key=lambda _i: _i[1][2], reverse=True)[:self.nfunctions]
+        return [{'function': f'{Path(_file).name}:{_line}({_func})', 'ncalls': _nc,
+                 'tottime': round(_tt, 4), 'cumtime': round(_ct, 4)}
+                for (_file, _line, _func), (_cc, _nc, _tt, _ct, _) in rows]
+
+
+def match_detections(true_times, det_times, tolerance=2.):
+    """
+    Match detected origin times to true origin times one-to-one, closest
+    pairs first, within **tolerance** seconds.
+
+    :returns: index into **true_times** of each detection's match, -1 if unmatched
+    """
+    true_times, det_times = np.asarray(true_times, dtype=float), np.asarray(det_times, dtype=float)
+    match = np.full(len(det_times), -1)
+    if len(true_times) == 0 or len(det_times) == 0:
+        return match
+    order = np.argsort(true_times)
+    ts = true_times[order]
+    # Candidate pairs: each detection with its neighbors in time
+    idx = np.searchsorted(ts, det_times)
+    idet = np.r_[np.arange(len(det_times)), np.arange(len(det_times))]
+    itrue = np.r_[idx - 1, idx]
+    ok = (itrue >= 0) & (itrue < len(ts))
+    idet, itrue = idet[ok], itrue[ok]
+    dt = np.abs(ts[itrue] - det_times[idet])
+    keep = dt <= tolerance
+    taken = np.zeros(len(ts), dtype=bool)
+    for _k in np.argsort(dt[keep], kind='stable'):
+        _d, _t = idet[keep][_k], itrue[keep][_k]
+        if match[_d] < 0 and not taken[_t]:
+            match[_d], taken[_t] = order[_t], True
+    return match
+
+
+def detection_scores(df, det_times, tolerance=2., mag_bins=np.arange(0., 4.5, 0.5)):
+    """
+    Recall and precision of detected origin times against an event table,
+    with recall in magnitude bins.
+    """
+    true_times = (df.DATETIME.values.astype('datetime64[ns]').astype(np.int64)/1e9)
+    match = match_detections(true_times, det_times, tolerance=tolerance)
+    found = np.zeros(len(df), dtype=bool)
+    found[match[match >= 0]] = True
+    nmatch = int((match >= 0).sum())
+    bins = pd.cut(df.MAG, mag_bins, right=False)
+    by_mag = pd.Series(found, index=df.index).groupby(bins, observed=False).agg(['mean', 'size'])
+    return {'n_true': len(df), 'n_detected': len(det_times), 'n_matched': nmatch,
+            'recall': nmatch/len(df) if len(df) > 0 else None,
+            'precision': nmatch/len(det_times) if len(det_times) > 0 else None,
+            'recall_by_mag': {str(_k): {'recall': None if np.isnan(_r['mean']) else _r['mean'],
+                                        'n': int(_r['size'])}
+                              for _k, _r in by_mag.iterrows()}}
+
+
+def detection_origins(party, tribe, trig_int):
+    """
+    Origin times (POSIX seconds) of detections in **party**, declustered over
+    all templates with **trig_int**, using each template's origin time
+    relative to its first sample.
+    """
+    events = SweepDeclusterer(trig_int).push(party_to_frame(party))
+    offsets = {}
+    for template in tribe:
+        origin = template.event.preferred_origin() or template.event.origins[0]
+        offsets[template.name] = origin.time - min(tr.stats.starttime for tr in template.st)
+    return events.detect_time.values + events.template_name.map(offsets).values
+
+
+def cluster_purity(labels, families):
+    """
+    Fraction of templates whose cluster's most common source patch is their
+    own, and the numbers of clusters and patches.
+    """
+    df = pd.DataFrame({'group': labels.values, 'family': families.reindex(labels.index).values})
+    major = df.groupby('group').family.agg(lambda _x: _x.value_counts().index[0])
+    return {'purity': float((df.family == df.group.map(major)).mean()),
+            'n_clusters': int(df.group.nunique()), 'n_families': int(df.family.nunique())}
+
+
+def _evid(template):
+    return int(template.event.resource_id.id.split('/')[-1])
+
+
+def benchmark_scale(name, nevents, duration, inv, ttable, workdir, stages, tckwargs,
+                    xcckwargs, detect_kwargs, detect_length=None, min_chan=4, fast_xcc=True,
+                    use_archive=False, n_workers=4, profile_dir=None, seed=0):
+    """
+    Run the workflow on one synthetic sequence.
+
+    :returns: report entry with the scale's parameters, stage timings, and scores
+    """
+    timer = StageTimer(profile_dir=profile_dir, prefix=f'{name}_')
+    entry = {'nevents': nevents, 'duration': duration, 'detect_length': detect_length}
+    t0 = UTCDateTime('2025-03-03T13:02:37.85')
+    workdir = Path(workdir)
+    workdir.mkdir(parents=True, exist_ok=True)
+    df, families = timer.run('synthesize', synthetic_sequence, nevents, t0, duration, seed=seed)
+    csv_file = write_event_table(df, workdir / f'{name}_events.csv')
+    client = SyntheticClient(df, inv, ttable, families=families, sampling_rate=tckwargs['samp_rate'],
+                             seed=seed)
+    if use_archive:
+        client = WaveformArchive(workdir / f'{name}_waveforms', client=client, chunk_length=3600.,
+                                 max_workers=4)
+    if 'load_event_table' in stages:
+        df = timer.run('load_event_table', load_event_table, csv_file, cache=False)
+    tribe = None
+    if 'aqms2cat' in stages:
+        cat = timer.run('aqms2cat', aqms2cat, df, inv, ttable=ttable, n_workers=n_workers)
+        entry['npicks'] = sum(len(_e.picks) for _e in cat)
+        if 'construct' in stages:
+            tribe, _ = timer.run('construct', construct_from_archive, cat, client, parallel=True,
+                                 num_cores=n_workers, **tckwargs)
+            tribe = Tribe(templates=[_t for _t in tribe if len(_t.st) >= min_chan])
+            entry['ntemplates'] = len(tribe)
+    if tribe is not None and len(tribe) > 0 and 'cluster' in stages:
+        if fast_xcc:
+            def _cluster():
+                xcc = XCCMatrix(None, shift_len=xcckwargs['shift_len'],
+                                allow_individual_trace_shifts=xcckwargs['allow_individual_trace_shifts'])
+                xcc.update(tribe)
+                return xcc.cluster(corr_thresh=xcckwargs['corr_thresh'],
+                                   replace_nan_distances_with=xcckwargs['replace_nan_distances_with'])
+        else:
+            def _cluster():
+                ctr = ClusteringTribe(templates=tribe.templates)
+                ctr.cluster(**xcckwargs)
+                return ctr._c.xcc
+        labels = timer.run('cluster', _cluster)
+        evids = pd.Series({template.name: _evid(template) for template in tribe})
+        entry['clustering'] = cluster_purity(
+            labels, pd.Series(families.reindex(evids.values).values, index=evids.index))
+        if 'select' in stages:
+            def _select():
+                table = cluster_table(tribe)
+                table['xcc'] = labels.reindex(table.index)
+                names = select_best(table, group='xcc', rank=['mag', 'nchan']).index
+                return Tribe(templates=[_t for _t in tribe if _t.name in names])
+            tribe = timer.run('select', _select)
+            entry['nselected'] = len(tribe)
+    if tribe is not None and len(tribe) > 0 and 'detect' in stages:
+        t1 = t0 + (duration if detect_length is None else min(duration, detect_length))
+        outdir = workdir / f'{name}_match_filter'
+        runner = MatchFilterRunner(tribe, client, outdir, chunk_length=3600., **detect_kwargs)
+        timer.run('detect', runner.run, t0, t1)
+        party = timer.run('merge', merge_chunk_parties, outdir)
+        det_times = detection_origins(party, tribe, detect_kwargs['trig_int'])
+        truth = df[df.DATETIME < pd.Timestamp(t1.datetime)]
+        entry['detection'] = detection_scores(truth, det_times)
+        Logger.info(f'{name}: recall {entry["detection"]["recall"]}, '
+                    f'precision {entry["detection"]["precision"]}')
+    entry['stages'] = timer.results
+    return entry
+
+
+def write_report(report_dir, report):
+    """Save a report as {report_dir}/{YYYYmmddTHHMMSS}_{commit}.json"""
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    path = report_dir / f'{UTCDateTime(report["created"]).strftime("%Y%m%dT%H%M%S")}_{report["commit"]}.json'
+    with open(path, 'w') as _f:
+        json.dump(report, _f, indent=1, default=str)
+    return path
+
+
+def compare_reports(old_file, new_file):
+    """
+    Tabulate stage times, peak memory, and scores of two reports.
+
+    :returns: :class:`~pandas.DataFrame` indexed by (scale, metric) with 'old',
+        'new', and 'ratio' (new/old) columns
+    """
+    rows = {}
+    for label, path in [('old', old_file), ('new', new_file)]:
+        with open(path, 'r') as _f:
+            report = json.load(_f)
+        for scale, entry in report['scales'].items():
+            for stage, result in entry['stages'].items():
+                rows.setdefault((scale, f'{stage} [s]'), {})[label] = result['elapsed']
+            rows.setdefault((scale, 'peak RSS [MB]'), {})[label] = max(
+                [_r['max_rss_mb'] for _r in entry['stages'].values()], default=np.nan)
+            for key in ['recall', 'precision']:
+                if 'detection' in entry:
+                    rows.setdefault((scale, key), {})[label] = entry['detection'][key]
+            if 'clustering' in entry:
+                rows.setdefault((scale, 'cluster purity'), {})[label] = entry['clustering']['purity']
+    df = pd.DataFrame.from_dict(rows, orient='index', columns=['old', 'new']).astype(float)
+    df.index = pd.MultiIndex.from_tuples(df.index, names=['scale', 'metric'])
+    df['ratio'] = df.new/df.old
+    return df
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    ROOT = Path(__file__).parent.parent.parent
+    # Real aftershock station set & its (cached) channel metadata
+    STATION_LIST = ROOT / 'data' / 'jiggle' / 'jiggle_aftershock_stations.txt'
+    INVENTORY = ROOT / 'processed_data' / 'benchmarks' / 'aftershock_stations.xml'
+    TTABLE_DIR = ROOT / 'processed_data' / 'ttables'
+    # Reports & profiles
+    REPORT_DIR = ROOT / 'processed_data' / 'benchmarks' / 'reports'
+    # Synthetic event tables, archives, and chunk parties (deleted after the run if None)
+    WORKDIR = None
+    # Vertical channels of the station set
+    CHANNELS = ['HHZ', 'EHZ', 'HNZ']
+    # (name, number of events, sequence length [s], detection length [s] or None for all)
+    SCALES = [
+        ('10ev_1h', 10, 3600., None),
+        ('1kev_1d', 1000, 86400., None),
+        ('10kev_30d', 10000, 30*86400., 86400.),
+    ]
+    STAGES = ['load_event_table', 'aqms2cat', 'construct', 'cluster', 'select', 'detect']
+    # Profile each stage with cProfile
+    PROFILE = True
+    # Compare against the newest earlier report
+    COMPARE = True
+    # Same switches as create_templates.py
+    FAST_XCC = True
+    USE_ARCHIVE = False
+    MIN_CHAN = 4
+    NWORKERS = 4
+    SEED = 0
+
+    tckwargs = {
+        'lowcut': 5.,
+        'highcut': None,
+        'filt_order': 4,
+        'samp_rate': 100.,
+        'length': 10.,
+        'prepick': 1.5,
+        'process_len': 3600.,
+        'min_snr': None,
+    }
+
+    xcckwargs = {
+        'method': 'xcc',
+        'replace_nan_distances_with': 'mean',
+        'shift_len': 4,
+        'corr_thresh': 0.45,
+        'allow_individual_trace_shifts': False,
+        'cores': 'all'
+    }
+
+    detect_kwargs = {
+        'threshold': 8.,
+        'threshold_type': 'MAD',
+        'trig_int': 1.,
+    }
+
+    # PROCESSING SECTION #
+    nslc = read_station_list(STATION_LIST, channels=CHANNELS)
+    inv = station_inventory(nslc, INVENTORY, client=Client('IRIS'))
+    ttable = TravelTimeTable(velocity_model='P4', phases=['P', 'p'], cache_dir=TTABLE_DIR)
+    report = {'version': REPORT_VERSION, 'commit': git_commit(ROOT), 'created': str(UTCDateTime()),
+              'host': platform.node(), 'python': platform.python_version(),
+              'channels': nslc, 'stages': STAGES, 'tckwargs': tckwargs, 'xcckwargs': xcckwargs,
+              'detect_kwargs': detect_kwargs, 'fast_xcc': FAST_XCC, 'use_archive': USE_ARCHIVE,
+              'seed': SEED, 'scales': {}}
+    profile_dir = REPORT_DIR / 'profiles' / report['created'].replace(':', '') if PROFILE else None
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = Path(tmpdir) if WORKDIR is None else Path(WORKDIR)
+        for name, nevents, duration, detect_length in SCALES:
+            report['scales'][name] = benchmark_scale(
+                name, nevents, duration, inv, ttable, workdir, STAGES, tckwargs, xcckwargs,
+                detect_kwargs, detect_length=detect_length, min_chan=MIN_CHAN, fast_xcc=FAST_XCC,
+                use_archive=USE_ARCHIVE, n_workers=NWORKERS, profile_dir=profile_dir, seed=SEED)
+    previous = sorted(REPORT_DIR.glob('*.json')) if REPORT_DIR.exists() else []
+    report_file = write_report(REPORT_DIR, report)
+    print(f'Wrote {report_file}')
+    for name, entry in report['scales'].items():
+        print(f'\n{name}: {entry["nevents"]} events over {entry["duration"]/86400:.2f} days')
+        for stage, result in entry['stages'].items():
+            print(f'  {stage:<18s} {result["elapsed"]:10.2f} s  {result["max_rss_mb"]:8.0f} MB')
+        for key in ['clustering', 'detection']:
+            if key in entry:
+                print(f'  {key}: ' + ', '.join(f'{_k} {_v}' for _k, _v in entry[key].items()
+                                               if not isinstance(_v, dict)))
+    if COMPARE and len(previous) > 0:
+        print(f'\nCompared to {previous[-1].name}:')
+        print(compare_reports(previous[-1], report_file).to_string(float_format='{:.3f}'.format))
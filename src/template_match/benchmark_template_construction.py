@@ -0,0 +1,100 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/benchmark_template_construction.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Benchmark template construction on a synthetic aftershock catalog:
+    EQcorrscan's per-event-group `from_client` method against
+    :meth:`~template_builder.construct_from_archive` reading through a local
+    :class:`~waveform_archive.WaveformArchive` (cold, then warm) that is
+    backed by a :class:`~fake_clients.FakeClient` with FDSN-like latency.
+"""
+
+import logging
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from obspy import UTCDateTime
+from obspy.core.event import Catalog, Event, Origin, Pick, WaveformStreamID
+
+from eqcorrscan import Tribe
+
+sys.path.append(str(Path(__file__).parent.parent))
+from fake_clients import FakeClient
+from waveform_archive import WaveformArchive
+from template_builder import construct_from_archive
+
+Logger = logging.getLogger(__name__)
+
+
+def synthetic_catalog(nevents, starttime, duration, nslc, seed=123):
+    """
+    Make a catalog of **nevents** events with random origin times between
+    **starttime** and **starttime** + **duration**, each with a P pick on
+    every channel in **nslc** 2-6 s after the origin time.
+    """
+    rng = np.random.default_rng(seed)
+    otimes = np.sort(rng.uniform(0, duration, nevents))
+    cat = Catalog()
+    for _e, _t in enumerate(otimes):
+        otime = starttime + float(_t)
+        event = Event(resource_id=f'smi:local/Event/{_e}')
+        event.origins.append(Origin(time=otime, latitude=48.6, longitude=-122.8, depth=15e3))
+        for _c in nslc:
+            event.picks.append(Pick(time=otime + float(rng.uniform(2, 6)), phase_hint='P',
+                                    waveform_id=WaveformStreamID(seed_string=_c)))
+        cat.events.append(event)
+    return cat
+
+
+def run(label, func, client):
+    nreq = len(client.requests)
+    tic = time.perf_counter()
+    tribe = func()
+    elapsed = time.perf_counter() - tic
+    print(f'{label:<28s} {elapsed:8.2f} s  {len(tribe):4d} templates  '
+          f'{len(client.requests) - nreq:5d} client requests')
+    return tribe
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    # Synthetic sequence
+    NEVENTS = 200
+    T0 = UTCDateTime('2025-03-03T00:00:00')
+    DURATION = 6*3600.
+    NSLC = ['UW.OLGA..HHZ', 'UW.TURTL..HHZ', 'UW.MCW..HHZ', 'UW.LOPEZ..HHZ']
+    # Emulated FDSN request latency (s)
+    LATENCY = 0.25
+
+    tckwargs = {
+        'lowcut': 5.,
+        'highcut': None,
+        'filt_order': 4,
+        'samp_rate': 100.,
+        'length': 10.,
+        'prepick': 1.5,
+        'process_len': 3600.,
+        'min_snr': None,
+    }
+
+    cat = synthetic_catalog(NEVENTS, T0, DURATION, NSLC)
+    client = FakeClient(nslc=NSLC, latency=LATENCY)
+    print(f'{NEVENTS} events over {DURATION/3600:.0f} hours on {len(NSLC)} channels, '
+          f'{LATENCY} s request latency')
+
+    run('from_client (EQcorrscan)',
+        lambda: Tribe().construct(method='from_client', client_id=client,
+                                  catalog=cat.copy(), **tckwargs),
+        client)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        archive = WaveformArchive(tmpdir, client=client, chunk_length=3600., max_workers=4)
+        for label in ['archive, cold', 'archive, warm']:
+            run(label,
+                lambda: construct_from_archive(cat.copy(), archive, **tckwargs)[0],
+                client)
@@ -0,0 +1,150 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/catalog_builder.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Builds an ObsPy :class:`~obspy.core.event.Catalog` from an AQMS event
+    table and a modeled pick table (see :mod:`pick_modeling`) across a pool of
+    worker processes.
+
+    Station delays and channel triplication (see :mod:`station_corrections`)
+    are applied to the whole pick table with array operations before events
+    are built, rather than as a second pass over Pick objects. Resource IDs are
+    derived from event IDs and NSLC codes, so catalogs built serially and in
+    parallel are identical.
+"""
+
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from obspy import UTCDateTime
+from obspy.core.event import (
+    Catalog, Event, Origin, Arrival, Magnitude, Pick,
+    ResourceIdentifier, QuantityError, OriginQuality,
+    OriginUncertainty, WaveformStreamID)
+
+Logger = logging.getLogger(__name__)
+
+EVALUATION_MODE = {'F': 'manual', 'I': 'manual', 'A': 'automatic', 'H': 'automatic'}
+EVALUATION_STATUS = {'F': 'final', 'I': 'reviewed', 'H': 'confirmed', 'A': 'preliminary'}
+
+
+def row_to_event(evid, row, picks=None, velocity_model='P4'):
+    """
+    Convert one event table row (and its rows of the pick table) into an
+    :class:`~obspy.core.event.Event` with deterministic resource IDs.
+    """
+    event = Event(
+        resource_id=ResourceIdentifier(id=f'smi:local/Event/{evid}'),
+        event_type=row.ETYPE)
+    origin = Origin(
+        resource_id=ResourceIdentifier(id=f'quakeml:uw.anss.org/Origin/UW/{evid}'),
+        time=UTCDateTime(str(row.DATETIME)),
+        longitude=row.LON,
+        latitude=row.LAT,
+        depth=row.MZ*1e3,
+        depth_type='operator assigned' if row.ZF else 'from location',
+        depth_errors=QuantityError(uncertainty=row.ERR_Z*1e3),
+        epicenter_fixed=bool(row.HF),
+        time_fixed=bool(row.TF),
+        quality=OriginQuality(associated_phase_count=row.OBS,
+                              used_phase_count=row.USED,
+                              minimum_distance=row.DIST/111.2,
+                              azimuthal_gap=row.GAP),
+        origin_uncertainty=OriginUncertainty(horizontal_uncertainty=row.ERR_H*1e3),
+        evaluation_mode=EVALUATION_MODE[row.ST],
+        evaluation_status=EVALUATION_STATUS[row.ST],
+    )
+    magnitude = Magnitude(resource_id=ResourceIdentifier(id=f'smi:local/Magnitude/{evid}'),
+                          mag=row.MAG,
+                          magnitude_type=row.MTYP,
+                          origin_id=origin.resource_id,
+                          mag_errors=QuantityError(uncertainty=row.MERR))
+    earth_model_id = ResourceIdentifier(id=f'quakeml:uw.anss.org/VelocityModel/UW/{velocity_model}')
+    if picks is not None:
+        for _p in picks.itertuples():
+            pick = Pick(
+                resource_id=ResourceIdentifier(id=f'smi:local/Pick/{evid}/{_p.nslc}/{_p.phase}'),
+                time=UTCDateTime(str(_p.time)),
+                waveform_id=WaveformStreamID(seed_string=_p.nslc),
+                phase_hint=_p.phase,
+                evaluation_mode='automatic')
+            event.picks.append(pick)
+            # Triplicated picks are copies, not modeled arrivals
+            if getattr(_p, 'triplicated', False):
+                continue
+            origin.arrivals.append(Arrival(
+                resource_id=ResourceIdentifier(id=f'smi:local/Arrival/{evid}/{_p.nslc}/{_p.phase}'),
+                pick_id=pick.resource_id,
+                phase=pick.phase_hint,
+                distance=_p.dist_deg,
+                earth_model_id=earth_model_id))
+    event.origins.append(origin)
+    event.magnitudes.append(magnitude)
+    event.preferred_origin_id = origin.resource_id
+    event.preferred_magnitude_id = magnitude.resource_id
+    return event
+
+
+def _build_events(df, picks, velocity_model):
+    """Worker task: build events for a chunk of the event table"""
+    picks_by_event = dict(tuple(picks.groupby('evid'))) if len(picks) > 0 else {}
+    return [row_to_event(evid, row, picks_by_event.get(evid), velocity_model)
+            for evid, row in df.iterrows()]
+
+
+def build_catalog(df, picks, velocity_model='P4', corrections=None, inv=None,
+                  n_workers=1, chunk_size=None):
+    """
+    Build a :class:`~obspy.core.event.Catalog` from an event table and a pick
+    table, applying station delays and channel triplication as it builds.
+
+    :param df: event table indexed by event ID (see :meth:`~jiggle_io.load_event_table`)
+    :param picks: pick table from :meth:`~pick_modeling.model_pick_table`
+    :param velocity_model: name of the velocity model used to model **picks**
+    :param corrections: optional :class:`~station_corrections.StationCorrections`
+        applied to **picks**
+    :param inv: inventory (or channel table) that picks are expanded onto, see
+        :meth:`~station_corrections.StationCorrections.apply`
+    :param n_workers: number of worker processes. 1 builds serially.
+    :param chunk_size: number of events per worker task, defaults to an even
+        split into 4 tasks per worker
+
+    :returns:
+        - **cat** (*obspy.core.event.Catalog*) -- events in the order of **df**
+        - **timings** (*dict*) -- seconds spent in each stage
+    """
+    timings = {}
+    tic = time.perf_counter()
+    if corrections is not None:
+        picks = corrections.apply(picks, inv=inv)
+    timings['corrections'] = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    if n_workers is None or n_workers > 1:
+        if chunk_size is None:
+            nchunks = 4*(n_workers or 1)
+        else:
+            nchunks = int(np.ceil(len(df)/chunk_size))
+        chunks = [_c for _c in np.array_split(np.arange(len(df)), max(nchunks, 1)) if len(_c) > 0]
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = []
+            for _c in chunks:
+                _df = df.iloc[_c]
+                futures.append(executor.submit(
+                    _build_events, _df, picks[picks.evid.isin(_df.index)], velocity_model))
+            # Collect in submission order so output does not depend on scheduling
+            events = [_e for _f in futures for _e in _f.result()]
+    else:
+        events = _build_events(df, picks, velocity_model)
+    timings['build_events'] = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    cat = Catalog(events=events)
+    timings['merge'] = time.perf_counter() - tic
+    Logger.info('catalog build timings: ' + ', '.join(f'{_k} {_v:.3f} s' for _k, _v in timings.items()))
+    return cat, timings
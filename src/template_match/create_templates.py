@@ -1,103 +1,54 @@
+import sys, time, logging
 from pathlib import Path
 
-import pandas as pd
-
 from obspy import UTCDateTime
 from obspy.clients.fdsn import Client
-from obspy.core.event import (
-    Catalog, Event, Origin, Arrival, Magnitude,
-    ResourceIdentifier, QuantityError, OriginQuality,
-    OriginUncertainty)
 
 from eqcorrscan import Tribe
 
 from eqcutil import ClusteringTribe
-from eqcutil.catalog.model_phases import model_picks
+
+sys.path.append(str(Path(__file__).parent.parent))
+from jiggle_io import load_event_table
+from pick_modeling import TravelTimeTable, model_pick_table
+from catalog_builder import build_catalog
+from station_corrections import StationCorrections
+from template_builder import construct_from_archive
+from waveform_archive import WaveformArchive
+from xcc_clustering import XCCMatrix, check_parity
+from template_selection import cluster_table, select_best, write_subset
+
+Logger = logging.getLogger(__name__)
 
 ### SUPPORTING METHOD FOR CONVERTING AQMS EVENT CSV INTO OBSPY CATALOG
 
-def aqms2cat(df, inv, phases=['P','p'], velocity_model='P4', pick_preference='earliest'):
+def aqms2cat(df, inv, phases=['P','p'], velocity_model='P4', pick_preference='earliest',
+             ttable=None, picks=None, n_workers=1, corrections=None, expand_inv=None):
     """
     Convert a dataframe representation of an AQMS event table
-    exported from Jiggle into a :class:`~obspy.core.event.Catalog`
+    exported from Jiggle (see :meth:`~jiggle_io.load_event_table`)
+    into a :class:`~obspy.core.event.Catalog`
     object and populate events with modeled pick times for stations
     included in **inv**.
-    """
-    cat = Catalog()
-    # Iterate across events
-    for evid, row in df.iterrows():
-        #Convert row into event, origin, and magnitude
-        event = Event(
-            resource_id = ResourceIdentifier(prefix='smi:local/Event/'),
-            event_type=row.ETYPE[1:-1])
-        origin = Origin(
-            resource_id=ResourceIdentifier(id=f'quakeml:uw.anss.org/Origin/UW/{evid}'),
-            time=UTCDateTime(str(row.DATETIME)),
-            longitude=row.LON,
-            latitude=row.LAT,
-            depth=row.MZ,
-            depth_type = {'0':'from location','1':'operator assigned'}[row.ZF[1:-1]],
-            depth_errors=QuantityError(uncertainty=row.ERR_Z*1e3),
-            epicenter_fixed=row.HF=="'1'",
-            time_fixed=row.TF=="'1'",
-            quality=OriginQuality(associated_phase_count=row.OBS,
-                                  used_phase_count=row.USED,
-                                  minimum_distance=row.DIST/111.2,
-                                  azimuthal_gap=row.GAP),
-            origin_uncertainty=OriginUncertainty(horizontal_uncertainty=row.ERR_H*1e3),
-            evaluation_mode={"'F'":'manual',"'I'":'manual', "'A'":'automatic', "'H'":'automatic'}[row.ST],
-            evaluation_status={"'F'":'final',"'I'":'reviewed',"'H'":'confirmed',"'A'":'preliminary'}[row.ST],
-        )
-
-        magnitude = Magnitude(mag=row.MAG,
-                              magnitude_type=row.MTYP,
-                              origin_id=origin.resource_id,
-                              mag_errors=QuantityError(uncertainty=row.MERR))
-
-        # Model Picks
-        picks = model_picks(origin, inv, model_name=velocity_model, phases=phases)
-        # Associate picks to origin & attach picks to event
-        
-        nslc_pick_times = {}
-        for _p in picks:
-            nslc = _p.waveform_id.id
-            if nslc in nslc_pick_times.keys():
-                if pick_preference == 'earliest':
-                    if nslc_pick_times[nslc] < _p.time:
-                        continue
-                    else:
-                        nslc_pick_times[nslc] = _p.time
-                elif pick_preference == 'latest':
-                    if nslc_pick_times[nslc] > _p.time:
-                        continue
-                    else:
-                        nslc_pick_times[nslc] = _p.time
-                elif pick_preference in ['all', None]:
-                    pass
-            else:
-                nslc_pick_times.update({nslc: _p.time})
 
-            arr = Arrival(
-                pick_id=_p.resource_id,
-                phase=_p.phase_hint,
-                earth_model_id=ResourceIdentifier(
-                    id=f'quakeml:uw.anss.org/VelocityModel/UW/{velocity_model}'
-                    )
-                )
-            event.picks.append(_p)
-            origin.arrivals.append(arr)
-        
-        # Attach origin to event
-        event.origins.append(origin)
-        # Attach magnitude to event
-        event.magnitudes.append(magnitude)
-        # Set origin as preferred origin
-        event.preferred_origin_id = origin.resource_id
-        # Set magnitude as preferred magnitude
-        event.preferred_magnitude_id = magnitude.resource_id
-
-        # Attach to catalog
-        cat.events.append(event)
+    Picks for all events are modeled at once with :meth:`~pick_modeling.model_pick_table`
+    using **ttable** (a :class:`~pick_modeling.TravelTimeTable`, built for
+    **velocity_model** and **phases** if not provided), unless a pre-computed
+    pick table is passed as **picks**. Events are then built across **n_workers**
+    processes with :meth:`~catalog_builder.build_catalog`, which also applies
+    station delays and component expansion from **corrections** (a
+    :class:`~station_corrections.StationCorrections`), expanding picks onto
+    channels in **expand_inv**.
+    """
+    # Model picks for all events x channels at once
+    tic = time.perf_counter()
+    if picks is None:
+        if ttable is None:
+            ttable = TravelTimeTable(velocity_model=velocity_model, phases=phases)
+        picks = model_pick_table(df, inv, ttable, pick_preference=pick_preference)
+    Logger.info(f'modeled {len(picks)} picks in {time.perf_counter() - tic:.3f} s')
+    cat, _ = build_catalog(df, picks, velocity_model=velocity_model, n_workers=n_workers,
+                           corrections=corrections, inv=expand_inv)
     return cat
         
 ### MAIN CODE ###
@@ -107,34 +58,46 @@ if __name__ == '__main__':
     AQMS_DATA = ROOT / 'data' / 'jiggle' / 'Event_Table_Output_4MAR2025_1900UTC.csv'
 
     OUTPUT_DIR = ROOT / 'processed_data' / 'templates'
+    # Cache directory for tabulated travel times
+    TTABLE_DIR = ROOT / 'processed_data' / 'ttables'
+    # Local waveform archive
+    WAVEPATH = ROOT / 'data' / 'waveforms'
+    # Construct templates from shared, once-processed windows of archived data
+    # instead of EQcorrscan's from_client method. Off until
+    # benchmark_template_construction.py has been run and its results reported
+    USE_ARCHIVE = False
 
     # DEFINE INVENTORY QUERY STRINGS
     STAS = 'OLGA,TURTL'#,MCW'#,LOPEZ'
     NETS = 'UW'
     CHANS = 'HHZ'#,EHZ'#,HHE,HHN'
-    # DEFINE CHANNEL CODES FOR TRIPLICATION
-    TO_TRIPLICATE = {'OLGA','TURTL','LOPEZ'}
-    TRIPLICATE_CHANS = 'NE'
-    # COMP2 = {'OLGA': 'NE', 'TURTL':'NE', 'MCW': ''}
+    # DEFINE CHANNELS THAT PICKS ARE EXPANDED (TRIPLICATED) ONTO
+    EXPAND_CHANS = 'HH?'
+    # Station delay files: production P5 delays and ad-hoc overrides, which
+    # also flag stations for expansion
+    DELAY_FILE = ROOT / 'data' / 'resources' / 'P5.del'
+    AD_HOC_FILE = ROOT / 'data' / 'resources' / 'station_corrections_ad_hoc.csv'
 
     MIN_CHAN = 6
+    # Number of processes for building the catalog
+    NWORKERS = 4
 
-    # Production station delays from the 2023 P5 station delay set (P5.del)
-    OFFICIAL_STATION_DELAYS = {
-        'OLGA': 0.06,
-        'TURTL': 0.01,
-        'MCW': 0.07,
-        'LOPEZ': -0.09
-        }
-    # Additional delays applied based on visual review of earlier template generation
-    AD_HOC_STATION_DELAYS = {
-        'OLGA': 2.15 - 0.5,
-        'TURTL': 0.5,
-        'MCW': 1.2,
-        'LOPEZ': 0.
-        }
     # Minimum mean Signal to Noise Ratio for template matching
     TEMPLATE_SNR_MIN = 5.
+    # Ranking of templates within each xcc group: 'snr', 'nchan', 'magnitude',
+    # or a list of cluster table columns (see template_selection.RANKINGS)
+    TEMPLATE_RANK = 'snr'
+
+    # Cluster with batched FFT correlations and a cached, sparse correlation matrix.
+    # Off until its groups have been checked against ClusteringTribe.cluster
+    # on this tribe (see VERIFY_XCC)
+    FAST_XCC = False
+    XCC_CACHE = OUTPUT_DIR / 'xcc_matrix.npz'
+    # Only correlate events within this many km of each other (None: all pairs)
+    MAX_PAIR_KM = 5.
+    # With FAST_XCC, also compare distances and groups to EQcorrscan and
+    # ClusteringTribe.cluster (see xcc_clustering.check_parity)
+    VERIFY_XCC = True
 
     tckwargs = {
         'method': 'from_client',
@@ -168,7 +131,7 @@ if __name__ == '__main__':
     tckwargs.update({'client_id': IRIS})
 
     # Read event table
-    df = pd.read_csv(AQMS_DATA, index_col=[0], parse_dates=['DATETIME'])
+    df = load_event_table(AQMS_DATA)
     # Strip off mainshock
     adf = df #.iloc[:10] #.iloc[1:]
     # Get station inventory
@@ -179,36 +142,35 @@ if __name__ == '__main__':
         level='channel',
         endafter=UTCDateTime('2025-03-03T00:00:00')
     )
-    # Convert event table into catalog & model arrival times
-    cat = aqms2cat(adf, inv, pick_preference='earliest')
-    # Manually apply station delays based on model P5 2023 P-wave station delays
-
-    # Apply station delays
-    for _e, event in enumerate(cat.events):
-        print(_e)
-        dup_picks = []
-
-        for pick in event.picks:
-            # Get composite station delay correction
-            _sta = pick.waveform_id.station_code
-            dt = OFFICIAL_STATION_DELAYS[_sta] +\
-                 AD_HOC_STATION_DELAYS[_sta]
-            # Apply station delay to pick
-            pick.time = pick.time + dt
-            # Create additional picks on 
-            if _sta in TO_TRIPLICATE:
-                for _c in TRIPLICATE_CHANS:
-                    ipick = pick.copy()
-                    ipick.waveform_id.channel_code = f'HH{_c}'
-                    ipick.resource_id = ResourceIdentifier()
-                    dup_picks.append(ipick)
-        for _p in dup_picks:
-            event.picks.append(_p)
+    # Get inventory of channels to expand picks onto
+    expand_inv = IRIS.get_stations(
+        station=STAS,
+        network=NETS,
+        channel=EXPAND_CHANS,
+        level='channel',
+        endafter=UTCDateTime('2025-03-03T00:00:00')
+    )
+    # Tabulate (or load cached) P4 travel times
+    ttable = TravelTimeTable(velocity_model='P4', phases=['P','p'], cache_dir=TTABLE_DIR)
+    # Composite station delays: model P5 2023 P-wave station delays plus ad-hoc adjustments
+    corrections = StationCorrections.from_files(delay_file=DELAY_FILE, override_file=AD_HOC_FILE)
+    # Convert event table into catalog & model arrival times, applying station
+    # delays and creating additional picks on horizontal channels as events are built
+    cat = aqms2cat(adf, inv, pick_preference='earliest', ttable=ttable, n_workers=NWORKERS,
+                   corrections=corrections, expand_inv=expand_inv)
     # Attach catalog to tckwargs
     tckwargs.update({'catalog': cat})
 
     # Construct templates
-    tribe = Tribe().construct(**tckwargs)
+    if USE_ARCHIVE:
+        archive = WaveformArchive(WAVEPATH, client=IRIS, chunk_length=3600., max_workers=4)
+        tribe, _ = construct_from_archive(
+            cat, archive, process_len=tckwargs['process_length'], parallel=True,
+            num_cores=tckwargs['num_cores'],
+            **{_k: tckwargs[_k] for _k in ['lowcut', 'highcut', 'filt_order', 'samp_rate',
+                                           'length', 'prepick', 'min_snr']})
+    else:
+        tribe = Tribe().construct(**tckwargs)
     # Rename templates & merge multiple traces
     ctr = ClusteringTribe()
     for tmp in tribe:
@@ -224,33 +186,31 @@ if __name__ == '__main__':
     # ctr = ClusteringTribe(templates=tribe.templates)
     breakpoint()
     # Run template xcorr clustering
-    ctr.cluster(**xcckwargs)
+    if FAST_XCC:
+        xcc = XCCMatrix(XCC_CACHE, shift_len=xcckwargs['shift_len'],
+                        allow_individual_trace_shifts=xcckwargs['allow_individual_trace_shifts'],
+                        max_distance=MAX_PAIR_KM)
+        # Only pairs with new or changed templates are correlated
+        xcc.update(ctr)
+        labels = xcc.cluster(corr_thresh=xcckwargs['corr_thresh'],
+                             replace_nan_distances_with=xcckwargs['replace_nan_distances_with'])
+        if VERIFY_XCC:
+            parity = check_parity(xcc, ctr, **xcckwargs)
+            if not parity['parity']:
+                Logger.warning(f'fast xcc differs from ClusteringTribe.cluster: {parity}')
+        ctr._c['xcc'] = labels
+    else:
+        ctr.cluster(**xcckwargs)
     # Populate clusters dataframe
     ctr.populate_event_metadata()
 
     # Save whole clustering tribe
     ctr.write(str(OUTPUT_DIR/'aqms_event_templates.tgz'))
     breakpoint()
-    # Create subset of highest SNR templates per xcorr cluster
-    pref_names = []
-    for _gn in ctr._c.xcc.unique():
-        # Subset by group
-        _df = ctr._c[ctr._c.xcc == _gn]
-        # Get highest snr
-        snr_max = _df.mean_snr_dB.max()
-        # If the max snr meets minimum requirements
-        if snr_max >= TEMPLATE_SNR_MIN:
-            name = _df[_df.mean_snr_dB == _df.mean_snr_dB.max()].index.values[0]
-            pref_names.append(name)
-        else:
-            continue
-
-    tctr = ctr.get_subset(names=pref_names)
-    tctr.write(str(OUTPUT_DIR/'templates_for_match_filter.tgz'))
-
-
-
-
-
-
-
+    # Select the highest ranked template per xcorr cluster that meets the SNR minimum
+    best = select_best(cluster_table(ctr), group='xcc', rank=TEMPLATE_RANK,
+                       min_values={'mean_snr_dB': TEMPLATE_SNR_MIN})
+    # Save the selection as an index into the whole clustering tribe
+    write_subset(OUTPUT_DIR/'templates_for_match_filter.json',
+                 OUTPUT_DIR/'aqms_event_templates.tgz', best.index,
+                 group='xcc', rank=TEMPLATE_RANK, min_snr=TEMPLATE_SNR_MIN)
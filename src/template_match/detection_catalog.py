@@ -0,0 +1,448 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/detection_catalog.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Streaming post-processing of matched-filter detections into a
+    columnar detection catalog.
+
+    :class:`~.DetectionPostProcessor` reads the chunk Parties of a
+    :class:`~match_filter_runner.MatchFilterRunner` (or
+    :class:`~sharded_match_filter.ShardedMatchFilter`) output directory one
+    chunk at a time, in time order, and:
+
+        1. Declusters detections across templates with a time-sorted sweep:
+           detections closer than **trig_int** seconds to the previous one are
+           one event, represented by the detection with the largest
+           correlation metric. Events still open at the end of a chunk are
+           carried into the next chunk.
+        2. Measures each event on a process pool: every template channel is
+           re-aligned to the continuous data within **shift_len** seconds
+           (lag-calc), channels correlating above **min_cc** get a pick, and
+           their amplitude ratios to the template give a relative magnitude,
+           M = M_template + median(log10(ratio)), anchored to the template
+           event's AQMS magnitude.
+        3. Writes events and picks as Parquet parts of a
+           :class:`~.DetectionCatalog`.
+
+    Only one chunk of detections, and on each worker one batch of waveform
+    data (at most **max_span** seconds of detections plus padding), is held
+    in memory at a time. Events get the template event's
+    location and an origin time shifted by the detection time, and use AQMS
+    event table column names (DATETIME, LAT, LON, MZ, MAG) so they can be
+    plotted alongside AQMS events (see `plot_aftershocks.py`).
+
+    Catalog layout::
+
+        {root}/events/{part}.parquet    -- one row per declustered detection
+        {root}/picks/{part}.parquet     -- one row per lag-calc pick
+"""
+
+import itertools
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from obspy import Stream, UTCDateTime
+
+from eqcorrscan import Party
+
+from template_builder import process_window
+from waveform_archive import WaveformArchive
+
+Logger = logging.getLogger(__name__)
+
+EVENT_COLUMNS = ['DATETIME', 'LAT', 'LON', 'MZ', 'MAG', 'MTYP', 'template_name',
+                 'template_mag', 'detect_time', 'detect_val', 'avg_cor', 'no_chans',
+                 'ndetections', 'npicks', 'mag_chans']
+PICK_COLUMNS = ['ID', 'seed_id', 'time', 'cc', 'amplitude_ratio']
+# Per-process worker state, set by _init_worker
+_WORKER = {}
+
+
+def template_metadata(tribe):
+    """
+    Get each template's event location, magnitude, and origin time relative
+    to its first trace, as a :class:`~pandas.DataFrame` indexed by template name
+    """
+    rows = {}
+    for template in tribe:
+        ref = min(tr.stats.starttime for tr in template.st)
+        event = template.event
+        origin = None if event is None else (event.preferred_origin() or (event.origins or [None])[0])
+        mag = None if event is None else (event.preferred_magnitude() or (event.magnitudes or [None])[0])
+        rows[template.name] = {
+            'LAT': None if origin is None else origin.latitude,
+            'LON': None if origin is None else origin.longitude,
+            # QuakeML depths are in meters
+            'MZ': None if origin is None or origin.depth is None else origin.depth/1000.,
+            'MAG': None if mag is None else mag.mag,
+            'MTYP': None if mag is None else mag.magnitude_type,
+            'origin_offset': 0. if origin is None else origin.time - ref}
+    meta = pd.DataFrame.from_dict(rows, orient='index')
+    for _c in ['LAT', 'LON', 'MZ', 'MAG', 'origin_offset']:
+        meta[_c] = meta[_c].astype(float)
+    return meta
+
+
+def party_to_frame(party):
+    """Get one row per detection in **party**, sorted by detection time"""
+    rows = [{'ID': _d.id, 'template_name': _d.template_name,
+             'detect_time': _d.detect_time.timestamp, 'detect_val': _d.detect_val,
+             'no_chans': _d.no_chans} for family in party for _d in family]
+    df = pd.DataFrame(rows, columns=['ID', 'template_name', 'detect_time', 'detect_val', 'no_chans'])
+    df['avg_cor'] = (df.detect_val/df.no_chans.clip(lower=1)).astype(float)
+    return df.sort_values('detect_time', kind='stable', ignore_index=True)
+
+
+class SweepDeclusterer(object):
+    """
+    Time-sorted sweep declustering of detections arriving in time-ordered
+    batches. Detections within **trig_int** seconds of the previous detection
+    belong to the same event, which is represented by its detection with the
+    largest absolute **metric** ('avg_cor' or 'detect_val').
+    """
+    def __init__(self, trig_int, metric='avg_cor'):
+        self.trig_int = float(trig_int)
+        self.metric = metric
+        self.buffer = None
+
+    def push(self, df, safe_time=None):
+        """
+        Add a batch of detections. Events are only closed if they end more
+        than **trig_int** before **safe_time**, the earliest time of any later
+        batch (None closes all events).
+
+        :returns: closed events, with an 'ndetections' column
+        """
+        if self.buffer is not None and len(self.buffer) > 0:
+            df = pd.concat([self.buffer, df], ignore_index=True)
+        df = df.sort_values('detect_time', kind='stable', ignore_index=True)
+        times = df.detect_time.values
+        group = pd.Series(np.cumsum(np.diff(times, prepend=-np.inf) > self.trig_int), index=df.index)
+        if safe_time is None:
+            closed = np.ones(len(df), dtype=bool)
+        else:
+            closed = group.map(df.detect_time.groupby(group).max()).values < safe_time - self.trig_int
+        self.buffer = df[~closed]
+        df, group = df[closed], group[closed]
+        best = df[self.metric].abs().groupby(group).idxmax()
+        out = df.loc[best.values].copy()
+        out['ndetections'] = group.value_counts().reindex(best.index).values
+        return out.reset_index(drop=True)
+
+    def flush(self):
+        """Close and return all remaining events"""
+        df, self.buffer = self.buffer, None
+        return self.push(party_to_frame(Party()) if df is None else df, safe_time=None)
+
+
+def _init_worker(templates, meta, archive_root, process_kwargs, shift_len, min_cc, pad):
+    _WORKER.update({'templates': templates, 'meta': meta,
+                    'archive': None if archive_root is None else WaveformArchive(archive_root),
+                    'process_kwargs': process_kwargs, 'shift_len': shift_len,
+                    'min_cc': min_cc, 'pad': pad})
+
+
+def _align(template_data, data, nshift):
+    """Best normalized correlation and lag of a template trace within **data**"""
+    tlen = len(template_data)
+    windows = sliding_window_view(data, tlen)
+    _t = template_data - template_data.mean()
+    _w = windows - windows.mean(axis=1, keepdims=True)
+    denom = np.sqrt((_w**2).sum(axis=1)*(_t**2).sum())
+    denom[denom == 0] = np.inf
+    cc = (_w @ _t)/denom
+    _i = int(np.argmax(cc))
+    return cc[_i], _i - nshift, windows[_i].std()/max(template_data.std(), 1e-30)
+
+
+def _batch_window(events, templates, pad, shift_len):
+    """Seed IDs and time range of continuous data needed to measure a batch of events"""
+    names = events.template_name.unique()
+    seed_ids = sorted({tr.id for _n in names for tr in templates[_n].st})
+    t0 = UTCDateTime(events.detect_time.min()) - pad - shift_len
+    t1 = UTCDateTime(events.detect_time.max()) + pad + shift_len + max(
+        max(tr.stats.endtime for tr in templates[_n].st) - min(tr.stats.starttime for tr in templates[_n].st)
+        for _n in names)
+    return seed_ids, t0, t1
+
+
+def _measure_task(events):
+    """
+    Worker task: lag-calc and relative magnitudes for a time-ordered batch of
+    declustered detections
+    """
+    tic = time.perf_counter()
+    meta = _WORKER['meta']
+    events = events.copy()
+    events['npicks'] = 0
+    events['mag_chans'] = 0
+    events['MAG'] = np.nan
+    picks = []
+    archive = _WORKER['archive']
+    if archive is None or len(events) == 0:
+        return events, pd.DataFrame(columns=PICK_COLUMNS), time.perf_counter() - tic
+    templates = _WORKER['templates']
+    pad, shift_len = _WORKER['pad'], _WORKER['shift_len']
+    seed_ids, t0, t1 = _batch_window(events, templates, pad, shift_len)
+    st = Stream()
+    for _id in seed_ids:
+        st += archive.read(*_id.split('.'), starttime=t0, endtime=t1)
+    if len(st) == 0:
+        raise ValueError(f'no data in {archive.root} for {len(seed_ids)} channels from {t0} to {t1}')
+    kw = _WORKER['process_kwargs']
+    st = process_window(st, t0, t1, kw['lowcut'], kw['highcut'], kw['filt_order'], kw['samp_rate'])
+    data = {tr.id: tr for tr in st.split()}
+    for _i, row in events.iterrows():
+        template = templates[row.template_name]
+        ref = min(tr.stats.starttime for tr in template.st)
+        prepick = getattr(template, 'prepick', None) or 0.
+        ratios = []
+        for ttr in template.st:
+            tr = data.get(ttr.id)
+            if tr is None:
+                continue
+            sr = tr.stats.sampling_rate
+            nshift = int(round(shift_len*sr))
+            start = UTCDateTime(row.detect_time) + (ttr.stats.starttime - ref)
+            i0 = int(round((start - tr.stats.starttime)*sr)) - nshift
+            i1 = i0 + ttr.stats.npts + 2*nshift
+            if i0 < 0 or i1 > tr.stats.npts:
+                continue
+            cc, lag, ratio = _align(ttr.data.astype(np.float64), tr.data[i0:i1].astype(np.float64), nshift)
+            if cc < _WORKER['min_cc']:
+                continue
+            picks.append({'ID': row.ID, 'seed_id': ttr.id,
+                          'time': (start + lag/sr + prepick).timestamp,
+                          'cc': cc, 'amplitude_ratio': ratio})
+            ratios.append(ratio)
+        events.loc[_i, 'npicks'] = len(ratios)
+        ratios = np.array(ratios)
+        ratios = ratios[ratios > 0]
+        if len(ratios) > 0 and np.isfinite(meta.loc[row.template_name, 'MAG']):
+            events.loc[_i, 'MAG'] = meta.loc[row.template_name, 'MAG'] + np.median(np.log10(ratios))
+            events.loc[_i, 'mag_chans'] = len(ratios)
+    return events, pd.DataFrame(picks, columns=PICK_COLUMNS), time.perf_counter() - tic
+
+
+class DetectionCatalog(object):
+    """
+    Columnar (Parquet) detection catalog written in parts.
+
+    :param root: directory to host the catalog
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.events_dir = self.root / 'events'
+        self.picks_dir = self.root / 'picks'
+
+    def __repr__(self):
+        nparts = len(list(self.events_dir.glob('*.parquet'))) if self.events_dir.exists() else 0
+        return f'DetectionCatalog(root={self.root}, parts={nparts})'
+
+    def clear(self):
+        for _d in [self.events_dir, self.picks_dir]:
+            shutil.rmtree(_d, ignore_errors=True)
+        os.makedirs(str(self.events_dir), exist_ok=True)
+        os.makedirs(str(self.picks_dir), exist_ok=True)
+
+    def write_part(self, part, events, picks):
+        for df, _d in [(events, self.events_dir), (picks, self.picks_dir)]:
+            tmp = _d / f'{part}.tmp'
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, _d / f'{part}.parquet')
+
+    def _read(self, directory, columns=None):
+        files = sorted(directory.glob('*.parquet'))
+        if len(files) == 0:
+            return None
+        return pd.concat([pd.read_parquet(_f, columns=columns) for _f in files], ignore_index=True)
+
+    def read(self, columns=None, min_mag=None):
+        """
+        Read detection events as an event table indexed by detection ID and
+        sorted by origin time.
+
+        :param columns: optional subset of :data:`EVENT_COLUMNS` to read
+        :param min_mag: optional minimum magnitude
+        """
+        if columns is not None:
+            columns = list(dict.fromkeys(['ID', 'DATETIME'] + list(columns) + (['MAG'] if min_mag is not None else [])))
+        df = self._read(self.events_dir, columns=columns)
+        if df is None:
+            return pd.DataFrame(columns=EVENT_COLUMNS, index=pd.Index([], name='ID'))
+        if min_mag is not None:
+            df = df[df.MAG >= min_mag]
+        return df.set_index('ID').sort_values('DATETIME', kind='stable')
+
+    def read_picks(self):
+        df = self._read(self.picks_dir)
+        return pd.DataFrame(columns=PICK_COLUMNS) if df is None else df
+
+
+def read_detection_catalog(root, columns=None, min_mag=None):
+    """Shortcut for :meth:`~.DetectionCatalog.read`"""
+    return DetectionCatalog(root).read(columns=columns, min_mag=min_mag)
+
+
+def _chunk_parties(outdir):
+    """
+    Get (chunk_id, starttime, [party files]) for each chunk in a runner
+    output directory, sorted by time
+    """
+    with open(Path(outdir) / 'manifest.json', 'r') as _f:
+        manifest = json.load(_f)
+    chunks = {}
+    for key, entry in manifest['chunks'].items():
+        chunk_id = key.split('.')[0]
+        _c = chunks.setdefault(chunk_id, [UTCDateTime(entry['starttime']), []])
+        _c[0] = min(_c[0], UTCDateTime(entry['starttime']))
+        if entry.get('file'):
+            _c[1].append(Path(outdir) / 'parties' / entry['file'])
+    return [(_k, _v[0], sorted(_v[1])) for _k, _v in sorted(chunks.items(), key=lambda _i: _i[1][0])]
+
+
+class DetectionPostProcessor(object):
+    """
+    Decluster, lag-calc, and estimate magnitudes for matched-filter detections.
+
+    :param tribe: :class:`~eqcorrscan.Tribe` used for detection
+    :param catalog: :class:`~.DetectionCatalog` or directory for one
+    :param archive: optional :class:`~waveform_archive.WaveformArchive` with
+        the continuous data. Without it, picks and magnitudes are skipped.
+        If it has a client, data missing for a batch are fetched before the
+        batch is measured. A batch without any data raises a :class:`ValueError`.
+    :param trig_int: seconds between detections of separate events
+    :param metric: declustering metric, 'avg_cor' or 'detect_val'
+    :param shift_len: seconds each channel may shift in lag-calc
+    :param min_cc: minimum channel correlation for a pick
+    :param pad: seconds of data processed on either side of a batch and discarded
+    :param batch_size: maximum number of events per worker task
+    :param max_span: maximum seconds between the first and last detection of
+        a worker task, which bounds the data each task reads
+    :param n_workers: number of worker processes
+    """
+    def __init__(self, tribe, catalog, archive=None, trig_int=1., metric='avg_cor',
+                 shift_len=0.2, min_cc=0.4, pad=30., batch_size=500, max_span=900., n_workers=4):
+        self.tribe = tribe
+        self.catalog = catalog if isinstance(catalog, DetectionCatalog) else DetectionCatalog(catalog)
+        self.archive = archive
+        self.trig_int = float(trig_int)
+        self.metric = metric
+        self.shift_len = float(shift_len)
+        self.min_cc = float(min_cc)
+        self.pad = float(pad)
+        self.batch_size = int(batch_size)
+        self.max_span = float(max_span)
+        self.n_workers = int(n_workers)
+        self.meta = template_metadata(tribe)
+        template = tribe[0]
+        self.process_kwargs = {'lowcut': template.lowcut, 'highcut': template.highcut,
+                               'filt_order': template.filt_order, 'samp_rate': template.samp_rate}
+
+    def __repr__(self):
+        return (f'DetectionPostProcessor(templates={len(self.tribe)}, catalog={self.catalog.root}, '
+                f'trig_int={self.trig_int}, workers={self.n_workers})')
+
+    def _finish(self, events):
+        """Add template locations, magnitudes, and origin times to measured events"""
+        meta = self.meta.loc[events.template_name.values]
+        events['LAT'] = meta.LAT.values
+        events['LON'] = meta.LON.values
+        events['MZ'] = meta.MZ.values
+        events['MTYP'] = meta.MTYP.values
+        events['template_mag'] = meta.MAG.values
+        events['DATETIME'] = pd.to_datetime(events.detect_time + meta.origin_offset.values, unit='s')
+        events['detect_time'] = pd.to_datetime(events.detect_time, unit='s')
+        return events[['ID'] + EVENT_COLUMNS]
+
+    def batches(self, events):
+        """
+        Split time-sorted events into worker batches of at most **batch_size**
+        events spanning at most **max_span** seconds
+        """
+        times = events.detect_time.values
+        b0 = 0
+        for _i in range(1, len(events) + 1):
+            if _i == len(events) or _i - b0 >= self.batch_size or times[_i] - times[b0] > self.max_span:
+                yield events.iloc[b0:_i]
+                b0 = _i
+
+    def _fill(self, batch):
+        """Fetch continuous data missing from the archive for a batch"""
+        if self.archive is None or self.archive.client is None or len(batch) == 0:
+            return
+        seed_ids, t0, t1 = _batch_window(batch, self.templates, self.pad, self.shift_len)
+        for _id in seed_ids:
+            self.archive.update(*_id.split('.'), t0, t1)
+
+    def run(self, outdir):
+        """
+        Post-process every chunk Party in a runner output directory,
+        replacing the contents of the catalog.
+
+        :returns: dict with the number of 'detections' read, 'events' written,
+            'picks' made, and 'timings'
+        """
+        wall = time.perf_counter()
+        counts = {'detections': 0, 'events': 0, 'picks': 0}
+        timings = {'read': 0., 'measure': 0.}
+        self.catalog.clear()
+        chunks = _chunk_parties(outdir)
+        sweep = SweepDeclusterer(self.trig_int, metric=self.metric)
+        self.templates = {template.name: template for template in self.tribe}
+        initargs = (self.templates, self.meta,
+                    None if self.archive is None else str(self.archive.root),
+                    self.process_kwargs, self.shift_len, self.min_cc, self.pad)
+        parts = itertools.count()
+        with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            pending = {}
+
+            def collect(return_when):
+                done, _ = wait(list(pending.keys()), return_when=return_when)
+                for _f in done:
+                    part = pending.pop(_f)
+                    events, picks, elapsed = _f.result()
+                    timings['measure'] += elapsed
+                    self.catalog.write_part(part, self._finish(events), picks)
+                    counts['events'] += len(events)
+                    counts['picks'] += len(picks)
+
+            def submit(events):
+                for batch in self.batches(events):
+                    # Keep the number of batches in memory bounded
+                    while len(pending) >= 2*self.n_workers:
+                        collect(FIRST_COMPLETED)
+                    self._fill(batch)
+                    _f = executor.submit(_measure_task, batch)
+                    pending[_f] = f'{next(parts):06d}'
+
+            for _i, (chunk_id, _, files) in enumerate(chunks):
+                tic = time.perf_counter()
+                frames = [party_to_frame(Party().read(str(_f))) for _f in files]
+                df = pd.concat(frames, ignore_index=True) if len(frames) > 0 else party_to_frame(Party())
+                timings['read'] += time.perf_counter() - tic
+                counts['detections'] += len(df)
+                # Later chunks have no detections before their start time
+                safe = chunks[_i + 1][1].timestamp if _i + 1 < len(chunks) else None
+                events = sweep.push(df, safe_time=safe)
+                Logger.info(f'chunk {chunk_id}: {len(df)} detections, {len(events)} closed events')
+                submit(events)
+            submit(sweep.flush())
+            if len(pending) > 0:
+                collect(ALL_COMPLETED)
+        timings['wall'] = time.perf_counter() - wall
+        counts['timings'] = timings
+        Logger.info(f'detection post-processing: {counts}')
+        return counts
@@ -0,0 +1,274 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/match_filter_runner.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Resumable, checkpointed matched-filter detection over long time ranges.
+
+    :class:`~.MatchFilterRunner` splits a detection time range into chunks
+    aligned on multiples of **chunk_length** (e.g., UTC days or hours) and runs
+    :meth:`~eqcorrscan.Tribe.client_detect` on each chunk. Each chunk's
+    :class:`~eqcorrscan.Party` is written to disk as soon as the chunk finishes
+    and recorded in a JSON manifest, so a rerun skips completed chunks and only
+    redoes failed chunks and the (partial) chunk that was still open at the end
+    time of the last run. Chunks are extended by the templates' moveout plus
+    length so that detections near chunk ends are not missed, and
+    :meth:`~.merge_chunk_parties` merges chunk Parties and removes the
+    duplicate detections this overlap produces.
+
+    Output layout::
+
+        {outdir}/manifest.json                  -- run parameters and chunk status
+        {outdir}/parties/{YYYYmmddTHHMMSS}.tgz  -- chunk Parties
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from obspy import UTCDateTime
+
+from eqcorrscan import Party, Family
+
+Logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def chunk_windows(starttime, endtime, chunk_length=86400.):
+    """
+    Split a time range into chunks aligned on multiples of **chunk_length**
+    seconds. The first and last chunks are clipped to the range.
+
+    :returns: list of (chunk_id, chunk_start, chunk_end, starttime, endtime)
+        tuples, where chunk_start and chunk_end are the aligned chunk bounds
+    """
+    starttime, endtime = UTCDateTime(starttime), UTCDateTime(endtime)
+    windows = []
+    c0 = UTCDateTime(np.floor(starttime.timestamp/chunk_length)*chunk_length)
+    while c0 < endtime:
+        c1 = c0 + chunk_length
+        windows.append((c0.strftime('%Y%m%dT%H%M%S'), c0, c1, max(c0, starttime), min(c1, endtime)))
+        c0 = c1
+    return windows
+
+
+def template_overlap(tribe):
+    """Maximum template moveout plus template length in seconds"""
+    overlap = 0.
+    for template in tribe:
+        if len(template.st) == 0:
+            continue
+        t0 = min(tr.stats.starttime for tr in template.st)
+        t1 = max(tr.stats.endtime for tr in template.st)
+        overlap = max(overlap, t1 - t0)
+    return overlap
+
+
+def _tribe_hash(tribe):
+    """Hash of template names, so resumed runs use the same templates"""
+    names = sorted(template.name for template in tribe)
+    return hashlib.sha1('\n'.join(names).encode()).hexdigest()
+
+
+class MatchFilterRunner(object):
+    """
+    Run matched-filter detection in checkpointed chunks.
+
+    :param tribe: :class:`~eqcorrscan.Tribe` (or ClusteringTribe) of templates
+    :param client: waveform client with a `get_waveforms` method, e.g., a
+        :class:`~fetch_engine.ChunkedFetcher` or :class:`~waveform_archive.WaveformArchive`
+    :param outdir: output directory for chunk Parties and the manifest
+    :param chunk_length: chunk length in seconds, e.g., 86400. or 3600.
+    :param overlap: seconds each chunk is extended past its end. Defaults to
+        :meth:`~.template_overlap`
+    :param processor: optional :class:`~stream_processor.StreamProcessor`. If
+        given, each chunk's data are fetched and processed by it (carrying
+        filter state between consecutive chunks) and passed to
+        :meth:`~eqcorrscan.Tribe.detect` as pre-processed data, instead of
+        using :meth:`~eqcorrscan.Tribe.client_detect`
+    :param detect_kwargs: keyword arguments passed to
+        :meth:`~eqcorrscan.Tribe.client_detect` (threshold, threshold_type,
+        trig_int, ...). `return_stream` is always False.
+    """
+    def __init__(self, tribe, client, outdir, chunk_length=86400., overlap=None, processor=None,
+                 **detect_kwargs):
+        self.tribe = tribe
+        self.client = client
+        self.processor = processor
+        self.outdir = Path(outdir)
+        self.party_dir = self.outdir / 'parties'
+        self.manifest_file = self.outdir / 'manifest.json'
+        self.chunk_length = float(chunk_length)
+        self.overlap = template_overlap(tribe) if overlap is None else float(overlap)
+        detect_kwargs.pop('return_stream', None)
+        self.detect_kwargs = detect_kwargs
+        os.makedirs(str(self.party_dir), exist_ok=True)
+        self.manifest = self._load_manifest()
+
+    def __repr__(self):
+        ndone = sum(_c['status'] == 'done' for _c in self.manifest['chunks'].values())
+        return (f'MatchFilterRunner(outdir={self.outdir}, chunk_length={self.chunk_length}, '
+                f'templates={len(self.tribe)}, chunks done={ndone})')
+
+    def _parameters(self):
+        params = {'chunk_length': self.chunk_length, 'tribe': _tribe_hash(self.tribe)}
+        if self.processor is not None:
+            params['processor'] = self.processor.parameters()
+        for _k, _v in self.detect_kwargs.items():
+            params[_k] = _v if isinstance(_v, (int, float, str, bool, type(None))) else repr(_v)
+        return params
+
+    def _load_manifest(self):
+        params = self._parameters()
+        if self.manifest_file.exists():
+            with open(self.manifest_file, 'r') as _f:
+                manifest = json.load(_f)
+            if manifest.get('parameters') != params:
+                raise ValueError(
+                    f'{self.manifest_file} was written with different templates or parameters '
+                    f'({manifest.get("parameters")}), use a new output directory')
+            return manifest
+        return {'version': MANIFEST_VERSION, 'parameters': params, 'chunks': {}}
+
+    def _save_manifest(self):
+        tmp = str(self.manifest_file) + '.tmp'
+        with open(tmp, 'w') as _f:
+            json.dump(self.manifest, _f, indent=1, sort_keys=True)
+        os.replace(tmp, str(self.manifest_file))
+
+    def is_done(self, chunk_id):
+        entry = self.manifest['chunks'].get(chunk_id)
+        return entry is not None and entry['status'] == 'done'
+
+    def run_chunk(self, chunk_id, chunk_start, chunk_end, starttime, endtime):
+        """Detect in one chunk, write its Party, and record it in the manifest"""
+        tic = time.perf_counter()
+        entry = {'starttime': str(starttime), 'endtime': str(endtime)}
+        try:
+            if self.processor is None:
+                party = self.tribe.client_detect(
+                    client=self.client, starttime=starttime, endtime=endtime + self.overlap,
+                    return_stream=False, **self.detect_kwargs)
+            else:
+                party = self._processed_detect(starttime, endtime)
+        except Exception as e:
+            Logger.error(f'chunk {chunk_id} failed: {e}')
+            entry.update({'status': 'failed', 'error': repr(e),
+                          'elapsed': time.perf_counter() - tic})
+            self.manifest['chunks'][chunk_id] = entry
+            self._save_manifest()
+            return None
+        # Only keep families with detections
+        party.families = [_f for _f in party.families if len(_f) > 0]
+        ndet = sum(len(_f) for _f in party)
+        party_file = None
+        if ndet > 0:
+            party_file = self.party_dir / f'{chunk_id}.tgz'
+            tmp = self.party_dir / f'{chunk_id}.tmp.tgz'
+            party.write(str(tmp), format='tar', overwrite=True)
+            os.replace(str(tmp), str(party_file))
+            party_file = party_file.name
+        # Chunks that ended early (e.g., at the current time) are redone on rerun
+        entry.update({'status': 'done' if endtime >= chunk_end else 'partial',
+                      'ndetections': ndet, 'file': party_file,
+                      'elapsed': time.perf_counter() - tic})
+        self.manifest['chunks'][chunk_id] = entry
+        self._save_manifest()
+        Logger.info(f'chunk {chunk_id}: {ndet} detections in {entry["elapsed"]:.1f} s')
+        return party
+
+    def _processed_detect(self, starttime, endtime):
+        """Detect in data processed by :attr:`processor`"""
+        seed_ids = sorted({tr.id for template in self.tribe for tr in template.st})
+        st = self.processor.fetch_process(self.client, seed_ids, starttime, endtime,
+                                          extend=self.overlap)
+        return self.tribe.detect(stream=st, pre_processed=True, **self.detect_kwargs)
+
+    def run(self, starttime, endtime):
+        """
+        Run detection on every chunk between **starttime** and **endtime** that
+        is not already done.
+
+        :returns: dict of the number of chunks 'done', 'partial', 'failed' and
+            'skipped' (already done) in this run
+        """
+        counts = {'done': 0, 'partial': 0, 'failed': 0, 'skipped': 0}
+        windows = chunk_windows(starttime, endtime, self.chunk_length)
+        Logger.info(f'{len(windows)} chunks between {starttime} and {endtime}')
+        for window in windows:
+            chunk_id = window[0]
+            if self.is_done(chunk_id):
+                counts['skipped'] += 1
+                continue
+            self.run_chunk(*window)
+            counts[self.manifest['chunks'][chunk_id]['status']] += 1
+        Logger.info(f'matched filter run: {counts}')
+        return counts
+
+
+def dedup_party(party, tolerance):
+    """
+    Remove duplicate detections from each family of **party**, in place.
+    Detections of the same template within **tolerance** seconds of each other
+    are treated as one, keeping the one with the largest absolute detect_val.
+    """
+    for family in party:
+        if len(family) < 2:
+            continue
+        dets = sorted(family.detections, key=lambda _d: _d.detect_time)
+        times = np.array([_d.detect_time.timestamp for _d in dets])
+        # Start a new group wherever the gap to the previous detection exceeds the tolerance
+        groups = np.cumsum(np.r_[True, np.diff(times) > tolerance])
+        keep = []
+        for _g in np.unique(groups):
+            members = [dets[_i] for _i in np.flatnonzero(groups == _g)]
+            keep.append(max(members, key=lambda _d: abs(_d.detect_val)))
+        family.detections = keep
+    return party
+
+
+def merge_chunk_parties(outdir, tolerance=None, out_file=None):
+    """
+    Merge the chunk Parties of a :class:`~.MatchFilterRunner` output directory
+    and remove duplicate detections from overlapping chunks. The Parties of
+    every chunk with a party file in the manifest ('done' or 'partial') are
+    merged.
+
+    :param outdir: runner output directory
+    :param tolerance: seconds within which detections of the same template are
+        duplicates. Defaults to the run's trig_int.
+    :param out_file: optional path to write the merged Party to
+    :returns: merged :class:`~eqcorrscan.Party`
+    """
+    outdir = Path(outdir)
+    with open(outdir / 'manifest.json', 'r') as _f:
+        manifest = json.load(_f)
+    if tolerance is None:
+        tolerance = manifest['parameters'].get('trig_int', 1.)
+    files = sorted(str(outdir / 'parties' / _v['file']) for _v in manifest['chunks'].values()
+                   if _v.get('file'))
+    failed = [_k for _k, _v in manifest['chunks'].items() if _v['status'] == 'failed']
+    if len(failed) > 0:
+        Logger.warning(f'{len(failed)} chunks failed: {sorted(failed)}')
+    party = Party()
+    for _file in files:
+        for family in Party().read(_file):
+            match = [_f for _f in party if _f.template.name == family.template.name]
+            if len(match) > 0:
+                match[0].detections += family.detections
+            else:
+                party.families.append(Family(template=family.template, detections=family.detections))
+    ndet = sum(len(_f) for _f in party)
+    party = dedup_party(party, tolerance)
+    Logger.info(f'merged {len(files)} chunk parties: {ndet} detections, '
+                f'{ndet - sum(len(_f) for _f in party)} duplicates removed')
+    if out_file is not None:
+        party.write(str(out_file), format='tar', overwrite=True)
+    return party
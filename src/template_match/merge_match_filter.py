@@ -0,0 +1,23 @@
+import sys, logging
+from pathlib import Path
+
+from eqcutil.util.logging import setup_terminal_logger
+
+sys.path.append(str(Path(__file__).parent.parent))
+from match_filter_runner import merge_chunk_parties
+
+
+if __name__ == '__main__':
+    # Create logger
+    Logger = setup_terminal_logger(name='merge_match_filter', level=logging.INFO)
+
+    ROOT = Path(__file__).parent.parent.parent
+    # Output directory of run_match_filter.py
+    OUTDIR = ROOT / 'processed_data' / 'match_filter'
+    OUT_FILE = OUTDIR / 'party_merged.tgz'
+    # Detections of one template within this many seconds are duplicates.
+    # None uses the run's trig_int
+    TOLERANCE = None
+
+    party = merge_chunk_parties(OUTDIR, tolerance=TOLERANCE, out_file=OUT_FILE)
+    Logger.info(f'Wrote {party} to {OUT_FILE}')
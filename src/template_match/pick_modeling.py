@@ -0,0 +1,216 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/pick_modeling.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Batched modeling of phase arrival times for catalog events at
+    inventory channels.
+
+    Rather than running a travel-time calculation for every event x station,
+    :class:`~.TravelTimeTable` tabulates travel times for a velocity model and
+    phase list on a distance x source depth grid once and caches the table on
+    disk. :meth:`~.model_pick_table` then interpolates travel times for all
+    events x all inventory channels in one array operation and applies the
+    'earliest', 'latest', or 'all' pick preference across phases.
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator
+
+from obspy.geodetics import locations2degrees
+from obspy.taup import TauPyModel
+
+Logger = logging.getLogger(__name__)
+
+PICK_COLUMNS = ['evid', 'nslc', 'phase', 'time', 'dist_deg', 'travel_time']
+
+
+def load_velocity_model(name, cache_dir=None):
+    """
+    Load a :class:`~obspy.taup.TauPyModel` by name. Models that are not built
+    into ObsPy (e.g., PNSN's P4 model) are looked up among the model files
+    shipped with :mod:`eqcutil` and built with ObsPy's TauP model builder.
+
+    :param name: velocity model name
+    :param cache_dir: directory to build models into and reuse built models
+        from. If `None`, models are built in a temporary directory.
+    """
+    try:
+        return TauPyModel(model=name)
+    except FileNotFoundError:
+        pass
+    if cache_dir is not None:
+        for path in Path(cache_dir).glob('*.npz'):
+            if path.stem.lower() == name.lower():
+                return TauPyModel(model=str(path))
+    import eqcutil
+    from obspy.taup.taup_create import build_taup_model
+    pkg = Path(eqcutil.__file__).parent
+    for ext in ['npz', 'nd', 'tvel']:
+        for path in pkg.rglob(f'*.{ext}'):
+            if path.stem.lower() != name.lower():
+                continue
+            if ext == 'npz':
+                return TauPyModel(model=str(path))
+            # Build the TauP model outside of the (possibly read-only) package
+            if cache_dir is None:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    build_taup_model(str(path), output_folder=tmpdir)
+                    return TauPyModel(model=str(Path(tmpdir) / f'{path.stem}.npz'))
+            os.makedirs(str(cache_dir), exist_ok=True)
+            build_taup_model(str(path), output_folder=str(cache_dir))
+            return TauPyModel(model=str(Path(cache_dir) / f'{path.stem}.npz'))
+    raise FileNotFoundError(f'velocity model "{name}" not found in ObsPy or eqcutil')
+
+
+class TravelTimeTable(object):
+    """
+    Tabulated first-arrival travel times for each phase in **phases** on a
+    regular epicentral distance (degrees) x source depth (km) grid.
+
+    :param velocity_model: name of the velocity model, see :meth:`~.load_velocity_model`
+    :param phases: list of TauP phase names
+    :param max_dist_deg: maximum epicentral distance of the grid in degrees
+    :param dist_step: distance grid spacing in degrees
+    :param max_depth_km: maximum source depth of the grid in km
+    :param depth_step: depth grid spacing in km
+    :param cache_dir: directory for cached tables. If `None`, tables are not cached.
+    """
+    def __init__(self, velocity_model='P4', phases=['P', 'p'], max_dist_deg=2.,
+                 dist_step=0.01, max_depth_km=40., depth_step=1., cache_dir=None):
+        self.velocity_model = velocity_model
+        self.phases = list(phases)
+        self.distances = np.round(np.arange(0, max_dist_deg + dist_step/2, dist_step), 6)
+        self.depths = np.round(np.arange(0, max_depth_km + depth_step/2, depth_step), 6)
+        self.cache_dir = cache_dir
+        self.table = None
+        self._interpolators = None
+        self.load_or_build()
+
+    def __repr__(self):
+        return (f'TravelTimeTable(velocity_model={self.velocity_model}, phases={self.phases}, '
+                f'distances={self.distances[0]}-{self.distances[-1]} deg ({len(self.distances)}), '
+                f'depths={self.depths[0]}-{self.depths[-1]} km ({len(self.depths)}))')
+
+    @property
+    def cache_file(self):
+        """Cache file name, unique to the velocity model, phase list, and grid"""
+        if self.cache_dir is None:
+            return None
+        grid = hashlib.sha1(self.distances.tobytes() + self.depths.tobytes()).hexdigest()[:10]
+        return Path(self.cache_dir) / f'{self.velocity_model}_{"-".join(self.phases)}_{grid}.npz'
+
+    def load_or_build(self):
+        if self.cache_file is not None and self.cache_file.exists():
+            with np.load(self.cache_file) as npz:
+                self.table = npz['table']
+            Logger.info(f'loaded travel-time table {self.cache_file}')
+        else:
+            self.build()
+            if self.cache_file is not None:
+                os.makedirs(str(self.cache_dir), exist_ok=True)
+                np.savez_compressed(self.cache_file, table=self.table,
+                                    distances=self.distances, depths=self.depths)
+        self._interpolators = [
+            RegularGridInterpolator((self.depths, self.distances), self.table[_k],
+                                    bounds_error=False, fill_value=np.nan)
+            for _k in range(len(self.phases))]
+
+    def build(self):
+        """Calculate the table with TauP, with NaN where a phase does not arrive"""
+        Logger.info(f'building travel-time table for {self.velocity_model} {self.phases}')
+        model = load_velocity_model(self.velocity_model, cache_dir=self.cache_dir)
+        table = np.full((len(self.phases), len(self.depths), len(self.distances)), np.nan)
+        for _i, depth in enumerate(self.depths):
+            for _j, dist in enumerate(self.distances):
+                arrivals = model.get_travel_times(source_depth_in_km=depth,
+                                                  distance_in_degree=dist,
+                                                  phase_list=self.phases)
+                for arr in arrivals:
+                    _k = self.phases.index(arr.name)
+                    # Keep the first arrival of each phase
+                    if not arr.time >= table[_k, _i, _j]:
+                        table[_k, _i, _j] = arr.time
+        self.table = table
+
+    def __call__(self, dist_deg, depth_km):
+        """
+        Interpolate travel times for arrays of distances (degrees) and source
+        depths (km) with matching shapes. Returns an array with a leading
+        phase axis, with NaN where a phase has no arrival or is off the grid.
+        """
+        dist_deg, depth_km = np.broadcast_arrays(dist_deg, depth_km)
+        # Clip air-quakes to the surface
+        points = np.stack([np.clip(depth_km, 0, None).ravel(), dist_deg.ravel()], axis=-1)
+        return np.stack([_f(points).reshape(dist_deg.shape) for _f in self._interpolators])
+
+
+def inventory_channels(inv):
+    """
+    Get a table of unique channels in an :class:`~obspy.core.inventory.Inventory`
+    with 'nslc', 'latitude', 'longitude', and 'elevation' columns.
+    """
+    holder = []
+    for net in inv:
+        for sta in net:
+            for cha in sta:
+                holder.append([f'{net.code}.{sta.code}.{cha.location_code}.{cha.code}',
+                               cha.latitude, cha.longitude, cha.elevation])
+    df = pd.DataFrame(holder, columns=['nslc', 'latitude', 'longitude', 'elevation'])
+    return df.drop_duplicates(subset='nslc').reset_index(drop=True)
+
+
+def model_pick_table(df, inv, ttable, pick_preference='earliest'):
+    """
+    Model phase arrival times for all events in an event table at all channels
+    in an inventory in one array operation.
+
+    :param df: event table indexed by event ID with LAT, LON, MZ (km), and
+        DATETIME columns
+    :param inv: :class:`~obspy.core.inventory.Inventory` with channel-level
+        metadata, or a table from :meth:`~.inventory_channels`
+    :param ttable: :class:`~.TravelTimeTable`
+    :param pick_preference: 'earliest' or 'latest' keeps one pick per event and
+        channel across **ttable**'s phases, 'all' (or `None`) keeps every phase
+
+    :returns: :class:`~pandas.DataFrame` with one row per pick and 'evid',
+        'nslc', 'phase', 'time' (datetime64), 'dist_deg', and 'travel_time'
+        (seconds) columns, sorted by event and channel
+    """
+    if pick_preference not in ['earliest', 'latest', 'all', None]:
+        raise ValueError(f'pick_preference "{pick_preference}" not supported')
+    chans = inv if isinstance(inv, pd.DataFrame) else inventory_channels(inv)
+    if len(df) == 0 or len(chans) == 0:
+        return pd.DataFrame(columns=PICK_COLUMNS)
+    # (event, channel) distances and (phase, event, channel) travel times
+    dist = locations2degrees(df.LAT.values[:, None], df.LON.values[:, None],
+                             chans.latitude.values[None, :], chans.longitude.values[None, :])
+    depth = np.broadcast_to(df.MZ.values[:, None], dist.shape)
+    tt = ttable(dist, depth)
+    phases = np.array(ttable.phases, dtype=object)
+    iev, ich = np.meshgrid(np.arange(len(df)), np.arange(len(chans)), indexing='ij')
+    if pick_preference in ['earliest', 'latest']:
+        valid = ~np.all(np.isnan(tt), axis=0)
+        filled = np.where(np.isnan(tt), np.inf if pick_preference == 'earliest' else -np.inf, tt)
+        kph = np.argmin(filled, axis=0) if pick_preference == 'earliest' else np.argmax(filled, axis=0)
+        kph, iev, ich = kph[valid], iev[valid], ich[valid]
+    else:
+        valid = ~np.isnan(tt)
+        kph, iev, ich = np.nonzero(valid)
+    tsec = tt[kph, iev, ich]
+    picks = pd.DataFrame({
+        'evid': df.index.values[iev],
+        'nslc': chans.nslc.values[ich],
+        'phase': phases[kph],
+        'time': df.DATETIME.values[iev] + pd.to_timedelta(tsec, unit='s').values,
+        'dist_deg': dist[iev, ich],
+        'travel_time': tsec})
+    return picks.sort_values(['evid', 'nslc', 'time'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,281 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/rolling_detector.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Rolling (near real-time) matched-filter detection for an active
+    sequence.
+
+    :class:`~.RollingDetector` polls a waveform client for data that arrived
+    since its last step, processes the new samples plus a short overlap with
+    the templates' processing parameters, and correlates them with
+    :meth:`~eqcorrscan.Tribe.detect` (`pre_processed=True`). The overlap is
+    the templates' moveout plus length, so every correlation position is
+    covered exactly once across steps. Positions are tracked with a cursor:
+    the time up to which correlation is complete. New detections are appended
+    to a :class:`~.DetectionStore` along with the cursor, so a restarted
+    service continues where it stopped rather than at the sequence start.
+
+    Detections are declustered across steps with **trig_int** (see
+    :class:`~detection_catalog.SweepDeclusterer`): detections within
+    **trig_int** of the cursor are held back and declustered with the next
+    step's detections. A step's detections, the cursor, and the held-back
+    detections are committed together, so a restart neither loses nor
+    repeats a step.
+
+    MAD thresholds are computed per step, so steps (**min_step**) should span
+    at least a few minutes of data for stable thresholds.
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from obspy import Stream, UTCDateTime
+
+from eqcorrscan.utils.pre_processing import multi_process
+
+from detection_catalog import SweepDeclusterer
+from match_filter_runner import template_overlap
+
+Logger = logging.getLogger(__name__)
+
+DETECTION_COLUMNS = ['template_name', 'detect_time', 'detect_val', 'threshold',
+                     'threshold_type', 'threshold_input', 'no_chans', 'typeofdet',
+                     'chans', 'id']
+
+
+def detection_frame(detections):
+    """
+    Get :class:`~eqcorrscan.Detection` objects as rows of
+    :data:`DETECTION_COLUMNS`, with 'detect_time' in POSIX seconds
+    """
+    return pd.DataFrame([{
+        'template_name': _d.template_name,
+        'detect_time': _d.detect_time.timestamp,
+        'detect_val': _d.detect_val,
+        'threshold': _d.threshold,
+        'threshold_type': _d.threshold_type,
+        'threshold_input': _d.threshold_input,
+        'no_chans': _d.no_chans,
+        'typeofdet': _d.typeofdet,
+        'chans': ';'.join('.'.join(_c) if isinstance(_c, tuple) else str(_c) for _c in _d.chans or []),
+        'id': _d.id} for _d in detections], columns=DETECTION_COLUMNS)
+
+
+class DetectionStore(object):
+    """
+    Append-only CSV store of detections with the detector's state.
+
+    Layout::
+
+        {root}/detections.csv   -- one row per detection, see DETECTION_COLUMNS
+        {root}/state.json       -- detector cursor, parameters, and committed
+                                   size of detections.csv
+
+    Rows are appended before the state is replaced, and the state records the
+    size of the detections file it commits. Rows past that size (from a step
+    interrupted before its state was saved) are truncated when the store is
+    opened, so rows and state always agree.
+
+    :param root: directory to host the store
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        self.detections_file = self.root / 'detections.csv'
+        self.state_file = self.root / 'state.json'
+        os.makedirs(str(self.root), exist_ok=True)
+        self._recover()
+
+    def __repr__(self):
+        return f'DetectionStore(root={self.root}, state={self.state})'
+
+    @property
+    def state(self):
+        if not self.state_file.exists():
+            return {}
+        with open(self.state_file, 'r') as _f:
+            return json.load(_f)
+
+    def save_state(self, **state):
+        tmp = self.state_file.with_suffix('.tmp')
+        with open(tmp, 'w') as _f:
+            json.dump(state, _f, indent=1)
+        os.replace(tmp, self.state_file)
+
+    def _recover(self):
+        """Drop rows appended after the last saved state"""
+        size = self.state.get('size')
+        if size is None or not self.detections_file.exists():
+            return
+        if self.detections_file.stat().st_size > size:
+            Logger.warning(f'dropping detections appended after the last saved state in {self.root}')
+            with open(self.detections_file, 'r+b') as _f:
+                _f.truncate(size)
+
+    def commit(self, df, **state):
+        """
+        Append rows of detections (see :meth:`~.detection_frame`) and then
+        save **state** with the new size of the detections file.
+        Returns the number of rows appended.
+        """
+        if len(df) > 0:
+            df = df[DETECTION_COLUMNS].copy()
+            df['detect_time'] = [str(UTCDateTime(_t)) for _t in df.detect_time]
+            with open(self.detections_file, 'a') as _f:
+                df.to_csv(_f, index=False, header=_f.tell() == 0)
+                _f.flush()
+                os.fsync(_f.fileno())
+        size = self.detections_file.stat().st_size if self.detections_file.exists() else 0
+        self.save_state(size=size, **state)
+        return len(df)
+
+    def read(self):
+        """Read all stored detections as a :class:`~pandas.DataFrame`"""
+        if not self.detections_file.exists():
+            return pd.DataFrame(columns=DETECTION_COLUMNS)
+        df = pd.read_csv(self.detections_file)
+        df['detect_time'] = pd.to_datetime(df.detect_time, format='ISO8601').dt.tz_localize(None)
+        return df
+
+
+class RollingDetector(object):
+    """
+    Rolling matched-filter detection service.
+
+    :param tribe: :class:`~eqcorrscan.Tribe` (or ClusteringTribe) of templates
+        sharing one set of processing parameters
+    :param client: waveform client with a `get_waveforms` method. If it has a
+        `now` method (e.g., :class:`~fake_clients.ReplayClient`) that is used
+        as the clock, otherwise the system clock.
+    :param store: :class:`~.DetectionStore` or directory for one
+    :param starttime: cursor for a new store. Defaults to the current time.
+    :param settle: seconds behind the clock that data are assumed complete
+    :param min_step: minimum seconds of new data before correlating
+    :param max_step: maximum seconds of data correlated in one step, so that
+        catching up after a pause is done in bounded pieces
+    :param pad: seconds of extra data processed before each step and then
+        discarded, to keep filter start-up transients out of the correlation
+    :param detect_kwargs: keyword arguments for :meth:`~eqcorrscan.Tribe.detect`
+        (threshold, threshold_type, trig_int, ...)
+    """
+    def __init__(self, tribe, client, store, starttime=None, settle=30., min_step=300.,
+                 max_step=3600., pad=30., **detect_kwargs):
+        self.tribe = tribe
+        self.client = client
+        self.store = store if isinstance(store, DetectionStore) else DetectionStore(store)
+        self.settle = float(settle)
+        self.min_step = float(min_step)
+        self.max_step = float(max_step)
+        self.pad = float(pad)
+        self.overlap = template_overlap(tribe)
+        self.detect_kwargs = detect_kwargs
+        template = tribe[0]
+        self.process_kwargs = {'lowcut': template.lowcut, 'highcut': template.highcut,
+                               'filt_order': template.filt_order, 'samp_rate': template.samp_rate}
+        self.seed_ids = sorted({tr.id for template in tribe for tr in template.st})
+        state = self.store.state
+        if 'cursor' in state:
+            self.cursor = UTCDateTime(state['cursor'])
+            Logger.info(f'resuming at {self.cursor}')
+        else:
+            self.cursor = self.now() if starttime is None else UTCDateTime(starttime)
+        # Detections near the cursor, declustered with the next step's detections
+        self.sweep = SweepDeclusterer(detect_kwargs.get('trig_int') or 0., metric='avg_cor')
+        if state.get('tail'):
+            self.sweep.buffer = pd.DataFrame(state['tail'])
+        self.nsteps = 0
+        self.ndetections = 0
+
+    def __repr__(self):
+        return (f'RollingDetector(templates={len(self.tribe)}, channels={len(self.seed_ids)}, '
+                f'cursor={self.cursor}, latency={self.latency():.1f} s, detections={self.ndetections})')
+
+    def now(self):
+        return self.client.now() if hasattr(self.client, 'now') else UTCDateTime()
+
+    def latency(self):
+        """Seconds between the clock and the detection cursor"""
+        return self.now() - self.cursor
+
+    def _fetch(self, starttime, endtime):
+        bulk = [tuple(_id.split('.')) + (starttime, endtime) for _id in self.seed_ids]
+        if hasattr(self.client, 'get_waveforms_bulk'):
+            return self.client.get_waveforms_bulk(bulk)
+        st = Stream()
+        for _b in bulk:
+            try:
+                st += self.client.get_waveforms(*_b)
+            except Exception as e:
+                Logger.warning(f'no data for {".".join(_b[:4])}: {e}')
+        return st
+
+    def step(self):
+        """
+        Correlate data that arrived since the last step, if there is at least
+        **min_step** seconds of it beyond the overlap. Returns the number of
+        new detections, or `None` if there was not enough new data.
+        """
+        horizon = self.now() - self.settle
+        if horizon - self.cursor < self.min_step + self.overlap:
+            return None
+        # Correlation positions from the cursor need overlap seconds of data after them
+        t0 = self.cursor
+        t1 = min(horizon, self.cursor + self.max_step) + self.overlap
+        t1 = min(t1, horizon)
+        st = self._fetch(t0 - self.pad, t1)
+        st.merge()
+        if len(st) == 0:
+            Logger.warning(f'no data between {t0} and {t1}')
+            return None
+        st = multi_process(st, parallel=False, starttime=t0 - self.pad, endtime=t1,
+                           ignore_length=True, ignore_bad_data=True, **self.process_kwargs)
+        st.trim(t0, t1)
+        st.traces = [tr for tr in st if tr.stats.npts > 0]
+        if len(st) == 0:
+            return None
+        party = self.tribe.detect(stream=st, pre_processed=True, **self.detect_kwargs)
+        # Positions past t1 - overlap are correlated in the next step
+        new_cursor = t1 - self.overlap
+        df = detection_frame([_d for _f in party for _d in _f
+                              if self.cursor <= _d.detect_time < new_cursor])
+        df['avg_cor'] = (df.detect_val/df.no_chans.clip(lower=1)).astype(float)
+        # Later steps have no detections before the new cursor
+        df = self.sweep.push(df, safe_time=new_cursor.timestamp).drop(columns=['avg_cor', 'ndetections'])
+        tail = self.sweep.buffer.replace({np.nan: None}).to_dict(orient='records')
+        nnew = self.store.commit(df, cursor=str(new_cursor), updated=str(self.now()),
+                                 templates=len(self.tribe), tail=tail)
+        self.cursor = new_cursor
+        self.nsteps += 1
+        self.ndetections += nnew
+        Logger.info(f'{t0} - {new_cursor}: {nnew} new detections, latency {self.latency():.1f} s')
+        return nnew
+
+    def run(self, poll_interval=10., endtime=None, max_steps=None):
+        """
+        Poll for new data every **poll_interval** seconds (of the client's
+        clock) until the cursor passes **endtime** or **max_steps** steps have
+        run. Runs until interrupted if both are `None`.
+        """
+        sleep = getattr(self.client, 'sleep', time.sleep)
+        nsteps = 0
+        try:
+            while True:
+                if endtime is not None and self.cursor >= UTCDateTime(endtime):
+                    break
+                if max_steps is not None and nsteps >= max_steps:
+                    break
+                if self.step() is None:
+                    sleep(poll_interval)
+                else:
+                    nsteps += 1
+        except KeyboardInterrupt:
+            Logger.info('stopped by user')
+        Logger.info(f'{self}')
+        return self.ndetections
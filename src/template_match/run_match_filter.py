@@ -1,4 +1,4 @@
-import os, logging
+import os, sys, logging
 from pathlib import Path
 
 from obspy import UTCDateTime
@@ -7,13 +7,31 @@ from obspy.clients.fdsn import Client
 from eqcutil import ClusteringTribe
 from eqcutil.util.logging import setup_terminal_logger
 
+sys.path.append(str(Path(__file__).parent.parent))
+from fetch_engine import ChunkedFetcher
+from match_filter_runner import MatchFilterRunner, merge_chunk_parties
+from sharded_match_filter import ShardedMatchFilter
+from stream_processor import StreamProcessor
+from template_selection import read_subset
+from detection_catalog import DetectionPostProcessor
+from waveform_archive import WaveformArchive
+
 
 if __name__ == '__main__':
     # Create logger
     Logger = setup_terminal_logger(name='run_match_filter', level=logging.INFO)
 
     ROOT = Path(__file__).parent.parent.parent
-    CTR_FILE = ROOT / 'processed_data' / 'templates' / 'templates_for_match_filter.tgz'
+    # Index of the selected templates in the whole clustering tribe
+    CTR_INDEX = ROOT / 'processed_data' / 'templates' / 'templates_for_match_filter.json'
+    # Checkpointed chunk Parties and run manifest
+    OUTDIR = ROOT / 'processed_data' / 'match_filter'
+    # Local waveform archive for sharded runs and detection post-processing
+    WAVEPATH = ROOT / 'data' / 'waveforms'
+    # Cached tribe and template spectra shared by runs and workers
+    SPECTRA_DIR = ROOT / 'processed_data' / 'template_spectra'
+    # Columnar catalog of declustered detections with picks and magnitudes
+    DETECTION_CATALOG = ROOT / 'processed_data' / 'detection_catalog'
 
     ## TEMPLATE MATCH PARAMETERIZATION SECTION ##
     T0 = UTCDateTime('2025-02-01T00:00:00')
@@ -21,40 +39,77 @@ if __name__ == '__main__':
     THRESH_TYPE = 'MAD'
     THRESH = 8.     # From Shelly & Beroza (2007)
     TRIG_INT = 1.   # 1 second gap between detections minimum
-    DAYLONG = False  # Processing 24 hour chunks?
+    RUN_CHUNK = 86400.  # Length of checkpointed detection chunks in seconds
     PARPROC = True  # Processing in parallel
     SAVEPROGRESS = True
     NCORES = 12       
-    RETURN_STREAM = True
+    CHUNK_LENGTH = 3600.    # Length of concurrent waveform requests in seconds
+    FETCH_WORKERS = 4       # Number of concurrent waveform requests
+    # Shard template groups x time chunks over a process pool. Off until a recorded
+    # run (manifest 'runs') shows how it scales with NWORKERS
+    SHARDED = False
+    STREAMED = True         # Unsharded runs: process chunks with filter state carried between them
+    STREAM_PAD = 60.        # Seconds of filter warm-up / zero-phase look-ahead data
+    NWORKERS = 12           # Number of worker processes for sharded runs
+    GROUP_SIZE = 20         # Number of templates per sharded task
+    MERGE_PARTY = False     # Also merge all chunk parties into one Party file (in memory)
+    LAG_SHIFT = 0.2         # Seconds each channel may shift when making picks
+    LAG_MIN_CC = 0.4        # Minimum channel correlation for a pick
 
     ## PROCESSING SECTION ##
 
     # Connect to client
     IRIS = Client('IRIS')
+    # Wrap client to fetch data in concurrent, retried chunks
+    CLIENT = ChunkedFetcher(IRIS, chunk_length=CHUNK_LENGTH, max_workers=FETCH_WORKERS)
     Logger.info(f'Connected to client')
+    # Local archive in front of IRIS, so only missing data are downloaded
+    ARCHIVE = WaveformArchive(WAVEPATH, client=IRIS, chunk_length=CHUNK_LENGTH,
+                              max_workers=FETCH_WORKERS)
     # Load templates
-    ctr = ClusteringTribe().read(str(CTR_FILE))
+    ctr = read_subset(CTR_INDEX, cache_root=SPECTRA_DIR, tribe_class=ClusteringTribe)
     Logger.info(f'Loaded {len(ctr)} templates')
-    # Run template matching
-    outs = ctr.client_detect(
-        client = IRIS,
-        starttime = T0,
-        endtime = T1,
-        threshold = THRESH,
-        threshold_type = THRESH_TYPE,
+    # Run template matching in checkpointed chunks, skipping chunks done by earlier runs
+    if SHARDED:
+        runner = ShardedMatchFilter(
+            ctr, ARCHIVE, OUTDIR,
+            chunk_length = RUN_CHUNK,
+            group_size = GROUP_SIZE,
+            n_workers = NWORKERS,
+            spectra_root = SPECTRA_DIR,
+            threshold = THRESH,
+            threshold_type = THRESH_TYPE,
+            trig_int = TRIG_INT
+        )
+    else:
+        # Memory-bounded processing with reused per-channel buffers
+        PROCESSOR = StreamProcessor.from_template(ctr[0], pad=STREAM_PAD) if STREAMED else None
+        runner = MatchFilterRunner(
+            ctr, CLIENT, OUTDIR,
+            chunk_length = RUN_CHUNK,
+            processor = PROCESSOR,
+            threshold = THRESH,
+            threshold_type = THRESH_TYPE,
+            trig_int = TRIG_INT,
+            concurrent_processing=False,
+            parallel_process=PARPROC,
+            save_progress=SAVEPROGRESS,
+            process_cores=NCORES
+        )
+    Logger.info(f'{runner}')
+    counts = runner.run(T0, T1)
+    # Merge chunk parties & remove duplicate detections from chunk overlaps
+    if MERGE_PARTY:
+        party = merge_chunk_parties(OUTDIR, out_file=OUTDIR / 'party_merged.tgz')
+    # Decluster detections, make picks & relative magnitudes, and write the detection catalog.
+    # Unsharded runs read through CLIENT, so the archive fetches each batch's data as needed.
+    post = DetectionPostProcessor(
+        ctr, DETECTION_CATALOG,
+        archive = ARCHIVE,
         trig_int = TRIG_INT,
-        daylong = DAYLONG,
-        concurrent_processing=False,
-        parallel_process=PARPROC,
-        save_progress=SAVEPROGRESS,
-        process_cores=NCORES,
-        return_stream=RETURN_STREAM
+        shift_len = LAG_SHIFT,
+        min_cc = LAG_MIN_CC,
+        n_workers = NWORKERS
     )
-
-    if RETURN_STREAM:
-        party, full_st = outs
-
-    else:
-        party = outs
-     
-    
+    Logger.info(f'{post}')
+    post.run(OUTDIR)
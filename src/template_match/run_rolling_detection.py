@@ -0,0 +1,70 @@
+import sys, logging
+from pathlib import Path
+
+from obspy import UTCDateTime
+from obspy.clients.fdsn import Client
+
+from eqcutil import ClusteringTribe
+from eqcutil.util.logging import setup_terminal_logger
+
+sys.path.append(str(Path(__file__).parent.parent))
+from fetch_engine import ChunkedFetcher
+from fake_clients import ReplayClient
+from waveform_archive import WaveformArchive
+from rolling_detector import RollingDetector
+from template_selection import read_subset
+
+
+if __name__ == '__main__':
+    # Create logger
+    Logger = setup_terminal_logger(name='run_rolling_detection', level=logging.INFO)
+
+    ROOT = Path(__file__).parent.parent.parent
+    # Index of the selected templates in the whole clustering tribe
+    CTR_INDEX = ROOT / 'processed_data' / 'templates' / 'templates_for_match_filter.json'
+    # Persistent detection store (detections.csv & detector state)
+    STORE = ROOT / 'processed_data' / 'rolling_detections'
+    # Local waveform archive, replayed in REPLAY mode
+    WAVEPATH = ROOT / 'data' / 'waveforms'
+
+    ## ROLLING DETECTION PARAMETERIZATION SECTION ##
+    THRESH_TYPE = 'MAD'
+    THRESH = 8.     # From Shelly & Beroza (2007)
+    TRIG_INT = 1.   # 1 second gap between detections minimum
+    SETTLE = 60.    # Seconds behind real time that data are assumed complete
+    MIN_STEP = 300. # Minimum seconds of new data per correlation step
+    POLL = 15.      # Seconds between polls for new data
+    # Start of detection for a new store (ignored when resuming)
+    T0 = UTCDateTime() - 3600.
+
+    # Replay archived data at high speed instead of running in real time
+    REPLAY = False
+    REPLAY_T0 = UTCDateTime('2025-03-03T12:00:00')
+    REPLAY_T1 = UTCDateTime('2025-03-03T18:00:00')
+    REPLAY_SPEED = 60.
+    if REPLAY:
+        STORE = ROOT / 'processed_data' / 'rolling_detections_replay'
+        T0 = REPLAY_T0
+
+    ## PROCESSING SECTION ##
+    if REPLAY:
+        CLIENT = ReplayClient(WaveformArchive(WAVEPATH), starttime=REPLAY_T0, speed=REPLAY_SPEED)
+    else:
+        CLIENT = ChunkedFetcher(Client('IRIS'), chunk_length=3600., max_workers=4)
+    Logger.info(f'Connected to client')
+    # Load templates
+    ctr = read_subset(CTR_INDEX, tribe_class=ClusteringTribe)
+    Logger.info(f'Loaded {len(ctr)} templates')
+
+    detector = RollingDetector(
+        ctr, CLIENT, STORE,
+        starttime = T0,
+        settle = SETTLE,
+        min_step = MIN_STEP,
+        threshold = THRESH,
+        threshold_type = THRESH_TYPE,
+        trig_int = TRIG_INT
+    )
+    Logger.info(f'{detector}')
+    # Run until interrupted (or until the end of the replay)
+    detector.run(poll_interval=POLL, endtime=REPLAY_T1 if REPLAY else None)
@@ -0,0 +1,286 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/sharded_match_filter.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Multi-process matched-filter scheduler that shards work over
+    template groups x time chunks.
+
+    :class:`~.ShardedMatchFilter` extends :class:`~match_filter_runner.MatchFilterRunner`
+    (same chunking, manifest, and chunk Party files) with a process pool:
+
+        1. The main process fills a :class:`~waveform_archive.WaveformArchive`
+           for each time chunk, one chunk ahead of the workers.
+        2. A worker pre-processes each chunk once with the templates'
+           processing parameters and saves it to `{outdir}/processed/`.
+        3. Each (chunk, template group) pair is then a correlation task, run
+           with :meth:`~eqcorrscan.Tribe.detect` (`pre_processed=True`) and
+           single-threaded correlations so that parallelism comes from the
+           pool. Task Parties are written to `{outdir}/parties/` and merged
+           with :meth:`~match_filter_runner.merge_chunk_parties`.
+
+    Workers receive the tribe once, when they start, and keep the most
+    recently read processed chunks in memory, so consecutive tasks on the same
+    chunk only differ in their templates. Tasks are queued chunk-major to make
+    that the common case. Template FFTs are not kept warm between tasks: without
+    a **spectra_root**, every task recomputes its templates' spectra. With a
+    **spectra_root**, template spectra are computed once in the main process
+    (:class:`~template_spectra.TemplateSpectra`) and memory-mapped by every
+    worker.
+
+    Each task's worker time and worker process id, and each run's worker
+    count and per-stage timings (under 'runs'), are recorded in the manifest.
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from obspy import Stream, UTCDateTime, read
+
+from eqcorrscan import Tribe
+
+from match_filter_runner import MatchFilterRunner, chunk_windows
+from template_builder import process_window
+from template_spectra import TemplateSpectra, fft_length
+from waveform_archive import WaveformArchive
+
+Logger = logging.getLogger(__name__)
+
+# Per-process worker state, set by _init_worker
+_WORKER = {}
+
+
+def group_templates(tribe, group_size):
+    """Split a tribe into lists of templates of at most **group_size**, sorted by name"""
+    templates = sorted(tribe.templates, key=lambda _t: _t.name)
+    return [templates[_i:_i + group_size] for _i in range(0, len(templates), group_size)]
+
+
+def _init_worker(groups, archive_root, processed_dir, process_kwargs, cache_size,
+                 spectra_path=None):
+    if spectra_path is not None:
+        TemplateSpectra(spectra_path).activate()
+    _WORKER.update({
+        'groups': [Tribe(templates=_g) for _g in groups],
+        'seed_ids': sorted({tr.id for _g in groups for _t in _g for tr in _t.st}),
+        'archive': WaveformArchive(archive_root),
+        'processed_dir': Path(processed_dir),
+        'process_kwargs': process_kwargs,
+        'cache': OrderedDict(),
+        'cache_size': cache_size})
+
+
+def _processed_file(processed_dir, chunk_id):
+    return Path(processed_dir) / f'{chunk_id}.mseed'
+
+
+def _process_task(chunk_id, starttime, endtime, pad):
+    """Worker task: pre-process one chunk of archived data and save it"""
+    tic = time.perf_counter()
+    archive = _WORKER['archive']
+    st = Stream()
+    for _id in _WORKER['seed_ids']:
+        st += archive.read(*_id.split('.'), starttime=starttime - pad, endtime=endtime)
+    kw = _WORKER['process_kwargs']
+    st = process_window(st, starttime - pad, endtime, kw['lowcut'], kw['highcut'],
+                        kw['filt_order'], kw['samp_rate'])
+    st.trim(starttime, endtime)
+    path = _processed_file(_WORKER['processed_dir'], chunk_id)
+    if len(st) > 0:
+        tmp = path.with_suffix('.tmp')
+        # Any remaining gaps are written as separate records
+        st.split().write(str(tmp), format='MSEED')
+        os.replace(tmp, path)
+    return chunk_id, len(st), time.perf_counter() - tic
+
+
+def _load_processed(chunk_id):
+    """Read a processed chunk, keeping the most recent chunks in memory"""
+    cache = _WORKER['cache']
+    if chunk_id in cache:
+        cache.move_to_end(chunk_id)
+        return cache[chunk_id]
+    path = _processed_file(_WORKER['processed_dir'], chunk_id)
+    st = read(str(path)) if path.exists() else Stream()
+    cache[chunk_id] = st
+    while len(cache) > _WORKER['cache_size']:
+        cache.popitem(last=False)
+    return st
+
+
+def _detect_task(chunk_id, igroup, party_file, detect_kwargs):
+    """Worker task: correlate one template group with one processed chunk"""
+    tic = time.perf_counter()
+    st = _load_processed(chunk_id)
+    tribe = _WORKER['groups'][igroup]
+    ndet = 0
+    if len(st) > 0 and len({tr.id for tr in st} & {tr.id for _t in tribe for tr in _t.st}) > 0:
+        party = tribe.detect(stream=st.copy(), pre_processed=True, **detect_kwargs)
+        party.families = [_f for _f in party.families if len(_f) > 0]
+        ndet = sum(len(_f) for _f in party)
+        if ndet > 0:
+            tmp = str(party_file).replace('.tgz', '.tmp.tgz')
+            party.write(tmp, format='tar', overwrite=True)
+            os.replace(tmp, str(party_file))
+    return chunk_id, igroup, ndet, time.perf_counter() - tic, os.getpid()
+
+
+class ShardedMatchFilter(MatchFilterRunner):
+    """
+    Matched-filter detection sharded over template groups x time chunks on a
+    process pool.
+
+    :param tribe: :class:`~eqcorrscan.Tribe` of templates sharing one set of
+        processing parameters
+    :param archive: :class:`~waveform_archive.WaveformArchive` to fill from its
+        client and read continuous data from
+    :param outdir: output directory, see :class:`~match_filter_runner.MatchFilterRunner`
+    :param chunk_length: time chunk length in seconds
+    :param group_size: number of templates per task
+    :param n_workers: number of worker processes
+    :param pad: seconds of data processed before each chunk and discarded
+    :param cache_size: number of processed chunks each worker keeps in memory
+    :param spectra_root: optional directory for cached template spectra. If
+        given, correlations use the 'cached_fft' backend.
+    :param detect_kwargs: keyword arguments for :meth:`~eqcorrscan.Tribe.detect`
+        (threshold, threshold_type, trig_int, ...)
+    """
+    def __init__(self, tribe, archive, outdir, chunk_length=86400., group_size=20,
+                 n_workers=4, pad=60., cache_size=2, overlap=None, spectra_root=None,
+                 **detect_kwargs):
+        self.group_size = int(group_size)
+        detect_kwargs.setdefault('parallel_process', False)
+        detect_kwargs.setdefault('cores', 1)
+        if spectra_root is not None:
+            detect_kwargs.setdefault('xcorr_func', 'cached_fft')
+        super().__init__(tribe, archive, outdir, chunk_length=chunk_length, overlap=overlap,
+                         **detect_kwargs)
+        self.archive = archive
+        self.n_workers = int(n_workers)
+        self.pad = float(pad)
+        self.cache_size = int(cache_size)
+        self.processed_dir = self.outdir / 'processed'
+        os.makedirs(str(self.processed_dir), exist_ok=True)
+        self.groups = group_templates(tribe, self.group_size)
+        self.seed_ids = sorted({tr.id for template in tribe for tr in template.st})
+        template = tribe[0]
+        self.process_kwargs = {'lowcut': template.lowcut, 'highcut': template.highcut,
+                               'filt_order': template.filt_order, 'samp_rate': template.samp_rate}
+        self.spectra = None
+        if spectra_root is not None:
+            # Processed chunks span at most chunk_length + overlap seconds
+            self.spectra = TemplateSpectra.build(
+                tribe, spectra_root, fft_length(tribe, self.chunk_length + self.overlap))
+
+    def __repr__(self):
+        return (f'ShardedMatchFilter(outdir={self.outdir}, chunk_length={self.chunk_length}, '
+                f'templates={len(self.tribe)}, groups={len(self.groups)}, workers={self.n_workers})')
+
+    def _parameters(self):
+        params = super()._parameters()
+        params['group_size'] = self.group_size
+        return params
+
+    def _fill_archive(self, starttime, endtime):
+        """Fetch any un-archived data for a chunk in the main process"""
+        for _id in self.seed_ids:
+            self.archive.update(*_id.split('.'), starttime - self.pad, endtime)
+
+    def run(self, starttime, endtime):
+        """
+        Run detection for every (chunk, template group) task between
+        **starttime** and **endtime** that is not already done.
+
+        :returns: dict with the number of tasks 'done', 'partial', 'failed',
+            and 'skipped', and per-stage 'timings' (seconds of worker time for
+            'process' and 'detect', and 'wall' time). The same counts are
+            appended to the manifest's 'runs' with the number of workers and
+            template groups.
+        """
+        counts = {'done': 0, 'partial': 0, 'failed': 0, 'skipped': 0}
+        timings = {'fetch': 0., 'process': 0., 'detect': 0.}
+        wall = time.perf_counter()
+        windows = {}
+        for chunk_id, c0, c1, t0, t1 in chunk_windows(starttime, endtime, self.chunk_length):
+            todo = [_g for _g in range(len(self.groups)) if not self.is_done(f'{chunk_id}.{_g:03d}')]
+            counts['skipped'] += len(self.groups) - len(todo)
+            if len(todo) > 0:
+                windows[chunk_id] = (c0, c1, t0, t1, todo)
+        Logger.info(f'{sum(len(_w[-1]) for _w in windows.values())} tasks over {len(windows)} chunks '
+                    f'x {len(self.groups)} template groups on {self.n_workers} workers')
+        initargs = (self.groups, str(self.archive.root), str(self.processed_dir),
+                    self.process_kwargs, self.cache_size,
+                    None if self.spectra is None else str(self.spectra.path))
+        with ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            pending = {}
+            queue = list(windows.keys())
+            while len(queue) > 0 or len(pending) > 0:
+                # Keep one chunk being fetched and processed ahead of the correlation tasks
+                if len(queue) > 0 and not any(_v[0] == 'process' for _v in pending.values()):
+                    chunk_id = queue.pop(0)
+                    c0, c1, t0, t1, todo = windows[chunk_id]
+                    tic = time.perf_counter()
+                    self._fill_archive(t0, t1 + self.overlap)
+                    timings['fetch'] += time.perf_counter() - tic
+                    _f = executor.submit(_process_task, chunk_id, t0, t1 + self.overlap, self.pad)
+                    pending[_f] = ('process', chunk_id, None)
+                    continue
+                finished, _ = wait(list(pending.keys()), return_when=FIRST_COMPLETED)
+                for _f in finished:
+                    kind, chunk_id, _g = pending.pop(_f)
+                    c0, c1, t0, t1, todo = windows[chunk_id]
+                    if kind == 'process':
+                        try:
+                            timings['process'] += _f.result()[-1]
+                        except Exception as e:
+                            Logger.error(f'processing chunk {chunk_id} failed: {e}')
+                            for _g in todo:
+                                counts[self._record(chunk_id, _g, t0, t1, c1, error=e)] += 1
+                            continue
+                        for _g in todo:
+                            party_file = self.party_dir / f'{chunk_id}.{_g:03d}.tgz'
+                            _t = executor.submit(_detect_task, chunk_id, _g, party_file, self.detect_kwargs)
+                            pending[_t] = ('detect', chunk_id, _g)
+                        continue
+                    try:
+                        _, _, ndet, elapsed, pid = _f.result()
+                        timings['detect'] += elapsed
+                        status = self._record(chunk_id, _g, t0, t1, c1, ndet=ndet, elapsed=elapsed,
+                                              worker=pid)
+                    except Exception as e:
+                        Logger.error(f'task {chunk_id}.{_g:03d} failed: {e}')
+                        status = self._record(chunk_id, _g, t0, t1, c1, error=e)
+                    counts[status] += 1
+                    if not any(_v[1] == chunk_id for _v in pending.values()):
+                        # All groups have run, the processed chunk is no longer needed
+                        _processed_file(self.processed_dir, chunk_id).unlink(missing_ok=True)
+        timings['wall'] = time.perf_counter() - wall
+        counts['timings'] = timings
+        self.manifest.setdefault('runs', []).append(
+            dict(counts, starttime=str(starttime), endtime=str(endtime), n_workers=self.n_workers,
+                 groups=len(self.groups), run=str(UTCDateTime())))
+        self._save_manifest()
+        Logger.info(f'sharded matched filter run: {counts}')
+        return counts
+
+    def _record(self, chunk_id, igroup, starttime, endtime, chunk_end, ndet=0, elapsed=0., error=None,
+                worker=None):
+        key = f'{chunk_id}.{igroup:03d}'
+        party_file = self.party_dir / f'{key}.tgz'
+        entry = {'starttime': str(starttime), 'endtime': str(endtime), 'elapsed': elapsed,
+                 'worker': worker}
+        if error is not None:
+            entry.update({'status': 'failed', 'error': repr(error)})
+        else:
+            entry.update({'status': 'done' if endtime >= chunk_end else 'partial',
+                          'ndetections': ndet,
+                          'file': party_file.name if ndet > 0 else None})
+        self.manifest['chunks'][key] = entry
+        self._save_manifest()
+        return entry['status']
@@ -0,0 +1,240 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/station_corrections.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Station delay and component expansion (triplication) corrections for
+    modeled pick tables (see :mod:`pick_modeling`).
+
+    :class:`~.StationCorrections` holds a table of corrections keyed by NSLC
+    code, where any field may be a wildcard (e.g., `UW.OLGA.*.*`), in one or
+    more layers whose delays are summed: typically the production station
+    delays read from a Hypoinverse P5.del-style delay file plus an ad-hoc
+    layer of adjustments from template review. Corrections are resolved once
+    per unique NSLC code (the most specific matching entry of each layer wins)
+    and applied to whole pick tables with array operations. Channels without
+    any matching entry get a default delay instead of raising a KeyError.
+
+    Picks at stations flagged for expansion are copied onto the other
+    components of the same location and band/instrument code that exist in
+    a station inventory (e.g., HHZ -> HHN, HHE or HH1, HH2).
+"""
+
+import logging
+from fnmatch import fnmatchcase
+
+import numpy as np
+import pandas as pd
+
+Logger = logging.getLogger(__name__)
+
+TABLE_COLUMNS = ['layer', 'nslc', 'delay', 'expand', 'note']
+
+
+def _normalize_nslc(code):
+    """Pad a (partial) NSLC code with wildcards, e.g., 'OLGA' -> '*.OLGA.*.*'"""
+    parts = str(code).split('.')
+    if len(parts) == 1:
+        parts = ['*'] + parts
+    parts += ['*']*(4 - len(parts))
+    if len(parts) != 4:
+        raise ValueError(f'cannot parse NSLC code "{code}"')
+    # Empty location codes are written as '--'
+    parts[2] = '' if parts[2] == '--' else parts[2]
+    return '.'.join(parts)
+
+
+def _specificity(nslc):
+    """Number of non-wildcard fields of an NSLC pattern"""
+    return sum(not any(_c in _p for _c in '*?[') for _p in nslc.split('.'))
+
+
+def read_delay_file(path, model=1, network=None):
+    """
+    Read a Hypoinverse P5.del-style station delay file into a table of
+    station delays.
+
+    Data lines are whitespace-delimited `STA [NET] [COMP] DELAY1 [DELAY2 ...]`
+    with one P-delay (seconds) per delay model. Lines starting with '#' or '*'
+    and a leading line with the number of delay models are skipped.
+
+    :param path: path to the delay file
+    :param model: 1-indexed delay model (column) to read
+    :param network: network code assigned to lines without one. Defaults to a
+        wildcard.
+
+    :returns: :class:`~pandas.DataFrame` with 'nslc' and 'delay' columns
+    """
+    holder = []
+    with open(path, 'r') as _f:
+        for lineno, line in enumerate(_f, start=1):
+            parts = line.split()
+            if len(parts) == 0 or parts[0][0] in '#*':
+                continue
+            if len(parts) == 1 and parts[0].isdigit():
+                continue
+            codes, delays = [], []
+            for _p in parts:
+                try:
+                    delays.append(float(_p))
+                except ValueError:
+                    if len(delays) > 0:
+                        break
+                    codes.append(_p)
+            if len(codes) == 0 or len(delays) < model:
+                Logger.warning(f'{path} line {lineno}: cannot parse "{line.rstrip()}"')
+                continue
+            sta = codes[0]
+            net = codes[1] if len(codes) > 1 and len(codes[1]) <= 2 else network
+            cha = codes[2] if len(codes) > 2 else '*'
+            # Single-character component codes apply to every band/instrument code
+            if len(cha) == 1 and cha != '*':
+                cha = '??' + cha
+            holder.append([f'{net or "*"}.{sta}.*.{cha}', delays[model - 1]])
+    return pd.DataFrame(holder, columns=['nslc', 'delay'])
+
+
+class StationCorrections(object):
+    """
+    Layered station delay and component expansion corrections keyed by NSLC.
+
+    :param default_delay: delay (seconds) applied to channels that have no
+        matching entry in any layer
+    """
+    def __init__(self, default_delay=0.):
+        self.default_delay = default_delay
+        self.table = pd.DataFrame(columns=TABLE_COLUMNS)
+        self._resolved = {}
+
+    def __repr__(self):
+        layers = ', '.join(f'{_k}: {_v}' for _k, _v in self.table.layer.value_counts(sort=False).items())
+        return f'StationCorrections(layers=({layers}), default_delay={self.default_delay})'
+
+    @classmethod
+    def from_files(cls, delay_file=None, override_file=None, model=1, network=None, default_delay=0.):
+        """
+        Build corrections from a P5.del-style delay file (layer 'official', see
+        :meth:`~.read_delay_file`) and an override CSV (layer 'ad_hoc', see
+        :meth:`~.StationCorrections.read_overrides`).
+        """
+        corr = cls(default_delay=default_delay)
+        if delay_file is not None:
+            dels = read_delay_file(delay_file, model=model, network=network)
+            corr.add_layer('official', dict(zip(dels.nslc, dels.delay)))
+        if override_file is not None:
+            corr.read_overrides(override_file)
+        return corr
+
+    def add_layer(self, layer, delays=None, expand=None, notes=None):
+        """
+        Add (or replace) entries of a correction layer.
+
+        :param layer: name of the layer
+        :param delays: dict of delays in seconds keyed by (partial) NSLC code,
+            e.g., {'OLGA': 0.5} or {'UW.OLGA..HHZ': 0.5}
+        :param expand: iterable of (partial) NSLC codes of channels whose picks
+            are expanded onto the inventory's other components
+        :param notes: optional dict of notes keyed like **delays**
+        """
+        delays = {} if delays is None else delays
+        notes = {} if notes is None else notes
+        expand = set() if expand is None else set(expand)
+        codes = list(delays.keys()) + [_c for _c in expand if _c not in delays]
+        new = pd.DataFrame({
+            'layer': layer,
+            'nslc': [_normalize_nslc(_c) for _c in codes],
+            'delay': [delays.get(_c, np.nan) for _c in codes],
+            'expand': [_c in expand for _c in codes],
+            'note': [notes.get(_c, '') for _c in codes]}, columns=TABLE_COLUMNS)
+        old = self.table[~((self.table.layer == layer) & self.table.nslc.isin(new.nslc))]
+        self.table = new if len(old) == 0 else pd.concat([old, new], ignore_index=True)
+        self._resolved = {}
+
+    def read_overrides(self, path, layer='ad_hoc'):
+        """
+        Add overrides from a CSV file with 'nslc', 'delay', and optional
+        'expand' (0/1) and 'note' columns. Empty delays are treated as 0.
+        """
+        df = pd.read_csv(path, comment='#', skipinitialspace=True, dtype={'nslc': str})
+        if 'nslc' not in df.columns or 'delay' not in df.columns:
+            raise ValueError(f'{path} must have "nslc" and "delay" columns')
+        expand = df.nslc[df.expand.fillna(0).astype(bool)] if 'expand' in df.columns else []
+        notes = dict(zip(df.nslc, df.note.fillna(''))) if 'note' in df.columns else None
+        self.add_layer(layer, delays=dict(zip(df.nslc, df.delay.fillna(0.))),
+                       expand=expand, notes=notes)
+
+    def resolve(self, nslc):
+        """
+        Resolve corrections for NSLC codes.
+
+        :param nslc: iterable of full NSLC codes
+        :returns: :class:`~pandas.DataFrame` indexed by NSLC with one delay
+            column per layer, the summed 'delay', and the 'expand' flag
+        """
+        layers = list(self.table.layer.unique())
+        todo = [_c for _c in pd.unique(np.asarray(nslc, dtype=object)) if _c not in self._resolved]
+        if len(todo) > 0:
+            table = self.table.assign(spec=self.table.nslc.map(_specificity))
+            table = table.sort_values('spec', ascending=False, kind='stable')
+            for code in todo:
+                hits = table[[fnmatchcase(code, _p) for _p in table.nslc]]
+                row = {}
+                for _l in layers:
+                    _d = hits[(hits.layer == _l) & hits.delay.notna()]
+                    row[_l] = _d.delay.iloc[0] if len(_d) > 0 else np.nan
+                row['expand'] = bool(hits.expand.any())
+                if all(np.isnan(row[_l]) for _l in layers):
+                    Logger.warning(f'no station delay for {code}, using {self.default_delay} s')
+                    row['delay'] = self.default_delay
+                else:
+                    row['delay'] = np.nansum([row[_l] for _l in layers])
+                self._resolved[code] = row
+        index = pd.Index(np.asarray(nslc, dtype=object), name='nslc')
+        return pd.DataFrame([self._resolved[_c] for _c in index], index=index,
+                            columns=layers + ['delay', 'expand'])
+
+    def apply(self, picks, inv=None):
+        """
+        Apply station delays to a pick table and expand picks onto other
+        components.
+
+        :param picks: pick table from :meth:`~pick_modeling.model_pick_table`
+        :param inv: :class:`~obspy.core.inventory.Inventory` or table from
+            :meth:`~pick_modeling.inventory_channels` listing the channels
+            picks can be expanded onto. If `None`, picks are not expanded.
+
+        :returns: corrected pick table with an added 'triplicated' column that
+            flags copied picks
+        """
+        picks = picks.copy()
+        picks['triplicated'] = False
+        if len(picks) == 0:
+            return picks
+        codes = picks.nslc.unique()
+        res = self.resolve(codes)
+        picks['time'] += pd.to_timedelta(picks.nslc.map(res.delay).values, unit='s')
+        if inv is None or not res.expand.any():
+            return picks
+        from pick_modeling import inventory_channels
+        chans = inv if isinstance(inv, pd.DataFrame) else inventory_channels(inv)
+        # Map each expanded channel to its sibling components
+        inst = chans.nslc.str[:-1]
+        siblings = []
+        for code in res.index[res.expand.values]:
+            _sib = chans.nslc[(inst == code[:-1]) & (chans.nslc != code)]
+            siblings += [(code, _s) for _s in _sib]
+        if len(siblings) == 0:
+            return picks
+        siblings = pd.DataFrame(siblings, columns=['nslc', 'sibling'])
+        dups = picks.merge(siblings, on='nslc', how='inner')
+        dups['nslc'] = dups.pop('sibling')
+        dups['triplicated'] = True
+        picks = pd.concat([picks, dups[picks.columns]], ignore_index=True)
+        # Drop copies onto channels that were already picked
+        picks = picks.drop_duplicates(subset=['evid', 'nslc', 'phase'], keep='first')
+        return picks.sort_values(['evid', 'nslc', 'time'], kind='stable').reset_index(drop=True)
+
+    def summary(self):
+        """Long-form table of all correction entries"""
+        return self.table.sort_values(['nslc', 'layer']).reset_index(drop=True)
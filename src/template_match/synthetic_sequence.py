@@ -0,0 +1,253 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/synthetic_sequence.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Synthetic aftershock sequences with a matching AQMS event table and
+    continuous waveforms, for benchmarking the template matching workflow.
+
+    :meth:`~.synthetic_sequence` draws origin times from a modified Omori law
+    and magnitudes from a truncated Gutenberg-Richter distribution, and places
+    events in a number of source patches ("families") around the mainshock
+    hypocenter. Events are returned as an event table with the columns and
+    dtypes of a Jiggle export (see :data:`~jiggle_io.EVENT_TABLE_SCHEMA`),
+    which :meth:`~.write_event_table` writes in Jiggle's CSV format.
+
+    :class:`~.SyntheticClient` is a :class:`~fake_clients.FakeClient` that
+    serves gaussian noise with each event's P and S wavelets added at arrival
+    times modeled with a :class:`~pick_modeling.TravelTimeTable`. Wavelets are
+    fixed per channel and family, so events of one family correlate as
+    repeating earthquakes do. Data are generated in fixed blocks seeded by
+    channel and block time, so any request returns identical samples and long
+    sequences are never held in memory at once.
+"""
+
+import logging
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy.signal import butter, sosfiltfilt
+
+from obspy import Stream, Trace, UTCDateTime
+
+from fake_clients import FakeClient
+from jiggle_io import EVENT_TABLE_SCHEMA
+from pick_modeling import inventory_channels, model_pick_table
+
+Logger = logging.getLogger(__name__)
+
+# Mainshock hypocenter of the 2025-03-03 M4.5 Orcas Island earthquake (Jiggle export)
+MAINSHOCK = {'LAT': 48.61117, 'LON': -122.80517, 'MZ': 15.97}
+KM_PER_DEG = 111.19
+
+
+def omori_times(n, duration, c=0.05*86400., p=1.1, rng=None):
+    """
+    Draw **n** sorted times (seconds after the mainshock) in [0, **duration**]
+    from the modified Omori law rate K/(c + t)**p, with **c** in seconds.
+    """
+    rng = np.random.default_rng(rng)
+    u = rng.uniform(0, 1, n)
+    if abs(p - 1.) < 1e-9:
+        t = c*((c + duration)/c)**u - c
+    else:
+        q = 1. - p
+        t = (c**q + u*((c + duration)**q - c**q))**(1./q) - c
+    return np.sort(t)
+
+
+def gr_magnitudes(n, b=1., mmin=0., mmax=4., rng=None):
+    """Draw **n** magnitudes from a Gutenberg-Richter distribution truncated to [mmin, mmax]"""
+    rng = np.random.default_rng(rng)
+    u = rng.uniform(0, 1, n)
+    return mmin - np.log10(1. - u*(1. - 10**(-b*(mmax - mmin))))/b
+
+
+def synthetic_sequence(nevents, starttime, duration, nfamilies=None, b=1., mmin=0., mmax=4.,
+                       c=0.05*86400., p=1.1, spread_km=3., family_km=0.2, first_evid=90000000,
+                       seed=0):
+    """
+    Make a synthetic aftershock sequence.
+
+    :param nevents: number of events
+    :param starttime: mainshock time, the start of the sequence
+    :param duration: sequence length in seconds
+    :param nfamilies: number of source patches, defaults to about sqrt(**nevents**)
+    :param b: Gutenberg-Richter b-value
+    :param mmin: minimum magnitude
+    :param mmax: maximum magnitude
+    :param c: Omori c-value in seconds
+    :param p: Omori p-value
+    :param spread_km: standard deviation of source patch locations around the
+        mainshock hypocenter in km
+    :param family_km: standard deviation of event locations within a patch in km
+    :param first_evid: event ID of the first event
+    :param seed: random seed
+
+    :returns:
+        - **df** (*pandas.DataFrame*) -- event table indexed by event ID (ID)
+          with the columns of a Jiggle event table export
+        - **families** (*pandas.Series*) -- source patch of each event
+    """
+    rng = np.random.default_rng(seed)
+    nfamilies = max(1, int(np.sqrt(nevents))) if nfamilies is None else int(nfamilies)
+    times = omori_times(nevents, duration, c=c, p=p, rng=rng)
+    mags = np.round(gr_magnitudes(nevents, b=b, mmin=mmin, mmax=mmax, rng=rng), 2)
+    centers = rng.normal(0, spread_km, (nfamilies, 3))
+    families = rng.integers(0, nfamilies, nevents)
+    xyz = centers[families] + rng.normal(0, family_km, (nevents, 3))
+    lat = MAINSHOCK['LAT'] + xyz[:, 1]/KM_PER_DEG
+    lon = MAINSHOCK['LON'] + xyz[:, 0]/(KM_PER_DEG*np.cos(np.radians(MAINSHOCK['LAT'])))
+    depth = np.clip(MAINSHOCK['MZ'] + xyz[:, 2], 1., None)
+    # Jiggle reports origin times to the millisecond
+    otimes = (pd.Timestamp(UTCDateTime(starttime).datetime) + pd.to_timedelta(times, unit='s')).round('ms')
+    evids = np.arange(first_evid, first_evid + nevents)
+    obs = rng.integers(6, 60, nevents)
+    df = pd.DataFrame({
+        'VER': 1, 'OWHO': 'synthetic', 'ST': 'F',
+        'DATETIME': otimes,
+        'TF': False, 'MAG': mags, 'MTYP': np.where(mags < 2., 'Md', 'Ml'), 'MOBS': obs//2,
+        'MERR': 0.2, 'MWHO': 'synthetic', 'HF': False,
+        'LAT': np.round(lat, 5), 'LON': np.round(lon, 5), 'Z': np.round(depth, 2),
+        'MZ': np.round(depth, 2), 'GZ': np.round(depth, 2), 'ZF': False,
+        'ERR_H': 0.3, 'ERR_Z': 0.6, 'ETYPE': 'earthquake', 'GT': 'L', 'SRC': 'synthetic',
+        'GAP': 90., 'DIST': 2., 'RMS': 0.05, 'OBS': obs, 'USED': obs, 'S': obs//4, 'FM': 0,
+        'WRECS': 2*obs, 'Q': 1., 'V': 1, 'B': 0, 'COMMENT': 'synthetic aftershock'},
+        index=pd.Index(evids, name='ID'))
+    df = df.astype(EVENT_TABLE_SCHEMA)
+    return df, pd.Series(families, index=df.index, name='family')
+
+
+def write_event_table(df, csv_file):
+    """Write an event table in the format of Jiggle's event table exports"""
+    out = df.copy()
+    out['DATETIME'] = out.DATETIME.dt.strftime('%Y-%m-%d %H:%M:%S.%f').str[:-3]
+    for _k, _v in EVENT_TABLE_SCHEMA.items():
+        if _v == 'bool':
+            out[_k] = np.where(out[_k], "'1'", "'0'")
+        elif _v in ['category', 'string'] or _k == 'DATETIME':
+            out[_k] = "'" + out[_k].astype(str) + "'"
+    out[list(EVENT_TABLE_SCHEMA.keys())].to_csv(csv_file, quoting=3)
+    return csv_file
+
+
+def _wavelet(seed, length, sampling_rate, band, decay):
+    """Band-limited noise burst with an exponentially decaying envelope and unit peak"""
+    npts = int(length*sampling_rate)
+    sos = butter(4, band, btype='band', fs=sampling_rate, output='sos')
+    w = sosfiltfilt(sos, np.random.default_rng(seed).normal(0, 1, npts))
+    t = np.arange(npts)/sampling_rate
+    w *= (1. - np.exp(-t/0.05))*np.exp(-t/decay)
+    return w/np.abs(w).max()
+
+
+class SyntheticClient(FakeClient):
+    """
+    Serve noise plus the waveforms of a synthetic event table's events.
+
+    :param df: event table from :meth:`~.synthetic_sequence`
+    :param inv: :class:`~obspy.core.inventory.Inventory` with channel-level
+        metadata, or a table from :meth:`~pick_modeling.inventory_channels`
+    :param ttable: :class:`~pick_modeling.TravelTimeTable` for P arrival times
+    :param families: source patch of each event. Defaults to one per event.
+    :param sampling_rate: sampling rate of the served data
+    :param noise: standard deviation of the noise in counts
+    :param amplitude: peak P amplitude in counts of a magnitude 0 event at 10 km
+        hypocentral distance. S waves are twice as large.
+    :param vpvs: P to S velocity ratio used to place S arrivals
+    :param block_length: length of generated data blocks in seconds
+    :param cache_blocks: number of generated blocks kept in memory
+    :param seed: seed for noise and wavelets
+    :param kwargs: latency, jitter, and failure_rate, see :class:`~fake_clients.FakeClient`
+    """
+    def __init__(self, df, inv, ttable, families=None, sampling_rate=100., noise=100.,
+                 amplitude=200., vpvs=1.73, block_length=3600., cache_blocks=64, seed=0,
+                 **kwargs):
+        self.chans = inv if isinstance(inv, pd.DataFrame) else inventory_channels(inv)
+        super().__init__(nslc=self.chans.nslc.tolist(), sampling_rate=sampling_rate,
+                         seed=seed, **kwargs)
+        self.noise = float(noise)
+        self.block_length = float(block_length)
+        self.cache_blocks = int(cache_blocks)
+        self.seed = seed
+        self._blocks = OrderedDict()
+        self._wavelets = {}
+        if families is None:
+            families = pd.Series(np.arange(len(df)), index=df.index)
+        self.wavelet_length = 8.
+        # One row per (event, channel) arrival, sorted by time within each channel
+        picks = model_pick_table(df, self.chans, ttable, pick_preference='earliest')
+        t0 = picks.time.values.astype('datetime64[ns]').astype(np.int64)/1e9
+        hypo = np.hypot(picks.dist_deg.values*KM_PER_DEG, df.MZ.reindex(picks.evid).values)
+        amp = amplitude*10**df.MAG.reindex(picks.evid).values*10./np.clip(hypo, 1., None)
+        arrivals = pd.DataFrame({
+            'nslc': picks.nslc.values, 'p': t0,
+            's': t0 + (vpvs - 1.)*picks.travel_time.values,
+            'amp': amp, 'family': families.reindex(picks.evid).values})
+        self.arrivals = {_k: _v.sort_values('p', ignore_index=True)
+                         for _k, _v in arrivals.groupby('nslc')}
+        # Longest time from a P arrival to the end of its S wavelet
+        self._reach = (arrivals.s - arrivals.p).max() + self.wavelet_length if len(arrivals) > 0 else 0.
+
+    def __repr__(self):
+        return (f'SyntheticClient(channels={len(self.chans)}, arrivals='
+                f'{sum(len(_v) for _v in self.arrivals.values())}, requests={len(self.requests)})')
+
+    def _seed(self, *parts):
+        return zlib.crc32('.'.join(str(_p) for _p in (self.seed,) + parts).encode())
+
+    def _wavelet(self, nslc, family, phase):
+        key = (nslc, family, phase)
+        if key not in self._wavelets:
+            self._wavelets[key] = _wavelet(self._seed(*key), self.wavelet_length, self.sampling_rate,
+                                           [2., 0.4*self.sampling_rate], 1.5)
+        return self._wavelets[key]
+
+    def _block(self, nslc, k):
+        """Samples of block **k** (starting at k*block_length seconds) of channel **nslc**"""
+        key = (nslc, k)
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+        fs = self.sampling_rate
+        npts = int(round(self.block_length*fs))
+        t0 = k*self.block_length
+        data = np.random.default_rng(self._seed(nslc, k)).normal(0, self.noise, npts)
+        arr = self.arrivals.get(nslc)
+        if arr is not None:
+            # Arrivals whose wavelets overlap this block
+            i0, i1 = np.searchsorted(arr.p.values, [t0 - self._reach, t0 + self.block_length])
+            for _a in arr.iloc[i0:i1].itertuples():
+                for phase, scale in [('p', 1.), ('s', 2.)]:
+                    w = self._wavelet(nslc, _a.family, phase)
+                    j0 = int(round((getattr(_a, phase) - t0)*fs))
+                    s0, s1 = max(j0, 0), min(j0 + len(w), npts)
+                    if s1 > s0:
+                        data[s0:s1] += scale*_a.amp*w[s0 - j0:s1 - j0]
+        self._blocks[key] = data
+        if len(self._blocks) > self.cache_blocks:
+            self._blocks.popitem(last=False)
+        return data
+
+    def _synthesize(self, network, station, location, channel, starttime, endtime):
+        st = Stream()
+        fs = self.sampling_rate
+        template = Stream([Trace(header={'network': _n, 'station': _s, 'location': _l, 'channel': _c})
+                           for _n, _s, _l, _c in [_e.split('.') for _e in self.nslc]])
+        # Sample-aligned request bounds
+        i0 = int(np.ceil(starttime.timestamp*fs - 1e-6))
+        i1 = int(np.floor(endtime.timestamp*fs + 1e-6))
+        if i1 < i0:
+            return st
+        nblock = int(round(self.block_length*fs))
+        for tr in template.select(network=network, station=station, location=location, channel=channel):
+            k0, k1 = i0//nblock, i1//nblock
+            data = np.concatenate([self._block(tr.id, _k) for _k in range(k0, k1 + 1)])
+            tr.data = np.round(data[i0 - k0*nblock:i1 - k0*nblock + 1]).astype(np.int32)
+            tr.stats.sampling_rate = fs
+            tr.stats.starttime = UTCDateTime(i0/fs)
+            st += tr
+        return st
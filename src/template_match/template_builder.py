@@ -0,0 +1,185 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/template_builder.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Template construction that fetches and pre-processes each station's
+    data once per processing window and cuts every template in that window
+    from the shared, processed buffer.
+
+    Events are assigned to overlapping processing windows that start at
+    multiples of a whole-minute window step. The overlap is sized so that every event's templates, plus
+    **data_pad** seconds on either side for filter edge effects, fit inside a
+    single window. For each window, the picked channels of all events are
+    fetched in one bulk request (e.g., from a :class:`~waveform_archive.WaveformArchive`
+    or :class:`~fetch_engine.ChunkedFetcher`), processed with
+    :meth:`~eqcorrscan.utils.pre_processing.multi_process`, and templates are
+    cut with EQcorrscan's `from_meta_file` method without re-processing.
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from obspy import Stream, UTCDateTime
+from obspy.core.event import Catalog
+
+from eqcorrscan import Tribe
+from eqcorrscan.utils.pre_processing import multi_process
+
+Logger = logging.getLogger(__name__)
+
+
+def _event_span(event, prepick, length):
+    """Get the start and end times of all templates for an event"""
+    times = [_p.time for _p in event.picks if _p.waveform_id]
+    if len(times) == 0:
+        return None
+    return min(times) - prepick, max(times) + length
+
+
+def group_events(catalog, process_len=3600., data_pad=90., prepick=0., length=0.):
+    """
+    Assign events to overlapping processing windows of **process_len** seconds.
+
+    :param catalog: :class:`~obspy.core.event.Catalog` of events with picks
+    :param process_len: length of processing windows in seconds
+    :param data_pad: minimum seconds between template data and window edges
+    :param prepick: template pre-pick time in seconds
+    :param length: template length in seconds
+
+    :returns: list of (starttime, endtime, :class:`~obspy.core.event.Catalog`)
+        tuples sorted by starttime. Events without picks are skipped.
+    """
+    spans = []
+    for event in catalog:
+        span = _event_span(event, prepick, length)
+        if span is None:
+            Logger.warning(f'no picks for event {event.resource_id}, skipping')
+            continue
+        spans.append((event, span[0], span[1]))
+    if len(spans) == 0:
+        return []
+    max_span = max(_t1 - _t0 for _, _t0, _t1 in spans)
+    # Window step that guarantees each padded event span fits in one window
+    step = process_len - 2*data_pad - max_span
+    if step <= 0:
+        raise ValueError(f'process_len ({process_len} s) is too short for data_pad '
+                         f'({data_pad} s) and template spans up to {max_span:.1f} s')
+    # Round the step down to a whole minute so windows stay aligned
+    if step > 60:
+        step = 60.*np.floor(step/60.)
+    groups = {}
+    for event, t0, _ in spans:
+        _k = int(np.floor((float(t0) - data_pad)/step))
+        groups.setdefault(_k, []).append(event)
+    return [(UTCDateTime(_k*step), UTCDateTime(_k*step + process_len), Catalog(events=groups[_k]))
+            for _k in sorted(groups.keys())]
+
+
+def _bulk_request(catalog, starttime, endtime, all_horiz=False):
+    """Get one bulk request line per channel picked by events in **catalog**"""
+    codes = set()
+    for event in catalog:
+        for pick in event.picks:
+            wid = pick.waveform_id
+            if not wid or not wid.station_code or not wid.channel_code:
+                continue
+            cha = wid.channel_code[:2] + '?' if all_horiz else wid.channel_code
+            codes.add((wid.network_code or '*', wid.station_code, wid.location_code or '', cha))
+    return [_c + (starttime, endtime) for _c in sorted(codes)]
+
+
+def fetch_window(client, catalog, starttime, endtime, all_horiz=False):
+    """
+    Fetch data for all channels picked by events in **catalog** between
+    **starttime** and **endtime** from **client**, using a single bulk request
+    if **client** supports it.
+    """
+    bulk = _bulk_request(catalog, starttime, endtime, all_horiz=all_horiz)
+    if hasattr(client, 'get_waveforms_bulk'):
+        try:
+            return client.get_waveforms_bulk(bulk)
+        except Exception as e:
+            Logger.error(f'bulk request failed for {starttime} - {endtime}: {e}')
+            return Stream()
+    st = Stream()
+    for _b in bulk:
+        try:
+            st += client.get_waveforms(*_b)
+        except Exception as e:
+            Logger.error(f'no data for {".".join(_b[:4])} {starttime} - {endtime}: {e}')
+    return st
+
+
+def process_window(st, starttime, endtime, lowcut, highcut, filt_order, samp_rate,
+                   parallel=False, num_cores=False, min_fraction=0.8):
+    """
+    Merge, trim, and pre-process one window of data with EQcorrscan's standard
+    matched-filter processing. Traces with less than **min_fraction** of the
+    window are dropped.
+    """
+    st = st.merge()
+    st.trim(starttime, endtime)
+    process_len = endtime - starttime
+    keep = []
+    for tr in st:
+        _len = (np.ma.count(tr.data) if np.ma.is_masked(tr.data) else tr.stats.npts)*tr.stats.delta
+        if _len < min_fraction*process_len:
+            Logger.warning(f'{tr.id} has {_len:.0f} of {process_len:.0f} s of data, not using')
+            continue
+        keep.append(tr)
+    st.traces = keep
+    if len(st) == 0:
+        return st
+    return multi_process(st, lowcut=lowcut, highcut=highcut, filt_order=filt_order,
+                         samp_rate=samp_rate, parallel=parallel, num_cores=num_cores,
+                         starttime=starttime, endtime=endtime)
+
+
+def construct_from_archive(catalog, client, lowcut, highcut, samp_rate, filt_order,
+                           length, prepick, process_len=3600., data_pad=90., swin='all',
+                           all_horiz=False, delayed=True, min_snr=None, parallel=False,
+                           num_cores=False, **kwargs):
+    """
+    Construct a :class:`~eqcorrscan.core.match_filter.Tribe` from a catalog,
+    fetching and processing each processing window's data once.
+
+    Takes the same template parameters as :meth:`~eqcorrscan.Tribe.construct`
+    with `method='from_client'`, with **client** being any object with a
+    `get_waveforms` (and preferably `get_waveforms_bulk`) method, such as a
+    :class:`~waveform_archive.WaveformArchive`. Additional **kwargs** are
+    passed to :meth:`~eqcorrscan.Tribe.construct`.
+
+    :returns:
+        - **tribe** (*eqcorrscan.Tribe*) -- constructed templates
+        - **timings** (*dict*) -- seconds spent fetching, processing, and cutting
+    """
+    timings = {'fetch': 0., 'process': 0., 'cut': 0.}
+    tribe = Tribe()
+    groups = group_events(catalog, process_len=process_len, data_pad=data_pad,
+                          prepick=prepick, length=length)
+    Logger.info(f'{len(catalog)} events in {len(groups)} processing windows')
+    for starttime, endtime, subcat in groups:
+        tic = time.perf_counter()
+        st = fetch_window(client, subcat, starttime, endtime, all_horiz=all_horiz)
+        timings['fetch'] += time.perf_counter() - tic
+        tic = time.perf_counter()
+        st = process_window(st, starttime, endtime, lowcut, highcut, filt_order, samp_rate,
+                            parallel=parallel, num_cores=num_cores)
+        timings['process'] += time.perf_counter() - tic
+        if len(st) == 0:
+            Logger.warning(f'no data for {len(subcat)} events in {starttime} - {endtime}')
+            continue
+        tic = time.perf_counter()
+        # Cut templates from the shared processed data
+        tribe += Tribe().construct(
+            method='from_meta_file', meta_file=subcat, st=st, process=False,
+            lowcut=lowcut, highcut=highcut, samp_rate=samp_rate, filt_order=filt_order,
+            length=length, prepick=prepick, swin=swin, process_len=process_len,
+            all_horiz=all_horiz, delayed=delayed, min_snr=min_snr, **kwargs)
+        timings['cut'] += time.perf_counter() - tic
+    Logger.info('template construction timings: ' + ', '.join(f'{_k} {_v:.3f} s' for _k, _v in timings.items()))
+    return tribe, timings
@@ -0,0 +1,154 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/template_selection.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Select the best template of each cluster and save the selection as
+    an index into the full tribe file.
+
+    :meth:`~.select_best` ranks every row of a cluster table (e.g., a
+    ClusteringTribe's `_c` attribute, see :meth:`~.cluster_table`) and keeps
+    the top row of each group in one sort and one pass, rather than filtering
+    the table once per group. Rankings are a named entry of :data:`RANKINGS`,
+    a column name or list of column names (later columns break ties), or a
+    callable returning one score per row.
+
+    :meth:`~.write_subset` saves the selected template names with the path,
+    size, and modification time of the full tribe file as a small JSON index,
+    and :meth:`~.read_subset` rebuilds the subset from the full tribe, so the
+    selected templates are not written to disk twice.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+from eqcorrscan import Tribe
+
+from template_spectra import load_tribe
+
+Logger = logging.getLogger(__name__)
+
+SUBSET_VERSION = 1
+# Named rankings: cluster table columns, in order of precedence (largest first)
+RANKINGS = {
+    'snr': ['mean_snr_dB'],
+    'nchan': ['nchan', 'mean_snr_dB'],
+    'magnitude': ['mag', 'mean_snr_dB'],
+}
+
+
+def cluster_table(tribe):
+    """
+    Get a copy of **tribe**'s cluster table (its `_c` attribute, if any)
+    indexed by template name, with 'nchan' (number of template traces) and
+    'mag' (preferred magnitude) columns added if missing.
+    """
+    table = getattr(tribe, '_c', None)
+    table = pd.DataFrame(index=[template.name for template in tribe]) if table is None else table.copy()
+    if 'nchan' not in table.columns:
+        table['nchan'] = pd.Series({template.name: len(template.st) for template in tribe})
+    if 'mag' not in table.columns:
+        mags = {}
+        for template in tribe:
+            mag = None if template.event is None else template.event.preferred_magnitude()
+            mags[template.name] = None if mag is None else mag.mag
+        table['mag'] = pd.Series(mags, dtype=float)
+    return table
+
+
+def _rank_keys(table, rank):
+    """Get a DataFrame of ranking keys, in order of precedence"""
+    if callable(rank):
+        return pd.DataFrame({'score': rank(table)}, index=table.index)
+    if isinstance(rank, str):
+        rank = RANKINGS.get(rank, [rank])
+    missing = [_k for _k in rank if _k not in table.columns]
+    if len(missing) > 0:
+        raise KeyError(f'ranking columns {missing} are not in the cluster table')
+    return table[list(rank)]
+
+
+def select_best(table, group='xcc', rank='snr', min_values=None):
+    """
+    Select the highest ranked row of each group.
+
+    :param table: cluster table indexed by template name
+    :param group: column of group labels
+    :param rank: name in :data:`RANKINGS`, column name, list of column names,
+        or callable returning a score per row of **table**
+    :param min_values: optional dict of {column: minimum}. Rows below any
+        minimum are not eligible, and groups with no eligible rows are skipped.
+
+    :returns: rows of **table** for the selected templates, sorted by group.
+        Ties go to the earliest row in **table**.
+    """
+    keys = _rank_keys(table, rank)
+    eligible = pd.Series(True, index=table.index)
+    for _col, _min in (min_values or {}).items():
+        eligible &= table[_col] >= _min
+    keys = keys[eligible.values]
+    # One stable sort, then the first row of each group
+    order = keys.assign(_group=table.loc[eligible.values, group].values).sort_values(
+        list(keys.columns), ascending=False, kind='stable', na_position='last')
+    best = order.drop_duplicates('_group').sort_values('_group', kind='stable')
+    Logger.info(f'selected {len(best)} templates from {table[group].nunique()} groups')
+    return table.loc[best.index]
+
+
+def write_subset(path, tribe_file, names, **metadata):
+    """
+    Save a subset of the templates in **tribe_file** as a JSON index.
+
+    :param path: index file to write
+    :param tribe_file: full tribe file, stored relative to **path**'s directory
+    :param names: names of the templates in the subset
+    :param metadata: other JSON-serializable entries to store, e.g., the
+        ranking used
+    """
+    path, tribe_file = Path(path), Path(tribe_file)
+    _st = tribe_file.stat()
+    index = {'version': SUBSET_VERSION,
+             'tribe_file': os.path.relpath(tribe_file.resolve(), path.resolve().parent),
+             'size': _st.st_size, 'mtime_ns': _st.st_mtime_ns,
+             'names': [str(_n) for _n in names]}
+    index.update(metadata)
+    tmp = path.with_suffix('.tmp')
+    with open(tmp, 'w') as _f:
+        json.dump(index, _f, indent=1)
+    os.replace(tmp, path)
+    return index
+
+
+def read_subset(path, cache_root=None, tribe_class=Tribe):
+    """
+    Read the templates listed in a subset index from its full tribe file.
+
+    :param path: index file written by :meth:`~.write_subset`
+    :param cache_root: optional cache directory for :meth:`~template_spectra.load_tribe`
+    :param tribe_class: class used to read the tribe file, e.g., ClusteringTribe
+    """
+    path = Path(path)
+    with open(path, 'r') as _f:
+        index = json.load(_f)
+    tribe_file = (path.resolve().parent / index['tribe_file']).resolve()
+    _st = tribe_file.stat()
+    if (_st.st_size, _st.st_mtime_ns) != (index['size'], index['mtime_ns']):
+        Logger.warning(f'{tribe_file} changed after {path} was written')
+    if cache_root is None:
+        tribe = tribe_class().read(str(tribe_file))
+    else:
+        tribe = load_tribe(tribe_file, cache_root, tribe_class=tribe_class)
+    names = index['names']
+    templates = {template.name: template for template in tribe}
+    missing = [_n for _n in names if _n not in templates]
+    if len(missing) > 0:
+        Logger.warning(f'{len(missing)} templates in {path} are not in {tribe_file}: {missing}')
+    names = [_n for _n in names if _n in templates]
+    if hasattr(tribe, 'get_subset'):
+        return tribe.get_subset(names=names)
+    return Tribe(templates=[templates[_n] for _n in names])
@@ -0,0 +1,253 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/template_spectra.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: On-disk cache of template spectra and normalization statistics for
+    repeated matched-filter runs.
+
+    :class:`~.TemplateSpectra` precomputes, for every template channel, the
+    normalized and flipped template's real FFT at a fixed FFT length and its
+    normalization statistics, the same quantities EQcorrscan's numpy
+    correlation backend computes on every call. Arrays are saved as `.npy`
+    files and opened with `mmap_mode='r'`, so any number of worker processes
+    share one copy through the page cache. Cache directories are keyed by the
+    templates' content hashes, the FFT length, and the processing parameters,
+    so a changed tribe or chunk length builds a new cache rather than reusing
+    a stale one.
+
+    Cached spectra are used through the `'cached_fft'` correlation function,
+    registered with EQcorrscan on import. Pass `xcorr_func='cached_fft'` to
+    :meth:`~eqcorrscan.Tribe.detect` after :meth:`~.TemplateSpectra.activate`.
+    Template channels are matched to cache rows by a hash of their data, and
+    channels missing from the cache, or streams too long for the cached FFT
+    length, fall back to computing spectra on the fly.
+
+    Layout::
+
+        {root}/{key}/index.json     -- parameters, template hashes, row hashes
+        {root}/{key}/spectra.npy    -- (rows, fft_len//2 + 1) complex64 spectra
+        {root}/{key}/stats.npy      -- (rows, 3) template mean, std, normalized sum
+        {root}/tribes/{key}.pkl     -- pickled tribes, see :meth:`~.load_tribe`
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+from pathlib import Path
+
+import numpy as np
+from scipy.fft import next_fast_len
+
+from eqcorrscan import Tribe
+from eqcorrscan.utils.correlate import register_array_xcorr
+
+Logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 1
+# Opened caches used by cached_normxcorr, keyed by FFT length
+_ACTIVE = {}
+
+
+def _row_hash(data):
+    """Hash of one template channel's samples, as passed to correlation functions"""
+    return hashlib.sha1(np.ascontiguousarray(data, dtype=np.float32).tobytes()).hexdigest()
+
+
+def _processing(template):
+    return {'lowcut': template.lowcut, 'highcut': template.highcut,
+            'filt_order': template.filt_order, 'samp_rate': template.samp_rate}
+
+
+def template_hash(template):
+    """Hash of a template's channel ids, start times, samples, and processing parameters"""
+    _h = hashlib.sha1(json.dumps(_processing(template), sort_keys=True).encode())
+    for tr in sorted(template.st, key=lambda _tr: _tr.id):
+        _h.update(f'{tr.id}|{tr.stats.starttime}|'.encode())
+        _h.update(_row_hash(tr.data).encode())
+    return _h.hexdigest()
+
+
+def fft_length(tribe, stream_length):
+    """
+    FFT length for correlating the templates of **tribe** with
+    **stream_length** seconds of data
+    """
+    template = tribe[0]
+    tlen = max(tr.stats.npts for template in tribe for tr in template.st)
+    slen = int(round(stream_length*template.samp_rate)) + 1
+    return next_fast_len(tlen + slen - 1, real=True)
+
+
+def _normalize(templates):
+    """Normalize templates as EQcorrscan's numpy_normxcorr does"""
+    templates = np.asarray(templates, dtype=np.float64)
+    length = templates.shape[-1]
+    mean = templates.mean(axis=-1, keepdims=True)
+    std = templates.std(axis=-1, keepdims=True)
+    norm = (templates - mean)/(std*length)
+    return norm, np.hstack([mean, std, norm.sum(axis=-1, keepdims=True)])
+
+
+def _spectra(templates, fft_len):
+    norm, stats = _normalize(templates)
+    return np.fft.rfft(np.flip(norm, axis=-1), fft_len, axis=-1), stats
+
+
+class TemplateSpectra(object):
+    """
+    Memory-mapped spectra of a tribe's template channels at one FFT length.
+
+    :param path: cache directory written by :meth:`~.TemplateSpectra.build`
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'index.json', 'r') as _f:
+            self.index = json.load(_f)
+        if self.index.get('version') != CACHE_VERSION:
+            raise ValueError(f'{self.path} was written by cache version {self.index.get("version")}')
+        self.fft_len = self.index['fft_len']
+        self.spectra = np.load(self.path / 'spectra.npy', mmap_mode='r')
+        self.stats = np.load(self.path / 'stats.npy', mmap_mode='r')
+        self.rows = {_h: _i for _i, _h in enumerate(self.index['rows'])}
+
+    def __repr__(self):
+        return (f'TemplateSpectra(path={self.path}, fft_len={self.fft_len}, '
+                f'templates={len(self.index["templates"])}, rows={len(self.rows)})')
+
+    @staticmethod
+    def key(tribe, fft_len):
+        """Cache key of a tribe and FFT length"""
+        _h = hashlib.sha1(f'{CACHE_VERSION}|{fft_len}'.encode())
+        for _th in sorted(template_hash(template) for template in tribe):
+            _h.update(_th.encode())
+        return _h.hexdigest()
+
+    @classmethod
+    def build(cls, tribe, root, fft_len):
+        """
+        Open the cache for **tribe** at **fft_len** under **root**, computing
+        and saving it first if it does not exist.
+        """
+        path = Path(root) / cls.key(tribe, fft_len)
+        if (path / 'index.json').exists():
+            Logger.info(f'using cached template spectra in {path}')
+            return cls(path)
+        templates, rows, data = {}, [], {}
+        for template in tribe:
+            templates[template.name] = template_hash(template)
+            for tr in template.st:
+                _h = _row_hash(tr.data)
+                if _h not in data:
+                    data[_h] = tr.data
+                    rows.append(_h)
+        nfreq = fft_len//2 + 1
+        spectra = np.zeros((len(rows), nfreq), dtype=np.complex64)
+        stats = np.zeros((len(rows), 3), dtype=np.float64)
+        # Channels of one length are transformed together
+        lengths = {}
+        for _i, _h in enumerate(rows):
+            lengths.setdefault(len(data[_h]), []).append(_i)
+        for _idx in lengths.values():
+            spectra[_idx], stats[_idx] = _spectra(np.array([data[rows[_i]] for _i in _idx]), fft_len)
+        tmp = path.with_name(path.name + '.tmp')
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(str(tmp))
+        np.save(tmp / 'spectra.npy', spectra)
+        np.save(tmp / 'stats.npy', stats)
+        with open(tmp / 'index.json', 'w') as _f:
+            json.dump({'version': CACHE_VERSION, 'fft_len': int(fft_len),
+                       'processing': _processing(tribe[0]),
+                       'templates': templates, 'rows': rows}, _f)
+        os.replace(str(tmp), str(path))
+        Logger.info(f'cached spectra of {len(rows)} channels of {len(templates)} templates in {path}')
+        return cls(path)
+
+    def lookup(self, templates):
+        """Cache row of each row of a 2D template array, -1 where not cached"""
+        return np.array([self.rows.get(_row_hash(_t), -1) for _t in templates], dtype=int)
+
+    def activate(self):
+        """Make the cache available to the 'cached_fft' correlation function"""
+        _ACTIVE[self.fft_len] = self
+        return self
+
+    def deactivate(self):
+        _ACTIVE.pop(self.fft_len, None)
+
+
+def load_tribe(tribe_file, root, tribe_class=Tribe):
+    """
+    Read a tribe tarball, keeping a pickled copy under **root** so later reads
+    skip extracting and parsing the tarball. The copy is keyed by the
+    tarball's path, size, and modification time.
+
+    :param tribe_file: path to a tribe written with :meth:`~eqcorrscan.Tribe.write`
+    :param root: cache root directory
+    :param tribe_class: class used to read the tarball, e.g., ClusteringTribe
+    """
+    tribe_file = Path(tribe_file).resolve()
+    _st = tribe_file.stat()
+    key = hashlib.sha1(f'{tribe_file}|{_st.st_size}|{_st.st_mtime_ns}'.encode()).hexdigest()
+    pkl = Path(root) / 'tribes' / f'{key}.pkl'
+    if pkl.exists():
+        with open(pkl, 'rb') as _f:
+            return pickle.load(_f)
+    tribe = tribe_class().read(str(tribe_file))
+    os.makedirs(str(pkl.parent), exist_ok=True)
+    tmp = pkl.with_suffix('.tmp')
+    with open(tmp, 'wb') as _f:
+        pickle.dump(tribe, _f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, pkl)
+    return tribe
+
+
+@register_array_xcorr('cached_fft')
+def cached_normxcorr(templates, stream, pads, cc_squared=False, *args, **kwargs):
+    """
+    Normalized cross-correlation with the same interface and results as
+    EQcorrscan's numpy_normxcorr, using spectra from the smallest active
+    :class:`~.TemplateSpectra` long enough for **stream**.
+    """
+    import bottleneck
+
+    used_chans = ~np.isnan(templates).any(axis=1)
+    stream = stream.astype(np.float64)
+    template_length = templates.shape[1]
+    stream_length = len(stream)
+    assert stream_length > template_length, 'Template must be shorter than stream'
+    needed = template_length + stream_length - 1
+    fits = [_n for _n in _ACTIVE if _n >= needed]
+    if len(fits) > 0:
+        cache = _ACTIVE[min(fits)]
+        fft_len = cache.fft_len
+        rows = cache.lookup(templates)
+        hit = rows >= 0
+        template_fft = np.empty((len(templates), fft_len//2 + 1), dtype=np.complex128)
+        norm_sum = np.empty((len(templates), 1))
+        template_fft[hit] = cache.spectra[rows[hit]]
+        norm_sum[hit, 0] = cache.stats[rows[hit], 2]
+        if not hit.all():
+            template_fft[~hit], stats = _spectra(templates[~hit], fft_len)
+            norm_sum[~hit, 0] = stats[:, 2]
+    else:
+        fft_len = next_fast_len(needed, real=True)
+        template_fft, stats = _spectra(templates, fft_len)
+        norm_sum = stats[:, 2:]
+    stream_mean_array = bottleneck.move_mean(stream, template_length)[template_length - 1:]
+    stream_std_array = bottleneck.move_std(stream, template_length)[template_length - 1:]
+    stream_std_array[stream_std_array == 0] = np.nan
+    res = np.fft.irfft(template_fft*np.fft.rfft(stream, fft_len), fft_len)
+    # Valid correlation positions of the full convolution
+    res = res[:, template_length - 1:stream_length]
+    res = (res - norm_sum*stream_mean_array)/stream_std_array
+    res[np.isnan(res)] = 0.
+    if cc_squared:
+        res *= np.abs(res)
+    for _i, pad in enumerate(pads):
+        res[_i] = np.append(res[_i], np.zeros(pad))[pad:]
+    return res.astype(np.float32), used_chans
@@ -0,0 +1,401 @@
+"""
+:module: M4.5_Orcas_2025/src/template_match/xcc_clustering.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Cross-correlation clustering of templates for large tribes, with the
+    same distances and group labels as ClusteringTribe's `xcc` method
+    (:meth:`~eqcorrscan.utils.clustering.cluster`).
+
+    :class:`~.XCCMatrix` computes template-pair coherences channel by channel
+    with batched FFTs: each template channel is transformed once, and the
+    correlations of all candidate pairs sharing that channel are products of
+    those spectra. Candidate pairs can be limited to events within
+    **max_distance** km of each other (see :meth:`~event_offsets.neighbor_pairs`),
+    since distant events do not correlate. Coherences are kept as sparse
+    (i, j, value) arrays in a compressed `.npz` file keyed by the correlation
+    parameters, so adding templates to a tribe only correlates pairs that
+    involve the new (or changed) templates.
+
+    Distances follow :meth:`~eqcorrscan.utils.clustering.distance_matrix`:
+    the other template is trimmed by shift_len/2 at each end and slid along the
+    full-length master template, channel correlations are averaged over the
+    channels they share, and a pair's distance is 1 minus the larger of its two
+    (master/other) coherences. Pairs that were not correlated have distance 1.
+
+    :meth:`~.check_parity` compares distances and groups with EQcorrscan and
+    ClusteringTribe's `xcc` clustering for a tribe.
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy.cluster.hierarchy import linkage, fcluster
+from scipy.fft import next_fast_len
+from scipy.sparse import coo_array
+from scipy.spatial.distance import squareform
+
+from eqcorrscan.utils.clustering import distance_matrix, handle_distmat_nans
+
+from event_offsets import neighbor_pairs
+from template_spectra import template_hash
+
+Logger = logging.getLogger(__name__)
+
+XCC_VERSION = 2
+
+
+def template_locations(tribe):
+    """
+    Get template event locations as an event table indexed by template name,
+    with LAT, LON, MZ (km) and DATETIME columns. Templates without an origin
+    are omitted.
+    """
+    rows = {}
+    for template in tribe:
+        event = template.event
+        origin = None if event is None else (event.preferred_origin() or (event.origins or [None])[0])
+        # Without a full hypocenter the template is paired with every template
+        if origin is None or origin.latitude is None or origin.depth is None:
+            continue
+        # QuakeML depths are in meters
+        rows[template.name] = {'LAT': origin.latitude, 'LON': origin.longitude,
+                               'MZ': origin.depth/1000.,
+                               'DATETIME': pd.Timestamp(origin.time.datetime)}
+    return pd.DataFrame.from_dict(rows, orient='index', columns=['LAT', 'LON', 'MZ', 'DATETIME'])
+
+
+def candidate_pairs(names, locations=None, max_distance=None):
+    """
+    Get the (i, j), i < j index pairs of **names** to correlate: all pairs, or
+    pairs within **max_distance** km in **locations** (an event table indexed
+    by name, see :meth:`~.template_locations`). Templates without a location
+    are paired with every template.
+    """
+    nt = len(names)
+    if max_distance is None or locations is None:
+        ii, jj = np.triu_indices(nt, k=1)
+        return np.column_stack([ii, jj])
+    index = {_n: _i for _i, _n in enumerate(names)}
+    located = locations[locations.index.isin(index.keys())]
+    near = neighbor_pairs(located, max_distance)
+    pairs = [np.column_stack([near.evid_i.map(index).values, near.evid_j.map(index).values])]
+    unlocated = np.array([_i for _i, _n in enumerate(names) if _n not in located.index], dtype=int)
+    for _i in unlocated:
+        others = np.delete(np.arange(nt), _i)
+        pairs.append(np.column_stack([np.full(len(others), _i), others]))
+    pairs = np.sort(np.vstack(pairs).astype(int), axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def _channel_data(streams, end_trim, nfft):
+    """
+    Get, per channel, the spectra of the full-length (master) and normalized,
+    trimmed (other) traces of each template with that channel, and the
+    standard deviations of the master traces over each lag window. Repeated
+    channels within a template are paired by order, as in EQcorrscan.
+    """
+    channels = {}
+    for _i, st in enumerate(streams):
+        seen = {}
+        for tr in sorted(st, key=lambda _tr: _tr.id):
+            seen[tr.id] = seen.get(tr.id, -1) + 1
+            channels.setdefault((tr.id, seen[tr.id]), []).append((_i, tr.data))
+    out = {}
+    for key, members in channels.items():
+        owner = np.array([_m[0] for _m in members])
+        data = np.array([_m[1] for _m in members], dtype=np.float64)
+        npts = data.shape[1]
+        other = data[:, end_trim:npts - end_trim] if end_trim > 0 else data
+        tlen = other.shape[1]
+        std = other.std(axis=1, keepdims=True)
+        std[std == 0] = np.inf
+        norm = (other - other.mean(axis=1, keepdims=True))/(std*tlen)
+        # Moving standard deviation of the master traces for each of the 2*end_trim + 1 lags
+        csum = np.pad(np.cumsum(data, axis=1), ((0, 0), (1, 0)))
+        csum2 = np.pad(np.cumsum(data**2, axis=1), ((0, 0), (1, 0)))
+        nlag = npts - tlen + 1
+        mean = (csum[:, tlen:tlen + nlag] - csum[:, :nlag])/tlen
+        var = (csum2[:, tlen:tlen + nlag] - csum2[:, :nlag])/tlen - mean**2
+        mstd = np.sqrt(np.clip(var, 0, None))
+        mstd[mstd < 1e-10*np.abs(data).max(axis=1, keepdims=True)] = np.inf
+        position = np.full(len(streams), -1, dtype=int)
+        position[owner] = np.arange(len(owner))
+        out[key] = {'position': position,
+                    'master': np.fft.rfft(data, nfft, axis=1),
+                    'other': np.fft.rfft(norm, nfft, axis=1),
+                    'std': mstd}
+    return out
+
+
+def correlate_pairs(streams, pairs, shift_len, allow_individual_trace_shifts=False,
+                    batch_size=4096):
+    """
+    Cross-channel coherence of directed template pairs.
+
+    :param streams: list of template :class:`~obspy.core.stream.Stream` objects
+        with one sampling rate and trace length
+    :param pairs: (n, 2) array of (master, other) indices into **streams**
+    :param shift_len: total shift allowed, in seconds
+    :param allow_individual_trace_shifts: whether each channel may shift
+        independently rather than the template as a whole
+    :param batch_size: number of pairs correlated at a time
+
+    :returns:
+        - **coherence** (*numpy.ndarray*) -- channel-averaged maximum
+          correlation, nan where the templates share no channels
+        - **shift** (*numpy.ndarray*) -- shift of the other template in seconds
+        - **nchan** (*numpy.ndarray*) -- number of shared channels
+    """
+    pairs = np.asarray(pairs, dtype=int).reshape(-1, 2)
+    df = streams[0][0].stats.sampling_rate
+    end_trim = int((shift_len*df)/2)
+    npts = {tr.stats.npts for st in streams for tr in st}
+    if len(npts) != 1:
+        raise ValueError('template traces are not all the same length')
+    npts = npts.pop()
+    nfft = next_fast_len(npts, real=True)
+    channels = _channel_data(streams, end_trim, nfft)
+    nlag = 2*end_trim + 1
+    npairs = len(pairs)
+    coherence = np.full(npairs, np.nan)
+    shift = np.full(npairs, np.nan)
+    nchan = np.zeros(npairs, dtype=int)
+    for b0 in range(0, npairs, batch_size):
+        b1 = min(b0 + batch_size, npairs)
+        ii, jj = pairs[b0:b1, 0], pairs[b0:b1, 1]
+        stack = np.zeros((b1 - b0, nlag))
+        peaks = np.zeros(b1 - b0)
+        lags = [[] for _ in range(b1 - b0)]
+        count = np.zeros(b1 - b0, dtype=int)
+        for chan in channels.values():
+            pi, pj = chan['position'][ii], chan['position'][jj]
+            use = np.flatnonzero((pi >= 0) & (pj >= 0))
+            if len(use) == 0:
+                continue
+            cc = np.fft.irfft(chan['master'][pi[use]]*np.conj(chan['other'][pj[use]]), nfft, axis=1)
+            cc = cc[:, :nlag]/chan['std'][pi[use]]
+            stack[use] += cc
+            count[use] += 1
+            if allow_individual_trace_shifts:
+                peaks[use] += cc.max(axis=1)
+                for _u, _lag in zip(use, cc.argmax(axis=1)):
+                    lags[_u].append(_lag)
+        has = count > 0
+        if allow_individual_trace_shifts and end_trim > 0:
+            coherence[b0:b1][has] = peaks[has]/count[has]
+            shift[b0:b1][has] = [(np.mean(lags[_u]) - end_trim)/df for _u in np.flatnonzero(has)]
+        else:
+            coherence[b0:b1][has] = stack[has].max(axis=1)/count[has]
+            shift[b0:b1][has] = (stack[has].argmax(axis=1) - end_trim)/df
+        nchan[b0:b1] = count
+    return coherence, shift, nchan
+
+
+class XCCMatrix(object):
+    """
+    Incrementally updated, sparse template cross-correlation matrix.
+
+    :param path: optional `.npz` file to cache coherences in. Cached values
+        are only reused if they were computed with the same parameters.
+    :param shift_len: total shift allowed, in seconds
+    :param allow_individual_trace_shifts: see :meth:`~.correlate_pairs`
+    :param max_distance: only correlate events within this many km of each
+        other. None correlates all pairs.
+    """
+    def __init__(self, path=None, shift_len=0., allow_individual_trace_shifts=False,
+                 max_distance=None):
+        self.path = None if path is None else Path(path)
+        self.shift_len = float(shift_len)
+        self.allow_individual_trace_shifts = bool(allow_individual_trace_shifts)
+        self.max_distance = None if max_distance is None else float(max_distance)
+        self.names = []
+        self.hashes = []
+        self.pairs = np.zeros((0, 2), dtype=int)
+        self.coherence = np.zeros(0)
+        self.shift = np.zeros(0)
+        self.nchan = np.zeros(0, dtype=int)
+        if self.path is not None and self.path.exists():
+            self._load()
+
+    def __repr__(self):
+        return (f'XCCMatrix(templates={len(self.names)}, pairs={len(self.pairs)}, '
+                f'shift_len={self.shift_len}, max_distance={self.max_distance})')
+
+    def _parameters(self):
+        return {'version': XCC_VERSION, 'shift_len': self.shift_len,
+                'allow_individual_trace_shifts': self.allow_individual_trace_shifts,
+                'max_distance': self.max_distance}
+
+    def _load(self):
+        with np.load(self.path, allow_pickle=False) as npz:
+            params = json.loads(str(npz['parameters']))
+            if params != self._parameters():
+                Logger.warning(f'{self.path} was computed with {params}, not reusing it')
+                return
+            self.names = [str(_n) for _n in npz['names']]
+            self.hashes = [str(_h) for _h in npz['hashes']]
+            self.pairs = npz['pairs']
+            self.coherence = npz['coherence']
+            self.shift = npz['shift']
+            self.nchan = npz['nchan']
+        Logger.info(f'loaded {len(self.pairs)} cached pairs of {len(self.names)} templates')
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp = self.path.with_name(self.path.stem + '.tmp.npz')
+        np.savez_compressed(tmp, parameters=json.dumps(self._parameters()),
+                            names=np.array(self.names, dtype=str),
+                            hashes=np.array(self.hashes, dtype=str),
+                            pairs=self.pairs, coherence=self.coherence.astype(np.float32),
+                            shift=self.shift.astype(np.float32), nchan=self.nchan)
+        os.replace(tmp, self.path)
+
+    def update(self, tribe, locations=None):
+        """
+        Correlate the candidate pairs of **tribe**'s templates that are not
+        already in the matrix, in tribe order.
+
+        :param tribe: :class:`~eqcorrscan.Tribe` (or ClusteringTribe)
+        :param locations: event table indexed by template name for pruning
+            pairs by distance. Defaults to :meth:`~.template_locations`.
+        :returns: number of newly correlated template pairs
+        """
+        tic = time.perf_counter()
+        names = [template.name for template in tribe]
+        hashes = [template_hash(template) for template in tribe]
+        index = {_n: _i for _i, _n in enumerate(names)}
+        # Reuse pairs of unchanged templates, re-indexed to tribe order
+        reindex = np.full(len(self.names), -1, dtype=int)
+        for _i, (_n, _h) in enumerate(zip(self.names, self.hashes)):
+            if _n in index and hashes[index[_n]] == _h:
+                reindex[_i] = index[_n]
+        keep = (reindex[self.pairs[:, 0]] >= 0) & (reindex[self.pairs[:, 1]] >= 0)
+        pairs = reindex[self.pairs[keep]]
+        coherence, shift, nchan = self.coherence[keep], self.shift[keep], self.nchan[keep]
+        # Candidate pairs that involve a new or changed template
+        if self.max_distance is not None and locations is None:
+            locations = template_locations(tribe)
+        candidates = candidate_pairs(names, locations, self.max_distance)
+        known = reindex[reindex >= 0]
+        new = candidates[~(np.isin(candidates[:, 0], known) & np.isin(candidates[:, 1], known))]
+        if len(new) > 0:
+            # Both master/other directions of each pair
+            directed = np.vstack([new, new[:, ::-1]])
+            _coh, _shift, _nchan = correlate_pairs(
+                [template.st for template in tribe], directed, self.shift_len,
+                allow_individual_trace_shifts=self.allow_individual_trace_shifts)
+            pairs = np.vstack([pairs, directed])
+            coherence = np.concatenate([coherence, _coh])
+            shift = np.concatenate([shift, _shift])
+            nchan = np.concatenate([nchan, _nchan])
+        self.names, self.hashes = names, hashes
+        self.pairs, self.coherence, self.shift, self.nchan = pairs, coherence, shift, nchan
+        self.save()
+        Logger.info(f'correlated {len(new)} new of {len(candidates)} candidate pairs '
+                    f'({len(names)*(len(names) - 1)//2} total) in {time.perf_counter() - tic:.2f} s')
+        return len(new)
+
+    def matrix(self, values='coherence'):
+        """Directed (master, other) **values** as a sparse array in tribe order"""
+        nt = len(self.names)
+        return coo_array((getattr(self, values), (self.pairs[:, 0], self.pairs[:, 1])),
+                         shape=(nt, nt)).tocsr()
+
+    def distance_matrix(self):
+        """
+        Dense (N, N) distance matrix: 1 minus the larger of each pair's two
+        coherences, nan for correlated pairs without shared channels, and 1
+        for pairs that were not correlated.
+        """
+        nt = len(self.names)
+        dist = np.ones((nt, nt))
+        dist[self.pairs[:, 0], self.pairs[:, 1]] = 1. - self.coherence
+        # As in eqcorrscan's distance_matrix, nan if either direction is nan
+        dist = np.minimum(dist, dist.T)
+        np.fill_diagonal(dist, 0)
+        return dist
+
+    def cluster(self, corr_thresh=0.3, replace_nan_distances_with=None, **kwargs):
+        """
+        Cluster templates at distances below 1 - **corr_thresh** as
+        :meth:`~eqcorrscan.utils.clustering.cluster` does. **kwargs** are
+        passed to :meth:`~scipy.cluster.hierarchy.linkage`.
+
+        :returns: :class:`~pandas.Series` of group labels indexed by template name
+        """
+        dist = handle_distmat_nans(self.distance_matrix(),
+                                   replace_nan_distances_with=replace_nan_distances_with)
+        Z = linkage(squareform(dist, checks=False), **kwargs)
+        labels = fcluster(Z, t=1 - corr_thresh, criterion='distance')
+        Logger.info(f'found {len(set(labels))} groups')
+        return pd.Series(labels, index=pd.Index(self.names, name='name'), name='xcc')
+
+
+def same_partition(labels, other):
+    """Check whether two label Series (indexed by name) group names identically"""
+    if set(labels.index) != set(other.index):
+        return False
+    other = other.reindex(labels.index)
+    pairs = pd.DataFrame({'a': labels.values, 'b': other.values}).drop_duplicates()
+    return pairs.a.is_unique and pairs.b.is_unique
+
+
+def check_parity(xcc, ctr, nsample=50, atol=1e-3, seed=0, **xcckwargs):
+    """
+    Compare an :class:`~.XCCMatrix` updated with **ctr** against EQcorrscan
+    and ClusteringTribe.
+
+    Distances of up to **nsample** randomly chosen templates are compared to
+    :meth:`~eqcorrscan.utils.clustering.distance_matrix` over the pairs the
+    matrix correlated, and the matrix's groups are compared to the 'xcc'
+    groups of :meth:`~eqcutil.ClusteringTribe.cluster` (run with
+    **xcckwargs**, which replaces any existing 'xcc' groups of **ctr**). Groups
+    only match if the matrix correlated every pair (no **max_distance**).
+
+    :param xcc: :class:`~.XCCMatrix` updated with **ctr**
+    :param ctr: ClusteringTribe
+    :param nsample: number of templates to compare distances for
+    :param atol: largest absolute distance difference counted as equal
+    :param seed: random seed for the template sample
+    :param xcckwargs: keyword arguments of ClusteringTribe's `cluster` method
+        (method, corr_thresh, shift_len, replace_nan_distances_with, ...)
+
+    :returns: dict with 'max_error' (largest absolute distance difference),
+        'pairs' (number of pairs compared), 'same_groups', and 'parity'
+        (True if distances are within **atol** and groups match)
+    """
+    names = [template.name for template in ctr]
+    if names != xcc.names:
+        raise ValueError('xcc matrix was not updated with this tribe')
+    rng = np.random.default_rng(seed)
+    isub = np.sort(rng.choice(len(names), size=min(nsample, len(names)), replace=False))
+    ref, _, _ = distance_matrix([ctr[_i].st.copy() for _i in isub], shift_len=xcc.shift_len,
+                                allow_individual_trace_shifts=xcc.allow_individual_trace_shifts,
+                                replace_nan_distances_with=1)
+    dist = xcc.distance_matrix()[np.ix_(isub, isub)]
+    # Correlated pairs among the sampled templates, in sample order
+    pos = np.full(len(names), -1)
+    pos[isub] = np.arange(len(isub))
+    pairs = pos[xcc.pairs]
+    pairs = pairs[(pairs >= 0).all(axis=1)]
+    mask = np.zeros(dist.shape, dtype=bool)
+    mask[pairs[:, 0], pairs[:, 1]] = True
+    mask &= np.isfinite(dist) & np.isfinite(ref)
+    error = np.abs(dist - ref)[mask]
+    max_error = float(error.max()) if len(error) > 0 else 0.
+    labels = xcc.cluster(corr_thresh=xcckwargs.get('corr_thresh', 0.3),
+                         replace_nan_distances_with=xcckwargs.get('replace_nan_distances_with'))
+    ctr.cluster(**xcckwargs)
+    same_groups = same_partition(labels, ctr._c.xcc)
+    Logger.info(f'xcc parity: max distance error {max_error:.2e} over {mask.sum()} pairs, '
+                f'same groups: {same_groups}')
+    return {'max_error': max_error, 'pairs': int(mask.sum()), 'same_groups': same_groups,
+            'parity': max_error <= atol and same_groups}
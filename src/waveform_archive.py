@@ -0,0 +1,280 @@
+"""
+:module: M4.5_Orcas_2025/src/waveform_archive.py
+:auth: Nathan T. Stevens
+:email: ntsteven@uw.edu
+:org: Pacific Northwest Seismic Network
+:license: GNU GPLv3
+:purpose: Provides a persistent, on-disk waveform archive that sits in front of
+    an FDSN client (or any object with a `get_waveforms` method) so that
+    repeated review sessions only download the data they are missing.
+
+    Waveforms are saved as miniSEED files organized by NSLC and UTC day::
+
+        {root}/{NET}/{STA}/{NET}.{STA}.{LOC}.{CHA}.{YYYY}.{JJJ}.mseed
+
+    and an `index.json` file in **root** records which time spans have already
+    been requested from the client for each query (network, station, location,
+    and channel strings, wildcards included). Requests are broken into their
+    comma-delimited components, the un-covered spans (gaps) are fetched from
+    the client, written to the archive, and the requested data are read back
+    from disk as a single merged :class:`~obspy.core.stream.Stream`.
+
+    File writes and index updates are serialized with a lock, so one archive
+    can be filled from several threads at once (e.g., prefetching several
+    review sequences).
+"""
+
+import json
+import logging
+import os
+import threading
+from fnmatch import fnmatch
+from itertools import product
+from pathlib import Path
+
+from obspy import Stream, UTCDateTime, read
+
+from fetch_engine import ChunkedFetcher, FetchReport, split_request
+
+Logger = logging.getLogger(__name__)
+
+FILE_FMT = '{network}.{station}.{location}.{channel}.{year:04d}.{julday:03d}.mseed'
+
+
+def _split_codes(codes):
+    """Split a comma-delimited FDSN code string into a list of codes"""
+    if codes is None:
+        return ['*']
+    return [_c.strip() for _c in str(codes).split(',')]
+
+
+def _merge_spans(spans):
+    """Merge a list of [t0, t1] epoch-second pairs into non-overlapping spans"""
+    merged = []
+    for t0, t1 in sorted(spans):
+        if merged and t0 <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], t1)
+        else:
+            merged.append([t0, t1])
+    return merged
+
+
+def _subtract_spans(t0, t1, spans):
+    """Get the parts of [t0, t1] that are not covered by (merged) **spans**"""
+    gaps = []
+    cursor = t0
+    for s0, s1 in spans:
+        if s1 <= cursor:
+            continue
+        if s0 >= t1:
+            break
+        if s0 > cursor:
+            gaps.append([cursor, s0])
+        cursor = max(cursor, s1)
+        if cursor >= t1:
+            break
+    if cursor < t1:
+        gaps.append([cursor, t1])
+    return gaps
+
+
+class WaveformArchive(object):
+    """
+    A file-backed waveform cache with a `get_waveforms` interface matching
+    :meth:`~obspy.clients.fdsn.Client.get_waveforms`.
+
+    :param root: directory to host the archive
+    :param client: object with a `get_waveforms` method used to fill gaps. If
+        `None`, the archive is read-only and only returns data already on disk.
+    :param settle: seconds before the present within which fetched spans are not
+        marked as covered, so that data still arriving at the data center are
+        re-requested in the next session.
+    :param min_gap: gaps shorter than this many seconds are not fetched.
+    :param chunk_length: gaps are fetched in chunks no longer than this many seconds
+    :param max_workers: number of chunks fetched concurrently, see
+        :class:`~fetch_engine.ChunkedFetcher`
+    :param max_retries: number of times a failed chunk is retried
+    """
+    def __init__(self, root, client=None, settle=600., min_gap=1., chunk_length=3600.,
+                 max_workers=1, max_retries=2):
+        self.root = Path(root)
+        self.client = client
+        if client is not None:
+            self.fetcher = ChunkedFetcher(client, chunk_length=chunk_length,
+                                          max_workers=max_workers, max_retries=max_retries)
+        else:
+            self.fetcher = None
+        self.settle = float(settle)
+        self.min_gap = float(min_gap)
+        self.index_file = self.root / 'index.json'
+        os.makedirs(str(self.root), exist_ok=True)
+        self.index = self._load_index()
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f'WaveformArchive(root={self.root}, client={self.client!r}, queries={len(self.index)})'
+
+    ## INDEX METHODS ##
+
+    def _load_index(self):
+        if self.index_file.exists():
+            with open(self.index_file, 'r') as _f:
+                return json.load(_f)
+        return {}
+
+    def _save_index(self):
+        with self._lock:
+            tmp = self.index_file.with_suffix('.tmp')
+            with open(tmp, 'w') as _f:
+                json.dump(self.index, _f, indent=1)
+            os.replace(tmp, self.index_file)
+
+    def _expand_query(self, network, station, location, channel):
+        """Get the cartesian product of comma-delimited codes as query keys"""
+        return ['.'.join(_q) for _q in product(
+            _split_codes(network), _split_codes(station),
+            _split_codes(location), _split_codes(channel))]
+
+    def add_coverage(self, key, starttime, endtime):
+        """Mark the span **starttime** to **endtime** as covered for query **key**"""
+        with self._lock:
+            spans = list(self.index.get(key, []))
+            spans.append([float(UTCDateTime(starttime)), float(UTCDateTime(endtime))])
+            self.index[key] = _merge_spans(spans)
+
+    def get_gaps(self, network, station, location, channel, starttime, endtime):
+        """
+        Get the un-archived time spans for a request, returned as a list of
+        (query key, gap start, gap end) tuples with :class:`~obspy.UTCDateTime` times.
+        """
+        t0 = float(UTCDateTime(starttime))
+        t1 = float(UTCDateTime(endtime))
+        gaps = []
+        for key in self._expand_query(network, station, location, channel):
+            with self._lock:
+                spans = list(self.index.get(key, []))
+            for g0, g1 in _subtract_spans(t0, t1, spans):
+                if g1 - g0 >= self.min_gap:
+                    gaps.append((key, UTCDateTime(g0), UTCDateTime(g1)))
+        return gaps
+
+    ## FILE METHODS ##
+
+    def _day_path(self, network, station, location, channel, time):
+        return self.root / network / station / FILE_FMT.format(
+            network=network, station=station, location=location, channel=channel,
+            year=time.year, julday=time.julday)
+
+    def put_waveforms(self, st):
+        """
+        Write the contents of **st** into the archive's day files, merging
+        with any data already present.
+        """
+        # Merge overlaps and split back into contiguous (unmasked) segments
+        st = st.copy().merge(method=1).split()
+        # Split traces at day boundaries
+        for tr in st:
+            day0 = UTCDateTime(tr.stats.starttime.date)
+            while day0 <= tr.stats.endtime:
+                day1 = day0 + 86400.
+                _tr = tr.slice(starttime=day0, endtime=day1 - tr.stats.delta/2, nearest_sample=False)
+                day0 = day1
+                if _tr.stats.npts == 0:
+                    continue
+                path = self._day_path(_tr.stats.network, _tr.stats.station,
+                                      _tr.stats.location, _tr.stats.channel,
+                                      _tr.stats.starttime)
+                os.makedirs(str(path.parent), exist_ok=True)
+                _st = Stream([_tr])
+                if path.exists():
+                    _st += read(str(path))
+                    _st.merge(method=1)
+                    _st = _st.split()
+                # Write then move, so readers never see a partially written file
+                tmp = path.with_suffix('.tmp')
+                _st.write(str(tmp), format='MSEED')
+                os.replace(tmp, path)
+
+    def get_paths(self, network='*', station='*', location='*', channel='*',
+                  starttime=None, endtime=None):
+        """
+        Get the archive files that may contain data matching a request.
+        """
+        # Bound the UTC days to search. Either bound may be left open
+        day0 = '0000.000' if starttime is None else UTCDateTime(starttime).strftime('%Y.%j')
+        day1 = '9999.999' if endtime is None else UTCDateTime(endtime).strftime('%Y.%j')
+        paths = []
+        for key in self._expand_query(network, station, location, channel):
+            net, sta, loc, cha = key.split('.')
+            # FDSN-style '--' denotes an empty location code
+            pattern = '.'.join([net, sta, '' if loc == '--' else loc, cha])
+            for path in sorted(self.root.glob(f'{net}/{sta}/*.mseed')):
+                parts = path.name.split('.')
+                if not fnmatch('.'.join(parts[:4]), pattern):
+                    continue
+                if not day0 <= '.'.join(parts[4:6]) <= day1:
+                    continue
+                paths.append(path)
+        return sorted(set(paths))
+
+    def read(self, network='*', station='*', location='*', channel='*',
+             starttime=None, endtime=None):
+        """Read archived data matching a request without querying the client"""
+        st = Stream()
+        for path in self.get_paths(network, station, location, channel,
+                                   starttime, endtime):
+            st += read(str(path), starttime=starttime, endtime=endtime)
+        # Join segments split across day files, but leave gaps as separate traces
+        if len(st) > 0:
+            st.merge(method=-1)
+        return st
+
+    ## CLIENT METHODS ##
+
+    def update(self, network, station, location, channel, starttime, endtime):
+        """
+        Fetch any gaps between the archive and a request from the client and write
+        them to disk. Returns the list of gaps that were requested.
+        """
+        gaps = self.get_gaps(network, station, location, channel, starttime, endtime)
+        if self.client is None or len(gaps) == 0:
+            return gaps
+        chunks = []
+        for key, g0, g1 in gaps:
+            Logger.info(f'fetching {key} {g0} - {g1}')
+            chunks += split_request(*key.split('.'), g0, g1, split_codes=False,
+                                    chunk_length=self.fetcher.chunk_length)
+        horizon = UTCDateTime() - self.settle
+        # Per-call report: several threads may update through one fetcher
+        report = FetchReport()
+        # Write chunks as they arrive. Failed chunks are not marked as covered
+        for chunk, st in self.fetcher.fetch_chunks(chunks, report=report):
+            if len(st) > 0:
+                with self._lock:
+                    self.put_waveforms(st)
+            # Do not mark data that may still be arriving as covered
+            if chunk.starttime < horizon:
+                key = '.'.join(chunk[:4])
+                with self._lock:
+                    self.add_coverage(key, chunk.starttime, min(chunk.endtime, horizon))
+                    self._save_index()
+        if len(report.failed) > 0:
+            Logger.warning(f'{len(report.failed)} of {len(chunks)} chunks failed and remain gaps')
+        return gaps
+
+    def get_waveforms(self, network, station, location, channel, starttime, endtime, **kwargs):
+        """
+        Get waveforms for a request, only fetching un-archived spans from the client.
+        Extra keyword arguments are ignored for compatibility with FDSN-style calls.
+        """
+        self.update(network, station, location, channel, starttime, endtime)
+        return self.read(network, station, location, channel, starttime, endtime)
+
+    def get_waveforms_bulk(self, bulk, **kwargs):
+        """Bulk version of :meth:`~.WaveformArchive.get_waveforms`"""
+        st = Stream()
+        for network, station, location, channel, starttime, endtime in bulk:
+            st += self.get_waveforms(network, station, location, channel, starttime, endtime)
+        if len(st) > 0:
+            st.merge(method=-1)
+        return st